@@ -0,0 +1,27 @@
+"""
+Add the log directories of all existing jobs to the job log index.
+
+Until this has been run, looking up a job that isn't in the index means
+searching every month's log directory.
+"""
+
+import argparse
+import sys
+
+from agent.executors import job_log_index
+from agent.executors.local import METADATA_FILE
+
+
+def main():
+    count = job_log_index.backfill(METADATA_FILE)
+    print(f"Indexed {count} job log directories")
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(description=__doc__.partition("\n\n")[0])
+    parser.parse_args(argv)
+    main()
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
@@ -17,9 +17,8 @@ from agent.executors.local import (
     get_medium_privacy_workspace,
     get_output_metadata,
     get_workspace_action_names,
+    open_manifest_store,
     read_job_metadata,
-    read_manifest_file,
-    write_manifest_file,
 )
 from common.job_executor import Study
 from common.lib.git import get_sha_from_remote_ref
@@ -27,23 +26,29 @@ from common.lib.git import get_sha_from_remote_ref
 
 def main(workspace, partial_job_id, branch):
     medium_privacy_dir = get_medium_privacy_workspace(workspace)
-    # Retrieve existing manifest file and job_metadata from logs for this job
-    manifest, job_metadata = get_existing_manifest_and_job_metadata(
-        medium_privacy_dir, workspace, partial_job_id
-    )
+    # Retrieve job_metadata from logs for this job
+    job_metadata = get_job_metadata(medium_privacy_dir, workspace, partial_job_id)
     if job_metadata is None:
         return
 
-    # Find the repo_url from the first existing output in the manifest file
-    repo_url = next(iter(manifest["outputs"].values()))["repo"]
+    with open_manifest_store(workspace) as manifest:
+        # Find the repo_url from the first existing output in the manifest file
+        repo_url = manifest.get_first_output()["repo"]
+        existing_outputs = {
+            output
+            for output in job_metadata["outputs"]
+            if manifest.get_output(output) is not None
+        }
+
     # Get current workspace actions so we can determine if this is an out-of-date action or an
-    # out of date output
+    # out of date output. This needs the network, so we don't hold the manifest lock for it.
     commit = get_sha_from_remote_ref(repo_url, branch)
     job_definition = PsuedoJobDefinition("__none__", Study(repo_url, commit, branch))
     current_workspace_actions = get_workspace_action_names(job_definition)
 
+    new_outputs = {}
     for output, level in job_metadata["outputs"].items():
-        if output in manifest["outputs"]:
+        if output in existing_outputs:
             print(f"{output} exists in manifest.json, skipping")
             continue
         print(f"Updating manifest output metadata for {output}")
@@ -85,28 +90,27 @@ def main(workspace, partial_job_id, branch):
             output_metadata["out_of_date_action"] = True
             output_metadata["out_of_date_output"] = False
 
-        manifest["outputs"][output] = output_metadata
+        new_outputs[output] = output_metadata
 
-    write_manifest_file(medium_privacy_dir, manifest)
+    # Anything added to the manifest in the meantime is left as it is
+    with open_manifest_store(workspace) as manifest:
+        manifest.add_outputs(new_outputs)
 
 
-def get_existing_manifest_and_job_metadata(
-    medium_privacy_dir, workspace, partial_job_id
-):
+def get_job_metadata(medium_privacy_dir, workspace, partial_job_id):
     """
-    Retrieve existing manifest file and job metadata, with some sanity checks to
-    verify we've got the right ones for the workspace we said we're updating.
+    Retrieve job metadata, with some sanity checks to verify we've got the right
+    one for the workspace we said we're updating.
     """
     manifest_file = medium_privacy_dir / METADATA_DIR / MANIFEST_FILE
-    # sanity check to confirm we didn't typo the workspace name and we have read a manifest file
+    # sanity check to confirm we didn't typo the workspace name and we have a manifest file
     assert manifest_file.exists(), (
         f"Could not find existing manifest file for workspace {workspace}"
     )
-    manifest = read_manifest_file(medium_privacy_dir, workspace)
     job_id = get_full_job_id(partial_job_id)
     if job_id is None:
         print(f"No match found for job id {partial_job_id}")
-        return manifest, None
+        return None
 
     job_metadata = read_job_metadata(job_id)
     # make sure this job metadata is for the workspace we expect
@@ -121,7 +125,7 @@ def get_existing_manifest_and_job_metadata(
     manifest_backup_file = manifest_file.parent / f"{manifest_file.name}{job_id}.bu"
     shutil.copy(manifest_file, manifest_backup_file)
 
-    return manifest, job_metadata
+    return job_metadata
 
 
 def job_id_from_log_path(log_path):
@@ -10,12 +10,7 @@ import argparse
 import sys
 from dataclasses import dataclass
 
-from agent.executors.local import (
-    get_medium_privacy_workspace,
-    read_manifest_file,
-    update_manifest_outputs_and_actions,
-    write_manifest_file,
-)
+from agent.executors.local import update_manifest_outputs_and_actions
 from common.job_executor import Study
 
 
@@ -26,11 +21,8 @@ class PsuedoJobDefinition:
 
 
 def main(workspace, repo_url, commit):
-    medium_privacy_dir = get_medium_privacy_workspace(workspace)
-    manifest = read_manifest_file(medium_privacy_dir, workspace)
     job_definition = PsuedoJobDefinition("__none__", Study(repo_url, commit, "main"))
-    update_manifest_outputs_and_actions(manifest, job_definition, new_outputs={})
-    write_manifest_file(medium_privacy_dir, manifest)
+    update_manifest_outputs_and_actions(workspace, job_definition, new_outputs={})
 
 
 def run(argv):
@@ -9,6 +9,7 @@ class ConfigException(Exception):
 
 
 METRICS_FILE = common_config.WORKDIR / "metrics.sqlite"
+HASH_CACHE_FILE = common_config.WORKDIR / "hashes.sqlite"
 
 # valid archive formats
 ARCHIVE_FORMATS = (".tar.gz", ".tar.zstd", ".tar.xz")
@@ -102,12 +103,32 @@ HIGH_PRIVACY_ARCHIVE_DIR = Path(
     os.environ.get("HIGH_PRIVACY_ARCHIVE_DIR", HIGH_PRIVACY_STORAGE_BASE / "archives")
 )
 
+# Number of threads used to copy (and hash) a job's outputs out of its volume
+OUTPUT_COPY_WORKERS = int(os.environ.get("OUTPUT_COPY_WORKERS", "4"))
+
 # Automatically delete containers and volumes after they have been used
 CLEAN_UP_DOCKER_OBJECTS = True
 
+# If enabled, cleaning up a job only queues its container and volume for removal,
+# which a background thread then does every CLEANUP_INTERVAL seconds, rather than
+# blocking the agent loop
+CLEANUP_ASYNC = os.environ.get("CLEANUP_ASYNC", "false").lower().strip() in truthy
+CLEANUP_INTERVAL = float(os.environ.get("CLEANUP_INTERVAL", "10"))
+
+# If enabled, the agent loop starts by listing all job containers and volumes in
+# one go, and answers each task's status check from that snapshot, rather than
+# inspecting each job's container in turn
+STATUS_SNAPSHOT = os.environ.get("STATUS_SNAPSHOT", "false").lower().strip() in truthy
+
 # use to checkout the repo
 TMP_DIR = common_config.WORKDIR / "temp"
 
+# Checkouts of recently used commits are kept here, up to a total of
+# CHECKOUT_CACHE_MAX_SIZE bytes, and job volumes populated from them by linking
+# files rather than copying them where the filesystem allows. 0 disables the cache.
+CHECKOUT_CACHE_DIR = TMP_DIR / "checkouts"
+CHECKOUT_CACHE_MAX_SIZE = int(os.environ.get("CHECKOUT_CACHE_MAX_SIZE", "0"))
+
 # docker specific exit codes we understand
 DOCKER_EXIT_CODES = {
     # 137 = 128+9, which means was killed by signal 9, SIGKILL
@@ -126,11 +147,29 @@ HIGH_PRIVACY_VOLUME_DIR = Path(
     )
 )
 
+# How job volumes are provided: "bind" copies the code and inputs into a directory
+# which is bind mounted into the job's container; "overlay" instead mounts an
+# overlayfs whose lower layer holds the code and (hardlinked) inputs, and whose
+# upper layer receives everything the job writes. Overlay volumes need the agent to
+# be able to mount filesystems, and those mounts must be visible to docker.
+VOLUME_BACKEND = os.environ.get("VOLUME_BACKEND", "bind")
+if VOLUME_BACKEND not in ("bind", "overlay"):  # pragma: no cover
+    raise ConfigException(f"VOLUME_BACKEND must be bind or overlay: {VOLUME_BACKEND}")
+
 # when running inside a docker container, this needs to point to the path to
 # the HIGH_PRIVACY_VOLUME_DIR from the *hosts* perspective, as that's what
 # docker will be looking for.
 DOCKER_HOST_VOLUME_DIR = os.environ.get("DOCKER_HOST_VOLUME_DIR")
 
+# The Docker daemon's unix socket, which we use to talk to the Docker Engine API
+# directly for the calls we make most often, falling back to the docker CLI if it
+# isn't available. Defaults to the same daemon as the CLI uses; empty disables it.
+_docker_host = os.environ.get("DOCKER_HOST", "unix:///var/run/docker.sock")
+DOCKER_API_SOCKET = os.environ.get(
+    "DOCKER_API_SOCKET",
+    _docker_host.removeprefix("unix://") if _docker_host.startswith("unix://") else "",
+)
+
 DOCKER_USER_ID = os.environ.get("DOCKER_USER_ID", str(os.geteuid()))
 DOCKER_GROUP_ID = os.environ.get("DOCKER_GROUP_ID", str(os.getegid()))
 
@@ -143,6 +182,35 @@ DATABASE_ACCESS_NETWORK = os.environ.get("DATABASE_ACCESS_NETWORK", "jobrunner-d
 
 TASK_API_ENDPOINT = os.environ.get("CONTROLLER_TASK_API_ENDPOINT")
 
+# If set, a background thread long-polls the controller task api, waiting up to
+# this many seconds at a time for the active tasks to change, and wakes the agent
+# loop as soon as they do. 0 disables long-polling.
+TASK_LONG_POLL_TIMEOUT = float(os.environ.get("TASK_LONG_POLL_TIMEOUT", "0"))
+
+# If enabled, a background thread watches the executor's events (for the local
+# executor, docker's container events), and wakes the agent loop as soon as a job's
+# container exits, rather than waiting for the next poll to notice
+WATCH_EXECUTOR_EVENTS = (
+    os.environ.get("WATCH_EXECUTOR_EVENTS", "false").lower().strip() in truthy
+)
+
+# When long-polling, how long the agent loop waits between runs if it has no active
+# tasks. Changes to the tasks will wake it sooner.
+IDLE_LOOP_INTERVAL = float(os.environ.get("IDLE_LOOP_INTERVAL", "60"))
+
+# If enabled, the agent loop hands the next step of each task (e.g. preparing or
+# finalizing a job) to a pool of worker threads for that step's stage, rather than
+# handling each task in turn, so a slow step doesn't hold up other jobs
+TASK_PIPELINE = os.environ.get("TASK_PIPELINE", "false").lower().strip() in truthy
+PREPARE_WORKERS = int(os.environ.get("PREPARE_WORKERS", "2"))
+EXECUTE_WORKERS = int(os.environ.get("EXECUTE_WORKERS", "2"))
+FINALIZE_WORKERS = int(os.environ.get("FINALIZE_WORKERS", "2"))
+CLEANUP_WORKERS = int(os.environ.get("CLEANUP_WORKERS", "1"))
+
+# Number of background threads fetching the code for new jobs from GitHub ahead of
+# them being prepared. 0 disables prefetching.
+GIT_PREFETCH_WORKERS = int(os.environ.get("GIT_PREFETCH_WORKERS", "0"))
+
 # Token for authenticating with the controller task api
 # For now this will reuse the job-server token for this backend
 TASK_API_TOKEN = os.environ.get("CONTROLLER_TASK_API_TOKEN", "token")
@@ -0,0 +1,130 @@
+"""
+Cache of checked out commits, used to populate job volumes.
+
+Every job needs the code for its commit copied into its volume, and all the jobs
+in a RAP usually share the same commit. Rather than check out the commit afresh
+for every job, we keep one checkout per commit under CHECKOUT_CACHE_DIR, and
+populate volumes from it with reflinks where possible (see `volumes.stage_file`).
+Its files are only ever hardlinked into the lower layer of an overlay volume,
+which jobs can't write to; a job must never share an inode with the cache, as it
+could then change the checkout for every later job.
+
+The cache is bounded by CHECKOUT_CACHE_MAX_SIZE bytes, evicting the least
+recently used checkouts first. The size of each checkout is recorded in a
+`<commit>.size` file alongside it, so eviction doesn't need to walk every tree.
+"""
+
+import contextlib
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import threading
+from collections import Counter
+from pathlib import Path
+
+from agent import config
+from common.lib.git import checkout_commit
+
+
+log = logging.getLogger(__name__)
+
+# Held while looking up, pinning and evicting checkouts. Never held while creating
+# or using one, so that jobs for different commits don't wait on each other
+_lock = threading.Lock()
+# The number of users of each commit's checkout. Pinned checkouts are never evicted
+_pins = Counter()
+# Held while creating a commit's checkout, so that it is only created once. Checkouts
+# of different commits from the same repo are also serialized, by `checkout_commit`
+# holding the repo's lock
+_creating = {}
+
+
+@contextlib.contextmanager
+def cached_checkout(repo_url, commit):
+    """Yield the path to a checkout of `commit` from `repo_url`, which must not be
+    modified"""
+    with _lock:
+        _pins[commit] += 1
+        creating = _creating.setdefault(commit, threading.Lock())
+    try:
+        path = config.CHECKOUT_CACHE_DIR / commit
+        with creating:
+            if path.exists():
+                log.debug(f"Using cached checkout of {commit}")
+                # record that we've used it, for LRU eviction
+                os.utime(path)
+            else:
+                create_checkout(repo_url, commit, path)
+                with _lock:
+                    evict(keep=set(_pins))
+        yield path
+    finally:
+        with _lock:
+            _pins[commit] -= 1
+            if not _pins[commit]:
+                del _pins[commit]
+                del _creating[commit]
+
+
+def create_checkout(repo_url, commit, path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Check out into a temporary directory and move it into place once complete,
+    # so we never use a partial checkout
+    tmp_dir = Path(tempfile.mkdtemp(dir=path.parent, prefix=".tmp-"))
+    try:
+        checkout_commit(repo_url, commit, tmp_dir)
+        size = checkout_size(tmp_dir)
+        size_path(path).write_text(str(size))
+        tmp_dir.rename(path)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def checkout_size(directory):
+    """Return the total size of all the files under `directory`"""
+    size = 0
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            st = Path(dirpath, filename).lstat()
+            if stat.S_ISREG(st.st_mode):
+                size += st.st_size
+    return size
+
+
+def size_path(path):
+    return path.with_name(f"{path.name}.size")
+
+
+def get_checkouts():
+    """Return (mtime, commit, size) for all cached checkouts"""
+    checkouts = []
+    for path in config.CHECKOUT_CACHE_DIR.iterdir():
+        if path.name.startswith(".") or not path.is_dir():
+            continue
+        try:
+            size = int(size_path(path).read_text())
+        except (OSError, ValueError):
+            size = 0
+        checkouts.append((path.stat().st_mtime, path.name, size))
+    return checkouts
+
+
+def evict(keep=()):
+    """Remove the least recently used checkouts until we are within
+    CHECKOUT_CACHE_MAX_SIZE. The checkouts for the commits in `keep` are never
+    removed."""
+    checkouts = sorted(get_checkouts())
+    total = sum(size for _, _, size in checkouts)
+    for _, commit, size in checkouts:
+        if total <= config.CHECKOUT_CACHE_MAX_SIZE:
+            break
+        if commit in keep:
+            continue
+        log.info(f"Evicting cached checkout of {commit}")
+        path = config.CHECKOUT_CACHE_DIR / commit
+        shutil.rmtree(path)
+        size_path(path).unlink(missing_ok=True)
+        total -= size
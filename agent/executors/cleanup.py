@@ -0,0 +1,135 @@
+"""
+Background cleanup of job containers and volumes.
+
+Removing a finished job's container and deleting its volume can take a long
+time for large volumes, and would block the agent loop. When CLEANUP_ASYNC is
+enabled, cleaning up a job instead just queues the work, and a background
+reaper thread does it:
+
+ - the volume is renamed into a trash directory, on the same filesystem, which
+   is atomic and immediate, and the reaper deletes it at a low IO priority
+ - the container is queued for removal by creating a marker file
+
+Both queues live on disk, so any outstanding cleanup survives a restart.
+"""
+
+import logging
+import shutil
+import subprocess
+import threading
+import time
+
+from opentelemetry import trace
+
+from agent import config
+from agent.executors import volumes
+from agent.lib import docker
+
+
+log = logging.getLogger(__name__)
+tracer = trace.get_tracer("cleanup")
+
+# Delete trashed volumes at the lowest best-effort IO priority, so that we don't
+# compete with running jobs for disk bandwidth. We avoid the idle class as it can
+# starve us completely on a busy disk.
+IONICE = ["ionice", "--class", "2", "--classdata", "7"]
+
+
+# Held while removing a queued container, so that the reaper can't remove a new
+# container which has reused the name of one it had queued
+_container_lock = threading.Lock()
+
+
+def trash_dir():
+    return config.HIGH_PRIVACY_VOLUME_DIR / ".trash"
+
+
+def volume_trash_dir():
+    return trash_dir() / "volumes"
+
+
+def container_queue_dir():
+    return trash_dir() / "containers"
+
+
+def queue_cleanup(job, container):
+    """Queue removal of the job's container and volume"""
+    queue_container_removal(container)
+    volumes.trash_volume(job, volume_trash_dir())
+
+
+def queue_container_removal(name):
+    container_queue_dir().mkdir(parents=True, exist_ok=True)
+    (container_queue_dir() / name).touch()
+
+
+def cancel_container_removal(name):
+    """Remove a container queued for removal now, so the name can be reused"""
+    marker = container_queue_dir() / name
+    with _container_lock:
+        if marker.exists():
+            docker.delete_container(name)
+            marker.unlink(missing_ok=True)
+
+
+def backlog_size():
+    """The number of containers and volumes waiting to be cleaned up"""
+    return sum(
+        len(list(directory.iterdir()))
+        for directory in (container_queue_dir(), volume_trash_dir())
+        if directory.exists()
+    )
+
+
+def main():  # pragma: no cover
+    while True:
+        reap()
+        time.sleep(config.CLEANUP_INTERVAL)
+
+
+def reap():
+    """Remove all the queued containers and trashed volumes"""
+    with tracer.start_as_current_span("CLEANUP") as span:
+        span.set_attribute("backlog", backlog_size())
+        containers = errors = trashed_volumes = 0
+
+        if container_queue_dir().exists():
+            for marker in container_queue_dir().iterdir():
+                with _container_lock:
+                    # its removal may have been cancelled since we listed it,
+                    # and the name reused for a new container
+                    if not marker.exists():
+                        continue
+                    try:
+                        docker.delete_container(marker.name)
+                    except Exception:
+                        log.exception(f"Failed to remove container {marker.name}")
+                        errors += 1
+                    else:
+                        marker.unlink(missing_ok=True)
+                        containers += 1
+
+        if volume_trash_dir().exists():
+            for path in volume_trash_dir().iterdir():
+                try:
+                    delete_trashed_volume(path)
+                except Exception:
+                    log.exception(f"Failed to delete trashed volume {path}")
+                    errors += 1
+                else:
+                    trashed_volumes += 1
+
+        span.set_attributes(
+            {"containers": containers, "volumes": trashed_volumes, "errors": errors}
+        )
+
+
+def delete_trashed_volume(path):
+    try:
+        subprocess.run(
+            IONICE + ["rm", "-rf", "--", str(path)], check=True, capture_output=True
+        )
+    except FileNotFoundError:
+        # no ionice available, so just delete it ourselves
+        log.warning("ionice not found, deleting trashed volume at normal priority")
+        shutil.rmtree(path)
@@ -0,0 +1,109 @@
+"""
+Index of job ids to their log directories.
+
+Job log directories are split up by the month the job was created, so finding
+one from just a job id means searching every month directory. Instead, we
+record each job's log directory in a sqlite db in JOB_LOG_DIR when we write its
+metadata.
+
+Jobs whose logs were written before the index existed are only found by
+searching, until the index has been backfilled with `backfill()` (see
+`agent.cli.backfill_job_log_index`). After that, a job missing from the index
+has no logs.
+"""
+
+import sqlite3
+import threading
+
+from agent import config
+
+
+INDEX_FILE = "index.sqlite"
+
+# job log directories are named after the job's container
+LOG_DIR_PREFIX = "os-job-"
+
+DDL = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT,
+    -- relative to JOB_LOG_DIR
+    log_dir TEXT,
+    PRIMARY KEY (id)
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+CONNECTION_CACHE = threading.local()
+
+
+def get_connection():
+    db_file = config.JOB_LOG_DIR / INDEX_FILE
+    cache = CONNECTION_CACHE.__dict__
+    if db_file not in cache:
+        db_file.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(db_file)
+        # manual transactions
+        conn.isolation_level = None
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.executescript(DDL)
+        cache[db_file] = conn
+
+    return cache[db_file]
+
+
+def add(job_id, log_dir):
+    get_connection().execute(
+        """
+        INSERT INTO jobs (id, log_dir) VALUES (?, ?)
+        ON CONFLICT(id) DO UPDATE SET log_dir = excluded.log_dir
+        """,
+        (job_id, str(log_dir.relative_to(config.JOB_LOG_DIR))),
+    )
+
+
+def lookup(job_id):
+    """Return the indexed log directory for the job, or None"""
+    row = (
+        get_connection()
+        .execute("SELECT log_dir FROM jobs WHERE id = ?", (job_id,))
+        .fetchone()
+    )
+    return config.JOB_LOG_DIR / row[0] if row else None
+
+
+def is_complete():
+    """Has the index been backfilled with all the jobs from before it existed?"""
+    row = (
+        get_connection()
+        .execute("SELECT value FROM state WHERE key = 'backfilled'")
+        .fetchone()
+    )
+    return row is not None
+
+
+def backfill(metadata_file):
+    """Index the log directories of all jobs with a `metadata_file`, and return
+    how many there are"""
+    jobs = [
+        (
+            path.parent.name.removeprefix(LOG_DIR_PREFIX),
+            str(path.parent.relative_to(config.JOB_LOG_DIR)),
+        )
+        for path in config.JOB_LOG_DIR.glob(f"*/{LOG_DIR_PREFIX}*/{metadata_file}")
+    ]
+    conn = get_connection()
+    # commits, or rolls back on error
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        # don't overwrite anything indexed since we searched
+        conn.executemany(
+            "INSERT INTO jobs (id, log_dir) VALUES (?, ?) ON CONFLICT(id) DO NOTHING",
+            jobs,
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO state (key, value) VALUES ('backfilled', 'true')"
+        )
+    return len(jobs)
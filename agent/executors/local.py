@@ -1,19 +1,27 @@
-import csv
+import copy
 import datetime
+import functools
 import json
 import logging
 import subprocess
 import tempfile
 import time
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from types import MappingProxyType
 
-from pipeline import load_pipeline
+from opentelemetry import trace
 
 from agent import config
-from agent.executors import volumes
-from agent.lib import docker
+from agent.executors import (
+    checkout_cache,
+    cleanup,
+    job_log_index,
+    manifest_store,
+    volumes,
+)
+from agent.executors.status_snapshot import LiveStatus, StatusSnapshot
+from agent.lib import csv_counter, docker, hash_cache
 from agent.metrics import read_job_metrics
 from common.job_executor import (
     ExecutorAPI,
@@ -23,7 +31,7 @@ from common.job_executor import (
     JobStatus,
     Privacy,
 )
-from common.lib import datestr_to_ns_timestamp, file_digest
+from common.lib import datestr_to_ns_timestamp, pipeline_cache
 from common.lib.git import GitError, checkout_commit, read_file_from_repo
 from common.lib.string_utils import tabulate
 
@@ -42,6 +50,12 @@ METADATA_DIR = "metadata"
 # Records information about job that's finished running
 METADATA_FILE = "metadata.json"
 
+# The same, apart from COLD_METADATA_KEYS, which is all we need for status checks
+SUMMARY_FILE = "summary.json"
+
+# Large metadata that only logs and some CLIs need
+COLD_METADATA_KEYS = {"container_metadata"}
+
 # Records details of which action created each file
 MANIFEST_FILE = "manifest.json"
 
@@ -59,7 +73,7 @@ log = logging.getLogger(__name__)
 
 
 def container_name(job_id):
-    return f"os-job-{job_id}"
+    return f"{job_log_index.LOG_DIR_PREFIX}{job_id}"
 
 
 def get_high_privacy_workspace(workspace):
@@ -93,9 +107,34 @@ def read_job_metadata(job_id):
     return {}
 
 
+def read_job_summary(job_id):
+    """Load the summary of any stored metadata for this job ID, which is everything
+    apart from COLD_METADATA_KEYS"""
+    path = job_metadata_path(job_id)
+    if not path:
+        return {}
+    summary_path = path.with_name(SUMMARY_FILE)
+    try:
+        st = summary_path.stat()
+    except FileNotFoundError:
+        # written before we had summaries
+        summary_path = path
+        st = summary_path.stat()
+    summary = load_summary(summary_path, st.st_ino, st.st_mtime_ns, st.st_size)
+    # copy it, so that callers can't modify the cached summary
+    return METADATA_DEFAULTS | copy.deepcopy(summary)
+
+
+@functools.lru_cache(maxsize=1024)
+def load_summary(path, inode, mtime_ns, size):
+    # the stat fields aren't used, but invalidate the cache if the file changes
+    metadata = json.loads(path.read_text())
+    return {k: v for k, v in metadata.items() if k not in COLD_METADATA_KEYS}
+
+
 def read_job_task_metadata(job_definition):
-    """Read any previously stored metadata for this specific task"""
-    metadata = read_job_metadata(job_definition.id)
+    """Read the summary of any previously stored metadata for this specific task"""
+    metadata = read_job_summary(job_definition.id)
     metadata_task_id = metadata.get("task_id")
     # Ignore previously stored task-specifc job metadata (i.e. metadata that
     # has written a task_id) if it doesn't match our current task
@@ -109,6 +148,12 @@ def write_job_metadata(job_definition, job_metadata):
     metadata_path = get_log_dir(job_definition) / METADATA_FILE
     metadata_path.parent.mkdir(exist_ok=True, parents=True)
     metadata_path.write_text(json.dumps(job_metadata, indent=2))
+    # replace it atomically, as it may be cached by inode
+    summary = {k: v for k, v in job_metadata.items() if k not in COLD_METADATA_KEYS}
+    summary_tmp = metadata_path.with_name(f"{SUMMARY_FILE}.tmp")
+    summary_tmp.write_text(json.dumps(summary))
+    summary_tmp.replace(metadata_path.with_name(SUMMARY_FILE))
+    job_log_index.add(job_definition.id, metadata_path.parent)
 
 
 def job_metadata_path(job_id):
@@ -116,7 +161,7 @@ def job_metadata_path(job_id):
 
     Because the path we write metadata to includes the month at the time the job was
     created, and because sometimes we need to look up metadata from a job ID without
-    knowing the creation time, we have to search for it.
+    knowing the creation time, we look it up in the job log index.
 
     This is tech debt we knowingly incurred when we prioritised finishing the
     Agent/Controller split in order to unblock the RAP API work.
@@ -124,10 +169,18 @@ def job_metadata_path(job_id):
     For further details see:
     https://github.com/opensafely-core/job-runner/pull/1454
     """
+    log_dir = job_log_index.lookup(job_id)
+    if log_dir is not None and (log_dir / METADATA_FILE).exists():
+        return log_dir / METADATA_FILE
+    if log_dir is None and job_log_index.is_complete():
+        return None
+
+    # not indexed, so we have to search for it
     job_metadata_file = container_name(job_id) + "/" + METADATA_FILE
     paths = list(config.JOB_LOG_DIR.glob(f"*/{job_metadata_file}"))
     assert len(paths) <= 1, f"Expected at most one path, got: {paths!r}"
     if paths:
+        job_log_index.add(job_id, paths[0].parent)
         return paths[0]
 
     return None
@@ -153,7 +206,41 @@ def workspace_is_archived(workspace):
 class LocalDockerAPI(ExecutorAPI):
     """ExecutorAPI implementation using local docker service."""
 
+    def __init__(self):
+        self.status_snapshot = None
+
+    def snapshot_status(self):
+        if not config.STATUS_SNAPSHOT:
+            return
+        try:
+            self.status_snapshot = StatusSnapshot.take(
+                LABEL, previous=self.status_snapshot, timeout=15
+            )
+        except docker.DockerTimeoutError:
+            log.warning("docker timed out listing containers, checking each job")
+            self.status_snapshot = None
+
+    def invalidate_status(self, job_definition):
+        """We are about to change the job's state, so stop using the snapshot"""
+        if self.status_snapshot:
+            self.status_snapshot.invalidate(job_definition.id)
+
+    def watch_events(self, callback):
+        for event in docker.container_events(LABEL, ["die"]):
+            name = event["Actor"]["Attributes"]["name"]
+            job_id = name.removeprefix(job_log_index.LOG_DIR_PREFIX)
+            # the snapshot still has it running
+            if self.status_snapshot:
+                self.status_snapshot.invalidate(job_id)
+            callback(job_id)
+
+    def current_status(self, job_definition):
+        if self.status_snapshot and self.status_snapshot.is_valid(job_definition.id):
+            return self.status_snapshot
+        return LiveStatus()
+
     def prepare(self, job_definition):
+        self.invalidate_status(job_definition)
         # Check the workspace is not archived
         workspace_dir = get_high_privacy_workspace(job_definition.workspace)
         if not workspace_dir.exists():
@@ -177,10 +264,14 @@ class LocalDockerAPI(ExecutorAPI):
         prepare_job(job_definition)
 
     def execute(self, job_definition):
+        self.invalidate_status(job_definition)
         current = self.get_status(job_definition)
         if current.state != ExecutorState.PREPARED:
             return current
 
+        # the job may have been prepared before the agent or host restarted
+        volumes.mount_volume(job_definition)
+
         extra_args = []
         # Configure logging
         extra_args.extend(
@@ -252,6 +343,9 @@ class LocalDockerAPI(ExecutorAPI):
             job_definition.image, job_definition.image_sha
         )
 
+        # a previous run of this job may have left its container queued for removal
+        cleanup.cancel_container_removal(container_name(job_definition.id))
+
         docker.run(
             container_name(job_definition.id),
             [image] + job_definition.args,
@@ -265,6 +359,7 @@ class LocalDockerAPI(ExecutorAPI):
         )
 
     def finalize(self, job_definition, cancelled=False, error=None):
+        self.invalidate_status(job_definition)
         current_status = self.get_status(job_definition, cancelled=cancelled)
 
         if current_status.state in [ExecutorState.FINALIZED, ExecutorState.ERROR]:
@@ -283,6 +378,7 @@ class LocalDockerAPI(ExecutorAPI):
         return self.get_status(job_definition)
 
     def terminate(self, job_definition):
+        self.invalidate_status(job_definition)
         current_status = self.get_status(job_definition)
         if current_status.state == ExecutorState.UNKNOWN:
             # job was pending, so do not go to EXECUTED
@@ -306,7 +402,11 @@ class LocalDockerAPI(ExecutorAPI):
         docker.kill(container_name(job_definition.id))
 
     def cleanup(self, job_definition):
-        if config.CLEAN_UP_DOCKER_OBJECTS:
+        self.invalidate_status(job_definition)
+        if config.CLEAN_UP_DOCKER_OBJECTS and config.CLEANUP_ASYNC:
+            log.info("Queueing container and volume for cleanup")
+            cleanup.queue_cleanup(job_definition, container_name(job_definition.id))
+        elif config.CLEAN_UP_DOCKER_OBJECTS:
             log.info("Cleaning up container and volume")
             docker.delete_container(container_name(job_definition.id))
             volumes.delete_volume(job_definition)
@@ -317,12 +417,9 @@ class LocalDockerAPI(ExecutorAPI):
 
     def get_status(self, job_definition, timeout=15, cancelled=False):
         name = container_name(job_definition.id)
+        status = self.current_status(job_definition)
         try:
-            container = docker.container_inspect(
-                name,
-                none_if_not_exists=True,
-                timeout=timeout,
-            )
+            container = status.container_inspect(name, timeout=timeout)
         except docker.DockerTimeoutError:
             raise ExecutorRetry(
                 f"docker timed out after {timeout}s inspecting container {name}"
@@ -348,7 +445,7 @@ class LocalDockerAPI(ExecutorAPI):
             # job. If we're not, the job may have been previously cancelled; look up
             # its cancelled status in job metadata, if it exists
             if cancelled or job_metadata.get("cancelled"):
-                if volumes.volume_exists(job_definition):
+                if status.volume_exists(job_definition):
                     # jobs prepared but not running still need to finalize, in order
                     # to record their cancelled state
                     return JobStatus(
@@ -362,8 +459,8 @@ class LocalDockerAPI(ExecutorAPI):
                     )
 
             # timestamp file presence means we have finished preparing
-            timestamp_ns = volumes.read_timestamp(
-                job_definition, TIMESTAMP_REFERENCE_FILE, 10
+            timestamp_ns = status.read_timestamp(
+                job_definition, TIMESTAMP_REFERENCE_FILE
             )
             # TODO: maybe log the case where the volume exists, but the
             # timestamp file does not? It's not a problem as the loop should
@@ -428,7 +525,7 @@ def prepare_job(job_definition):
     # build a list of required input_files for this job
     job_input_files = []
     for job_id in job_definition.input_job_ids:
-        metadata = read_job_metadata(job_id)
+        metadata = read_job_summary(job_id)
         job_input_files.extend(list(metadata.get("outputs", {}).keys()))
 
     # `docker cp` can't create parent directories for us so we make sure all
@@ -447,13 +544,21 @@ def prepare_job(job_definition):
             f"Could not checkout commit {job_definition.commit} from {job_definition.repo_url}"
         )
 
+    staging_stats = volumes.StagingStats()
     for filename in job_input_files:
         log.info(f"Copying input file: {filename}")
         if not (workspace_dir / filename).exists():
             raise LocalDockerError(
                 f"The file {filename} doesn't exist in workspace {job_definition.workspace} as requested for job {job_definition.id}"
             )
-        volumes.copy_to_volume(job_definition, workspace_dir / filename, filename)
+        volumes.stage_to_volume(
+            job_definition, workspace_dir / filename, filename, staging_stats
+        )
+    trace.get_current_span().set_attributes(
+        staging_stats.span_attributes("input_staging")
+    )
+
+    volumes.mount_volume(job_definition)
 
     # Used to record state for telemetry, and also see `get_unmatched_outputs`
     volumes.write_timestamp(job_definition, TIMESTAMP_REFERENCE_FILE)
@@ -475,8 +580,9 @@ def finalize_job(job_definition, cancelled, error=None):
         unmatched_patterns = []
         unmatched_outputs = []
     else:
-        outputs, unmatched_patterns = find_matching_outputs(job_definition)
-        unmatched_outputs = get_unmatched_outputs(job_definition, outputs)
+        volume_scan = volumes.scan_volume(job_definition, TIMESTAMP_REFERENCE_FILE)
+        outputs, unmatched_patterns = find_matching_outputs(job_definition, volume_scan)
+        unmatched_outputs = get_unmatched_outputs(volume_scan, outputs)
 
     if container_metadata:
         redact_environment_variables(container_metadata)
@@ -651,12 +757,36 @@ def persist_outputs(job_definition, outputs, job_metadata):
     excluded_job_msgs = {}
     excluded_file_msgs = {}
 
-    sizes = {}
-    # copy all files into workspace long term storage
-    for filename, level in outputs.items():
-        log.info(f"Extracting output file: {filename}")
-        dst = workspace_dir / filename
-        sizes[filename] = volumes.copy_from_volume(job_definition, filename, dst)
+    # copy all files into workspace long term storage, hashing them and counting
+    # the rows of any L4 csv files as we go
+    def extract_output(filename, level):
+        read_csv = None
+        if (
+            level == "moderately_sensitive"
+            and Path(filename).suffix == ".csv"
+            and ".csv" in job_definition.level4_file_types
+        ):
+            # we only need to know if there are too many rows, not how many
+            read_csv = functools.partial(
+                read_csv_counts, max_rows=job_definition.level4_max_csv_rows
+            )
+        return volumes.copy_and_hash_from_volume(
+            job_definition,
+            filename,
+            workspace_dir / filename,
+            read_stream=read_csv,
+            max_read_size=job_definition.level4_max_filesize,
+        )
+
+    with ThreadPoolExecutor(
+        max_workers=config.OUTPUT_COPY_WORKERS, thread_name_prefix="copy"
+    ) as executor:
+        futures = {}
+        for filename, level in outputs.items():
+            # log here, as the log context doesn't extend to the executor's threads
+            log.info(f"Extracting output file: {filename}")
+            futures[filename] = executor.submit(extract_output, filename, level)
+        copied = {filename: future.result() for filename, future in futures.items()}
 
     l4_files = [
         filename
@@ -668,7 +798,11 @@ def persist_outputs(job_definition, outputs, job_metadata):
     # check any L4 files are valid
     for filename in l4_files:
         ok, job_msg, file_msg, csv_counts = check_l4_file(
-            job_definition, filename, sizes[filename], workspace_dir
+            job_definition,
+            filename,
+            copied[filename].size,
+            workspace_dir,
+            csv_result=copied[filename].read_result,
         )
         if not ok:
             excluded_job_msgs[filename] = job_msg
@@ -712,54 +846,32 @@ def persist_outputs(job_definition, outputs, job_metadata):
             user=job_definition.user,
             message=excluded_job_msgs.get(filename),
             csv_counts=csv_metadata.get(filename),
+            content_hash=copied[filename].sha256,
         )
 
     # Update manifest with file metdata
-    manifest = read_manifest_file(medium_privacy_dir, job_definition.workspace)
-
-    update_manifest_outputs_and_actions(manifest, job_definition, new_outputs)
-
-    write_manifest_file(medium_privacy_dir, manifest)
+    update_manifest_outputs_and_actions(
+        job_definition.workspace, job_definition, new_outputs
+    )
 
     return excluded_job_msgs
 
 
-def update_manifest_outputs_and_actions(manifest, job_definition, new_outputs):
+def update_manifest_outputs_and_actions(workspace, job_definition, new_outputs):
     """
-    Update an existing manifest file when finalizing a job.
+    Update the workspace's manifest when finalizing a job.
      - Flags any previous outputs for actions that no longer exist in the workspace
        project.yaml
-     - Removes any previous outputs for the current job's action
+     - Flags any previous outputs for the current job's action that it didn't
+       produce
      - Adds the new outputs from the just completed job
     """
-    # flag any outputs for outdated actions
-    existing_outputs = deepcopy(manifest["outputs"])
-    if existing_outputs:
-        if workspace_action_names := get_workspace_action_names(job_definition):
-            for output, output_metadata in existing_outputs.items():
-                if output_metadata["action"] not in workspace_action_names:
-                    manifest["outputs"][output]["out_of_date_action"] = True
-                else:
-                    # A user could remove an action from a project.yaml and then put it
-                    # back - we don't want actions that reappear to be marked out of
-                    # date forever
-                    manifest["outputs"][output]["out_of_date_action"] = False
-
-    # find existing filenames for this action from previous jobs which are have not
-    # been produced by this just-run job
-    old_outputs_for_action = {
-        filename
-        for filename, output_metadata in manifest["outputs"].items()
-        if output_metadata["action"] == job_definition.action
-        and filename not in new_outputs
-    }
-    # Mark any previous outputs for this action as out-of-date. Previous jobs may have written files
-    # to different paths, e.g. if a job writes dynamic filenames which have changed, or if the output
-    # path is updated so files are now written to a different location.
-    for filename in old_outputs_for_action:
-        manifest["outputs"][filename]["out_of_date_output"] = True
-
-    manifest["outputs"].update(**new_outputs)
+    # do this before taking the workspace lock, as it may need to read the repo
+    workspace_action_names = get_workspace_action_names(job_definition)
+    with open_manifest_store(workspace) as manifest:
+        manifest.update_outputs_and_actions(
+            job_definition.action, new_outputs, workspace_action_names
+        )
 
 
 def get_workspace_action_names(job_definition):
@@ -767,10 +879,15 @@ def get_workspace_action_names(job_definition):
         # Note: we are using the repo url and commit from the job's study here, NOT the repo_url and
         # commit used to run the job itself, as the action could be running can be a reusable action
         # (and using the repo/commit of the reusable action, not the workspace itself.)
-        project_file = read_file_from_repo(
+        pipeline_config = pipeline_cache.get_pipeline(
             job_definition.study.git_repo_url,
             job_definition.study.commit,
-            "project.yaml",
+            functools.partial(
+                read_file_from_repo,
+                job_definition.study.git_repo_url,
+                job_definition.study.commit,
+                "project.yaml",
+            ),
         )
     except GitError:
         # If we get any sort of GitError, we just continue, as we don't want it to prevent
@@ -779,7 +896,6 @@ def get_workspace_action_names(job_definition):
         # for the job and won't be re-fetched.
         return
     else:
-        pipeline_config = load_pipeline(project_file)
         return set(pipeline_config.all_actions)
 
 
@@ -795,10 +911,11 @@ def get_output_metadata(
     user,
     message=None,
     csv_counts=None,
+    content_hash=None,
 ):
     stat = abspath.stat()
-    with abspath.open("rb") as fp:
-        content_hash = file_digest(fp, "sha256").hexdigest()
+    if content_hash is None:
+        content_hash = hash_cache.file_sha256(abspath)
     csv_counts = csv_counts or {}
     return {
         "level": level,
@@ -813,7 +930,8 @@ def get_output_metadata(
         "content_hash": content_hash,
         "excluded": excluded,
         "message": message,
-        "row_count": csv_counts.get("rows"),
+        # we don't know the exact count if we stopped counting at the limit
+        "row_count": None if csv_counts.get("truncated") else csv_counts.get("rows"),
         "col_count": csv_counts.get("cols"),
     }
 
@@ -871,22 +989,21 @@ further assistance.
 """
 
 
-def get_csv_counts(path):
-    csv_counts = {}
-    with path.open() as f:
-        reader = csv.DictReader(f)
-        headers = reader.fieldnames
-        first_row = next(reader, None)
-        if first_row:
-            csv_counts["cols"] = len(first_row)
-            csv_counts["rows"] = sum(1 for _ in reader) + 1
-        else:
-            csv_counts["cols"] = csv_counts["rows"] = 0
+def get_csv_counts(path, max_rows=None):
+    with path.open("rb") as f:
+        return read_csv_counts(f, max_rows)
 
-    return csv_counts, headers
+
+def read_csv_counts(f, max_rows=None):
+    counts = csv_counter.count_csv(f, max_rows)
+    return {
+        "rows": counts.rows,
+        "cols": counts.cols,
+        "truncated": counts.truncated,
+    }, counts.headers
 
 
-def check_l4_file(job_definition, filename, size, workspace_dir):
+def check_l4_file(job_definition, filename, size, workspace_dir, csv_result=None):
     def mb(b):
         return round(b / (1024 * 1024), 2)
 
@@ -917,7 +1034,8 @@ def check_l4_file(job_definition, filename, size, workspace_dir):
         # this may need to be abstracted in future
         actual_file = workspace_dir / filename
         try:
-            csv_counts, headers = get_csv_counts(actual_file)
+            # use the counts from when we copied the file, if we have them
+            csv_counts, headers = csv_result or get_csv_counts(actual_file)
         except Exception:  # pragma: no cover
             pass
         else:
@@ -925,13 +1043,16 @@ def check_l4_file(job_definition, filename, size, workspace_dir):
                 job_msgs.append("File has patient_id column")
                 file_msgs.append(PATIENT_ID.format(filename=filename))
             if csv_counts["rows"] > job_definition.level4_max_csv_rows:
+                row_count = csv_counts["rows"]
+                if csv_counts.get("truncated"):
+                    row_count = f"more than {job_definition.level4_max_csv_rows}"
                 job_msgs.append(
-                    f"File row count ({csv_counts['rows']}) exceeds maximum allowed rows ({job_definition.level4_max_csv_rows})"
+                    f"File row count ({row_count}) exceeds maximum allowed rows ({job_definition.level4_max_csv_rows})"
                 )
                 file_msgs.append(
                     MAX_CSV_ROWS_MSG.format(
                         filename=filename,
-                        row_count=csv_counts["rows"],
+                        row_count=row_count,
                         limit=job_definition.level4_max_csv_rows,
                     )
                 )
@@ -942,12 +1063,12 @@ def check_l4_file(job_definition, filename, size, workspace_dir):
         return True, None, None, csv_counts
 
 
-def find_matching_outputs(job_definition):
+def find_matching_outputs(job_definition, volume_scan):
     """
     Returns a dict mapping output filenames to their privacy level, plus a list
     of any patterns that had no matches at all
     """
-    all_matches = volumes.glob_volume_files(job_definition)
+    all_matches = volume_scan.matches
     unmatched_patterns = []
     outputs = {}
     for pattern, privacy_level in job_definition.output_spec.items():
@@ -959,7 +1080,7 @@ def find_matching_outputs(job_definition):
     return outputs, unmatched_patterns
 
 
-def get_unmatched_outputs(job_definition, outputs):
+def get_unmatched_outputs(volume_scan, outputs):
     """
     Returns all the files created by the job which were *not* matched by any of
     the output patterns.
@@ -973,8 +1094,7 @@ def get_unmatched_outputs(job_definition, outputs):
     debugging info and not for Serious Business Purposes, it should be
     sufficient.
     """
-    all_outputs = volumes.find_newer_files(job_definition, TIMESTAMP_REFERENCE_FILE)
-    return [filename for filename in all_outputs if filename not in outputs]
+    return [filename for filename in volume_scan.new_files if filename not in outputs]
 
 
 def write_log_file(job_definition, job_metadata, filename, excluded):
@@ -1017,6 +1137,16 @@ KEYS_TO_LOG = [
 
 def copy_git_commit_to_volume(job_definition, repo_url, commit, extra_dirs):
     log.info(f"Copying in code from {repo_url}@{commit}")
+    if config.CHECKOUT_CACHE_MAX_SIZE:
+        with checkout_cache.cached_checkout(repo_url, commit) as checkout_dir:
+            volumes.stage_to_volume(job_definition, checkout_dir, ".")
+        # the checkout is shared with other jobs, so we create these directly in
+        # the volume
+        volume = volumes.staging_path(job_definition)
+        for directory in extra_dirs:
+            volume.joinpath(directory).mkdir(parents=True, exist_ok=True)
+        return
+
     # git-archive will create a tarball on stdout and docker cp will accept a
     # tarball on stdin, so if we wanted to we could do this all without a
     # temporary directory, but not worth it at this stage
@@ -1097,6 +1227,16 @@ def read_manifest_file(workspace_dir, workspace):
     }
 
 
+def open_manifest_store(workspace):
+    """Lock and open the workspace's manifest store, which exports to the
+    manifest file in its medium privacy directory"""
+    return manifest_store.open_manifest(
+        get_high_privacy_workspace(workspace) / METADATA_DIR,
+        get_medium_privacy_workspace(workspace) / METADATA_DIR / MANIFEST_FILE,
+        workspace,
+    )
+
+
 def write_manifest_file(workspace_dir, manifest):
     manifest_file = workspace_dir / METADATA_DIR / MANIFEST_FILE
     manifest_file.parent.mkdir(exist_ok=True, parents=True)
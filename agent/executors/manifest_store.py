@@ -0,0 +1,305 @@
+"""
+Incremental store for workspace manifests.
+
+A workspace's `metadata/manifest.json` records every output of every action in
+the workspace. Reading, updating and rewriting the whole file for each finished
+job costs time proportional to the number of outputs in the workspace, which
+can be tens of thousands.
+
+Instead, we keep the manifest in a per-workspace sqlite db, indexed by action,
+and finishing a job only touches the rows for outputs that actually change.
+Each output's metadata is stored already serialised, so exporting
+`manifest.json` is mostly string concatenation, and we only do it if something
+has changed.
+
+The db is the source of truth, but `manifest.json` can still be edited by other
+tools, so if it has changed since we last exported it, we import it again. That
+includes when we still have changes to export, e.g. after an interrupted
+export: we never overwrite an edit we haven't seen, so those changes are lost,
+as they were when we rewrote the file for each job.
+
+All access to a workspace's store is serialised by an exclusive lock on a lock
+file alongside it, so that concurrent finalizes can't lose each other's updates.
+"""
+
+import contextlib
+import fcntl
+import json
+import logging
+import sqlite3
+
+
+STORE_FILE = "manifest.sqlite"
+LOCK_FILE = "manifest.lock"
+
+log = logging.getLogger(__name__)
+
+DDL = """
+CREATE TABLE IF NOT EXISTS outputs (
+    filename TEXT PRIMARY KEY,
+    action TEXT,
+    out_of_date_action INTEGER,
+    out_of_date_output INTEGER,
+    -- serialised and indented ready for export
+    metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS outputs_action ON outputs (action);
+-- manifest keys other than outputs
+CREATE TABLE IF NOT EXISTS manifest (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+@contextlib.contextmanager
+def open_manifest(store_dir, manifest_file, workspace):
+    """Lock the workspace's manifest store and yield it.
+
+    `manifest_file` is exported on exit, if anything has changed.
+    """
+    store_dir.mkdir(parents=True, exist_ok=True)
+    with (store_dir / LOCK_FILE).open("a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        conn = sqlite3.connect(store_dir / STORE_FILE, isolation_level=None)
+        try:
+            conn.executescript(DDL)
+            store = ManifestStore(conn, manifest_file, workspace)
+            store.sync()
+            yield store
+            store.sync()
+        finally:
+            conn.close()
+
+
+class ManifestStore:
+    def __init__(self, conn, manifest_file, workspace):
+        self.conn = conn
+        self.manifest_file = manifest_file
+        self.workspace = workspace
+
+    @contextlib.contextmanager
+    def transaction(self, needs_export=True):
+        """Run a transaction, which will make us export manifest.json if it
+        changes anything and `needs_export` is true"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            changes = self.conn.total_changes
+            yield
+            if needs_export and self.conn.total_changes != changes:
+                self.set_state("export_pending", True)
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        else:
+            self.conn.execute("COMMIT")
+
+    def get_state(self, key, default=None):
+        row = self.conn.execute(
+            "SELECT value FROM state WHERE key = ?", (key,)
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_state(self, key, value):
+        self.conn.execute(
+            """
+            INSERT INTO state (key, value) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+            """,
+            (key, json.dumps(value)),
+        )
+
+    def sync(self):
+        """Export our changes to manifest.json, or import it if it was changed by
+        something else"""
+        # a new store has no signature, and needs importing even if there's no
+        # manifest.json, whose signature would be None
+        if self.get_state("signature", False) != self.manifest_signature():
+            if self.get_state("export_pending"):
+                log.warning(
+                    f"{self.manifest_file} was changed before we could export our"
+                    " changes to it, so importing it instead"
+                )
+            self.import_manifest()
+        elif self.get_state("export_pending"):
+            self.export()
+
+    def manifest_signature(self):
+        try:
+            st = self.manifest_file.stat()
+        except FileNotFoundError:
+            return None
+        return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+    def import_manifest(self):
+        if self.manifest_file.exists():
+            manifest = json.loads(self.manifest_file.read_text())
+        else:
+            manifest = {
+                "workspace": self.workspace,
+                "repo": None,  # old key, no longer needed
+            }
+        outputs = manifest.pop("outputs", {})
+        with self.transaction(needs_export=False):
+            self.conn.execute("DELETE FROM manifest")
+            self.conn.execute("DELETE FROM outputs")
+            self.conn.executemany(
+                "INSERT INTO manifest (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in manifest.items()],
+            )
+            self.conn.executemany(
+                """
+                INSERT INTO outputs (
+                    filename, action, out_of_date_action, out_of_date_output, metadata
+                ) VALUES (?, ?, ?, ?, ?)
+                """,
+                [output_row(filename, meta) for filename, meta in outputs.items()],
+            )
+            self.set_state("signature", self.manifest_signature())
+            # always write a manifest.json, even if it ends up empty
+            self.set_state("export_pending", not self.manifest_file.exists())
+
+    def export(self):
+        """Write manifest.json, formatted as by `json.dumps(manifest, indent=2)`"""
+        items = [
+            f"  {json.dumps(key)}: {indent(json.dumps(json.loads(value), indent=2))}"
+            for key, value in self.conn.execute(
+                "SELECT key, value FROM manifest ORDER BY rowid"
+            )
+        ]
+        outputs = [
+            f"    {json.dumps(filename)}: {metadata}"
+            for filename, metadata in self.conn.execute(
+                "SELECT filename, metadata FROM outputs ORDER BY rowid"
+            )
+        ]
+        if outputs:
+            items.append('  "outputs": {\n' + ",\n".join(outputs) + "\n  }")
+        else:
+            items.append('  "outputs": {}')
+
+        self.manifest_file.parent.mkdir(exist_ok=True, parents=True)
+        tmp = self.manifest_file.with_suffix(".tmp")
+        tmp.write_text("{\n" + ",\n".join(items) + "\n}")
+        tmp.replace(self.manifest_file)
+
+        with self.transaction(needs_export=False):
+            self.set_state("signature", self.manifest_signature())
+            self.set_state("export_pending", False)
+
+    def get_action_outputs(self, action):
+        rows = self.conn.execute(
+            "SELECT filename, metadata FROM outputs WHERE action = ? ORDER BY rowid",
+            (action,),
+        )
+        return {filename: json.loads(metadata) for filename, metadata in rows}
+
+    def get_output(self, filename):
+        row = self.conn.execute(
+            "SELECT metadata FROM outputs WHERE filename = ?", (filename,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_first_output(self):
+        row = self.conn.execute(
+            "SELECT metadata FROM outputs ORDER BY rowid LIMIT 1"
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def add_outputs(self, new_outputs):
+        """Add outputs which aren't already in the manifest, leaving any which
+        are untouched"""
+        with self.transaction():
+            self.conn.executemany(
+                """
+                INSERT INTO outputs (
+                    filename, action, out_of_date_action, out_of_date_output, metadata
+                ) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(filename) DO NOTHING
+                """,
+                [output_row(filename, meta) for filename, meta in new_outputs.items()],
+            )
+
+    def update_outputs_and_actions(self, action, new_outputs, workspace_action_names):
+        """
+        Update the manifest when finalizing a job.
+         - Flags any previous outputs for actions that are not in
+           `workspace_action_names`, if given
+         - Flags any previous outputs for the job's action which the job didn't
+           produce
+         - Adds the new outputs from the job
+        """
+        with self.transaction():
+            if workspace_action_names:
+                self.flag_out_of_date_actions(workspace_action_names)
+
+            # Previous jobs may have written files to different paths, e.g. if a job
+            # writes dynamic filenames which have changed, or if the output path is
+            # updated so files are now written to a different location.
+            for filename, metadata in self.get_action_outputs(action).items():
+                if filename not in new_outputs and not metadata.get(
+                    "out_of_date_output"
+                ):
+                    metadata["out_of_date_output"] = True
+                    self.update_output(filename, metadata)
+
+            for filename, metadata in new_outputs.items():
+                self.update_output(filename, metadata)
+
+    def flag_out_of_date_actions(self, workspace_action_names):
+        # Only the outputs whose flag needs to change. A user could remove an
+        # action from a project.yaml and then put it back, so outputs can become
+        # up to date again.
+        rows = self.conn.execute(
+            """
+            SELECT filename, metadata FROM outputs
+            WHERE out_of_date_action IS NULL
+            OR out_of_date_action != (
+                action NOT IN (SELECT value FROM json_each(?))
+            )
+            """,
+            (json.dumps(sorted(workspace_action_names)),),
+        ).fetchall()
+        for filename, metadata in rows:
+            metadata = json.loads(metadata)
+            metadata["out_of_date_action"] = (
+                metadata.get("action") not in workspace_action_names
+            )
+            self.update_output(filename, metadata)
+
+    def update_output(self, filename, metadata):
+        self.conn.execute(
+            """
+            INSERT INTO outputs (
+                filename, action, out_of_date_action, out_of_date_output, metadata
+            ) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(filename) DO UPDATE SET
+                action = excluded.action,
+                out_of_date_action = excluded.out_of_date_action,
+                out_of_date_output = excluded.out_of_date_output,
+                metadata = excluded.metadata
+            WHERE metadata != excluded.metadata
+            """,
+            output_row(filename, metadata),
+        )
+
+
+def output_row(filename, metadata):
+    return (
+        filename,
+        metadata.get("action"),
+        metadata.get("out_of_date_action"),
+        metadata.get("out_of_date_output"),
+        # at the depth it appears in manifest.json
+        indent(json.dumps(metadata, indent=2), depth=2),
+    )
+
+
+def indent(serialised, depth=1):
+    # JSON strings can't contain literal newlines, so this only affects the
+    # lines of the structure
+    return serialised.replace("\n", "\n" + "  " * depth)
@@ -0,0 +1,83 @@
+"""
+Snapshot of the state of all our jobs' containers and volumes.
+
+Checking a job's status means inspecting its container, and checking for its
+volume and timestamp file, so doing it for every task on every loop costs
+O(tasks) docker calls. Instead, at the start of each loop we list all our
+containers in a single call, and only inspect a container when we first see it
+or its state has changed. Inspect results are kept across loops, as the parts we
+use (whether it's running, and when it started or finished) can't change without
+its state changing too.
+
+A snapshot is only as fresh as the start of the loop, so the executor
+invalidates a job whenever it changes the job's state, after which we check
+its status directly for the rest of the loop.
+"""
+
+from agent.executors import volumes
+from agent.lib import docker
+
+
+class LiveStatus:
+    """Check each part of a job's status directly"""
+
+    def container_inspect(self, name, timeout=None):
+        return docker.container_inspect(name, none_if_not_exists=True, timeout=timeout)
+
+    def volume_exists(self, job):
+        return volumes.volume_exists(job)
+
+    def read_timestamp(self, job, path):
+        return volumes.read_timestamp(job, path, 10)
+
+
+class StatusSnapshot(LiveStatus):
+    """Answer status checks from the state at the time the snapshot was taken"""
+
+    def __init__(self, containers, volume_ids, inspected=None):
+        # name -> (id, state)
+        self.containers = containers
+        self.volume_ids = volume_ids
+        # name -> ((id, state), inspect output)
+        self.inspected = inspected or {}
+        self.timestamps = {}
+        self.invalidated = set()
+
+    @classmethod
+    def take(cls, label, previous=None, timeout=None):
+        containers = docker.container_states(label, timeout=timeout)
+        inspected = {}
+        if previous:
+            # forget containers which have gone
+            inspected = {
+                name: value
+                for name, value in previous.inspected.items()
+                if name in containers
+            }
+        return cls(containers, volumes.list_volumes(), inspected)
+
+    def invalidate(self, job_id):
+        self.invalidated.add(job_id)
+
+    def is_valid(self, job_id):
+        return job_id not in self.invalidated
+
+    def container_inspect(self, name, timeout=None):
+        key = self.containers.get(name)
+        if key is None:
+            return {}
+        cached = self.inspected.get(name)
+        if cached is None or cached[0] != key:
+            cached = (key, super().container_inspect(name, timeout=timeout))
+            self.inspected[name] = cached
+        return cached[1]
+
+    def volume_exists(self, job):
+        return job.id in self.volume_ids
+
+    def read_timestamp(self, job, path):
+        if job.id not in self.volume_ids:
+            return None
+        if (job.id, path) not in self.timestamps:
+            self.timestamps[(job.id, path)] = super().read_timestamp(job, path)
+        return self.timestamps[(job.id, path)]
@@ -1,7 +1,17 @@
+import errno
+import fcntl
+import hashlib
+import io
 import logging
+import os
+import re
+import secrets
 import shutil
+import subprocess
+import threading
 import time
 from collections import defaultdict
+from dataclasses import dataclass
 from pathlib import Path
 
 from agent import config
@@ -25,6 +35,148 @@ def copy_file(source, dest, follow_symlinks=True):
     return dest.stat().st_size
 
 
+COPY_BUFFER_SIZE = 2**20
+
+# ioctl to make dest share src's data blocks, copy-on-write, on filesystems that
+# support it (e.g. btrfs, xfs). See ioctl_ficlone(2).
+FICLONE = 0x40049409
+
+# Ways of staging a file into a volume, in order of preference. Reflinks and
+# hardlinks don't copy any data at all; copy_file_range at least keeps the copy
+# in the kernel, and can be offloaded by some filesystems.
+STAGING_STRATEGIES = ("reflink", "hardlink", "copy_file_range")
+
+# The strategies which aren't supported for each (source device, dest device) pair,
+# so we don't keep retrying them for every file on that pair of filesystems
+_unsupported_strategies = defaultdict(set)
+
+# Errors which mean a strategy isn't supported at all between two filesystems.
+# Anything else (e.g. too many links to a file, or no space left) may only affect
+# the file we were staging.
+UNSUPPORTED_ERRNOS = {errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOSYS}
+
+# Total bytes and seconds spent actually copying data, used to estimate how long
+# the files we didn't copy would have taken
+_copy_throughput = {"bytes": 0, "seconds": 0.0}
+
+# Files are staged from several threads at once (e.g. the prepare stage workers
+# and the output copying pool), so updates to the above must hold this lock
+_staging_lock = threading.Lock()
+
+
+def reflink_file(source, dest):
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copymode(source, dest)
+
+
+def copy_file_range(source, dest):
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        while os.copy_file_range(src.fileno(), dst.fileno(), 2**30):
+            pass
+    shutil.copymode(source, dest)
+
+
+class StagingStats:
+    """Accumulates what staging files into a volume did, for tracing"""
+
+    def __init__(self):
+        self.files = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self.seconds = defaultdict(float)
+
+    def add(self, strategy, size, seconds):
+        self.files[strategy] += 1
+        self.bytes[strategy] += size
+        self.seconds[strategy] += seconds
+
+    @property
+    def bytes_saved(self):
+        return self.bytes["reflink"] + self.bytes["hardlink"]
+
+    @property
+    def seconds_saved(self):
+        """Estimate how long copying the reflinked and hardlinked files would have
+        taken, based on how fast we have copied files before. None if we've not
+        copied anything yet."""
+        with _staging_lock:
+            copied_bytes = _copy_throughput["bytes"]
+            copied_seconds = _copy_throughput["seconds"]
+        if not copied_bytes:
+            return None
+        seconds_per_byte = copied_seconds / copied_bytes
+        linking_seconds = self.seconds["reflink"] + self.seconds["hardlink"]
+        return max(0.0, self.bytes_saved * seconds_per_byte - linking_seconds)
+
+    def span_attributes(self, prefix):
+        attributes = {f"{prefix}.bytes_saved": self.bytes_saved}
+        if self.seconds_saved is not None:
+            attributes[f"{prefix}.seconds_saved"] = self.seconds_saved
+        for strategy, count in self.files.items():
+            attributes[f"{prefix}.{strategy}.files"] = count
+            attributes[f"{prefix}.{strategy}.bytes"] = self.bytes[strategy]
+        return attributes
+
+
+def stage_file(source, dest, stats=None, read_only_dest=False):
+    """Atomically populate dest from source, copying as little data as we can.
+
+    We use the first of STAGING_STRATEGIES which works for this pair of
+    filesystems. A hardlink shares the file itself, so is only used for
+    `read_only_dest`, destinations which are never written through, such as the
+    lower layer of an overlay volume. Anywhere else, a job owns the files in its
+    volume, so could modify the original through a hardlink, whatever its
+    permissions.
+
+    Returns the strategy used.
+    """
+    source = Path(source)
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    devices = (source.stat().st_dev, dest.parent.stat().st_dev)
+    with _staging_lock:
+        unsupported = set(_unsupported_strategies[devices])
+    size = source.stat().st_size
+
+    start = time.monotonic()
+    with atomic_writer(dest) as tmp:
+        for strategy in STAGING_STRATEGIES:
+            if strategy in unsupported:
+                continue
+            if strategy == "hardlink" and not read_only_dest:
+                continue
+            try:
+                match strategy:
+                    case "reflink":
+                        reflink_file(source, tmp)
+                    case "hardlink":
+                        os.link(source, tmp)
+                    case "copy_file_range":
+                        copy_file_range(source, tmp)
+                    case _:
+                        assert False, f"Unknown staging strategy {strategy}"
+            except OSError as exc:
+                logger.debug(f"Cannot {strategy} {source} to {dest}: {exc}")
+                if exc.errno in UNSUPPORTED_ERRNOS:
+                    with _staging_lock:
+                        _unsupported_strategies[devices].add(strategy)
+                tmp.unlink(missing_ok=True)
+            else:
+                break
+        else:
+            strategy = "copy"
+            shutil.copy(source, tmp)
+
+    seconds = time.monotonic() - start
+    if strategy in ("copy_file_range", "copy"):
+        with _staging_lock:
+            _copy_throughput["bytes"] += size
+            _copy_throughput["seconds"] += seconds
+    if stats is not None:
+        stats.add(strategy, size, seconds)
+    return strategy
+
+
 def host_volume_path(job, create=True):
     path = config.HIGH_PRIVACY_VOLUME_DIR / job.id
     if create:
@@ -35,6 +187,51 @@ def host_volume_path(job, create=True):
     return path
 
 
+def use_overlay():
+    return config.VOLUME_BACKEND == "overlay"
+
+
+def volume_layers_path(job):
+    """The directory holding the layers of an overlay volume"""
+    return config.HIGH_PRIVACY_VOLUME_DIR / ".layers" / job.id
+
+
+def staging_path(job):
+    """Where the code and inputs for a job are staged before it runs.
+
+    For overlay volumes, this is the lower layer, which the job can never modify.
+    """
+    if use_overlay():
+        return volume_layers_path(job) / "lower"
+    return host_volume_path(job)
+
+
+def output_path(job):
+    """Where to look for the files a job has created or modified.
+
+    For overlay volumes, these are exactly the files in the upper layer.
+    """
+    if use_overlay():
+        return volume_layers_path(job) / "upper"
+    return host_volume_path(job)
+
+
+def volume_file_path(job, path):
+    """The path on the host to read `path` in the job's volume from.
+
+    Overlay volumes aren't mounted again after the agent or host restarts, so
+    rather than reading through the merged view, we find the file in its layers:
+    anything written since the volume was mounted is in the upper layer, and
+    everything else was staged in the lower one.
+    """
+    if not use_overlay():
+        return host_volume_path(job) / path
+    upper = output_path(job) / path
+    if os.path.lexists(upper):
+        return upper
+    return staging_path(job) / path
+
+
 volume_type = "bind"  # https://docs.docker.com/engine/storage/bind-mounts/
 
 
@@ -62,15 +259,58 @@ def create_volume(job, labels=None):
     re-copy all the files in that case.
     """
     host_volume_path(job).mkdir(exist_ok=True)
+    if use_overlay():
+        # we must not modify the lower layer of a mounted overlay
+        unmount_volume(job)
+        for layer in ("lower", "upper", "work"):
+            (volume_layers_path(job) / layer).mkdir(parents=True, exist_ok=True)
+
+
+def mount_volume(job):
+    """Mount an overlay volume, once its lower layer has been staged.
+
+    The job's volume directory becomes the merged view of the staged code and
+    inputs with an empty upper layer, so nothing needs copying and any files the
+    job writes end up in the upper layer. Does nothing for bind volumes, or if
+    it's already mounted, so it can be called again to remount a volume after a
+    restart.
+    """
+    if not use_overlay():
+        return
+    path = host_volume_path(job)
+    if os.path.ismount(path):
+        return
+    layers = volume_layers_path(job)
+    options = (
+        f"lowerdir={layers / 'lower'},upperdir={layers / 'upper'},"
+        f"workdir={layers / 'work'}"
+    )
+    subprocess.run(
+        ["mount", "-t", "overlay", "overlay", "-o", options, str(path)], check=True
+    )
+
+
+def unmount_volume(job):
+    path = host_volume_path(job)
+    if os.path.ismount(path):
+        subprocess.run(["umount", str(path)], check=True)
 
 
 def volume_exists(job):
     return host_volume_path(job, create=False).exists()
 
 
+def list_volumes():
+    """Return the ids of all the jobs which have volumes"""
+    try:
+        return {entry.name for entry in os.scandir(config.HIGH_PRIVACY_VOLUME_DIR)}
+    except FileNotFoundError:
+        return set()
+
+
 def copy_to_volume(job, src, dst, timeout=None):
     # We don't respect the timeout.
-    volume = host_volume_path(job)
+    volume = staging_path(job)
     if src.is_dir():
         shutil.copytree(
             src,
@@ -83,20 +323,124 @@ def copy_to_volume(job, src, dst, timeout=None):
         copy_file(src, volume / dst)
 
 
+def stage_to_volume(job, src, dst, stats=None):
+    """Populate dst in the volume from src, a file or directory, using stage_file"""
+    volume = staging_path(job)
+    read_only_dest = use_overlay()
+    if src.is_dir():
+        shutil.copytree(
+            src,
+            volume / dst,
+            symlinks=True,
+            copy_function=lambda s, d: stage_file(s, d, stats, read_only_dest),
+            dirs_exist_ok=True,
+        )
+    else:
+        stage_file(src, volume / dst, stats, read_only_dest)
+
+
+class TeeReader(io.RawIOBase):
+    """A readable stream which writes everything read from `src` to `dst`, and
+    adds it to `digest`"""
+
+    def __init__(self, src, dst, digest):
+        self.src = src
+        self.dst = dst
+        self.digest = digest
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self.src.readinto(buffer)
+        if size:
+            data = memoryview(buffer)[:size]
+            self.dst.write(data)
+            self.digest.update(data)
+        return size
+
+
+@dataclass
+class CopiedFile:
+    size: int
+    sha256: str
+    # whatever read_stream returned, if it was called
+    read_result: object = None
+
+
+def copy_and_hash(source, dest, read_stream=None, max_read_size=None):
+    """Atomically copy source to dest, computing its sha256 as we go.
+
+    If `read_stream` is given, it is called with the file's contents as a binary
+    stream, so that it can be parsed in the same pass, unless the file is bigger
+    than `max_read_size`. Any error from `read_stream` is logged and ignored.
+    """
+    source = Path(source)
+    dest = Path(dest)
+    size = source.stat().st_size
+    digest = hashlib.sha256()
+    read_result = None
+    with atomic_writer(dest) as tmp:
+        with source.open("rb") as src, tmp.open("wb") as dst:
+            tee = TeeReader(src, dst, digest)
+            if read_stream and (max_read_size is None or size <= max_read_size):
+                stream = io.BufferedReader(tee, COPY_BUFFER_SIZE)
+                try:
+                    read_result = read_stream(stream)
+                except Exception:
+                    logger.exception(f"Failed to read {source}")
+            # copy whatever hasn't been read yet
+            buffer = bytearray(COPY_BUFFER_SIZE)
+            while tee.readinto(buffer):
+                pass
+        shutil.copymode(source, tmp)
+
+    return CopiedFile(size, digest.hexdigest(), read_result)
+
+
+def copy_and_hash_from_volume(job, src, dst, read_stream=None, max_read_size=None):
+    path = volume_file_path(job, src)
+    return copy_and_hash(path, dst, read_stream, max_read_size)
+
+
 def copy_from_volume(job, src, dst, timeout=None):
     # this is only used to copy final outputs/logs.
-    path = host_volume_path(job) / src
+    path = volume_file_path(job, src)
     return copy_file(path, dst)
 
 
 def delete_volume(job):
+    if use_overlay():
+        unmount_volume(job)
+        remove_directory(host_volume_path(job))
+        remove_directory(volume_layers_path(job))
+    else:
+        remove_directory(host_volume_path(job))
+
+
+def trash_volume(job, trash_dir):
+    """Move the job's volume into `trash_dir`, to be deleted later.
+
+    This is a rename on the same filesystem, so is atomic and quick however large
+    the volume is.
+    """
+    unmount_volume(job)
+    paths = [host_volume_path(job)]
+    if use_overlay():
+        paths.append(volume_layers_path(job))
+    trash_dir.mkdir(parents=True, exist_ok=True)
+    for path in paths:
+        if path.exists():
+            path.rename(trash_dir / f"{job.id}-{secrets.token_hex(8)}")
+
+
+def remove_directory(path):
     failed_files = {}
 
     # if we logged each file error directly, it would spam the logs, so we collect them
     def onerror(function, path, excinfo):
         failed_files[Path(path)] = str(excinfo[1])
 
-    path = host_volume_path(job)
     try:
         shutil.rmtree(str(path), onerror=onerror)
 
@@ -114,7 +458,7 @@ def write_timestamp(job, path, timeout=None):
 
 
 def read_timestamp(job, path, timeout=None):
-    abs_path = host_volume_path(job) / path
+    abs_path = volume_file_path(job, path)
     if not abs_path.exists():
         return None
     try:
@@ -131,25 +475,111 @@ def read_timestamp(job, path, timeout=None):
         return None
 
 
-def glob_volume_files(job):
-    volume = host_volume_path(job)
+def compile_output_pattern(pattern):
+    """Compile an output pattern into a regex matching relative file paths.
 
-    found = defaultdict(list)
+    This follows the semantics of `Path.glob()`: `*`, `?` and `[...]` match
+    within a single path component (including hidden files), and a `**`
+    component matches zero or more directories.
+    """
+    parts = pattern.split("/")
+    regex = ""
+    for part in parts[:-1]:
+        if part == "**":
+            regex += "(?:.+/)?"
+        else:
+            regex += translate_glob_component(part) + "/"
+    if parts[-1] == "**":
+        # this only matches directories, never files
+        regex += "(?!)"
+    else:
+        regex += translate_glob_component(parts[-1])
+    return re.compile(regex, re.DOTALL)
+
+
+def translate_glob_component(part):
+    regex = ""
+    i = 0
+    while i < len(part):
+        char = part[i]
+        i += 1
+        if char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[":
+            # a "]" straight after the "[" or "[!" is part of the set
+            start = i + 1 if part[i : i + 1] == "!" else i
+            start = start + 1 if part[start : start + 1] == "]" else start
+            end = part.find("]", start)
+            if end == -1:
+                regex += re.escape(char)
+            else:
+                chars = part[i:end].replace("\\", "\\\\")
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                elif chars.startswith("^"):
+                    chars = "\\" + chars
+                # a negated set mustn't match the separator either
+                regex += f"(?!/)[{chars}]"
+                i = end + 1
+        else:
+            regex += re.escape(char)
+    return regex
+
+
+@dataclass
+class VolumeScan:
+    # output pattern -> the relative paths of the files it matches
+    matches: dict
+    # relative paths of the files created or modified by the job
+    new_files: list
+
+
+def scan_volume(job, reference=None):
+    """Find the job's outputs in a single walk of its volume.
+
+    Every file is matched against all the job's output patterns, and checked
+    against the mtime of the `reference` file, which was written just before the
+    job started. For overlay volumes, we walk only the upper layer, and all its
+    files are new.
+    """
+    volume = output_path(job)
+    patterns = [
+        (pattern, compile_output_pattern(pattern)) for pattern in job.output_spec
+    ]
+    if reference is None or use_overlay():
+        ref_time = None
+    else:
+        ref_time = (volume / reference).stat().st_mtime
+
+    matches = defaultdict(list)
+    new_files = []
+    directories = [(volume, "")]
+    while directories:
+        directory, prefix = directories.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                name = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append((entry.path, name + "/"))
+                    continue
+                if not entry.is_file():
+                    continue
+                for pattern, regex in patterns:
+                    if regex.fullmatch(name):
+                        matches[pattern].append(name)
+                if name == reference:
+                    continue
+                if ref_time is None or entry.stat().st_mtime > ref_time:
+                    new_files.append(name)
+
+    return VolumeScan(matches, new_files)
 
-    for pattern in job.output_spec.keys():
-        for match in volume.glob(pattern):
-            if match.is_file():
-                found[pattern].append(str(match.relative_to(volume)))
 
-    return found
+def glob_volume_files(job):
+    return scan_volume(job).matches
 
 
 def find_newer_files(job, reference):
-    volume = host_volume_path(job)
-    ref_time = (volume / reference).stat().st_mtime
-    found = []
-    for f in volume.glob("**/*"):
-        if f.is_file() and f.stat().st_mtime > ref_time:
-            found.append(str(f.relative_to(volume)))
-
-    return found
+    return scan_volume(job, reference).new_files
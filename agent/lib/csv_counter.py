@@ -0,0 +1,157 @@
+"""
+Fast row and column counts for CSV files.
+
+Parsing every record with the csv module just to count them is slow for large
+files. Instead, we parse only the header and first row with the csv module, and
+count the remaining records by scanning the raw bytes for line endings, taking
+care to ignore those inside quoted fields. We do this a chunk at a time: any
+quoted fields are replaced with a placeholder using a regex, and then the line
+endings can be counted with a single `bytes.count`.
+
+The counts match those from `csv.DictReader` on the file opened in universal
+newlines mode: blank lines are not counted, and a quote only starts a quoted
+field at the start of a field.
+"""
+
+import csv
+import io
+import re
+from dataclasses import dataclass
+
+
+CHUNK_SIZE = 2**20
+
+QUOTE = b'"'
+# A quoted field, which can contain line endings and escaped quotes. A quote
+# only starts a quoted field at the start of a field, which the lookbehind
+# checks; it comes after the quote, so that the regex can search for the quote
+# quickly. If the field isn't closed, it runs to the end of the chunk. The
+# quantifiers are possessive so that we never backtrack and treat the first of a
+# pair of escaped quotes as the closing quote.
+QUOTED_FIELD = re.compile(rb'"(?<![^,\r\n]")(?:[^"]++|"")*+(?:"|\Z)')
+# The rest of a quoted field continued from a previous chunk
+QUOTED_FIELD_END = re.compile(rb'(?:[^"]++|"")*+"')
+# A line ending at the start of a chunk or after another line ending
+BLANK_LINE = re.compile(rb"(?<![^\n])\n")
+# replaces quoted fields, so that we can count the remaining line endings
+PLACEHOLDER = b"_"
+
+
+@dataclass
+class CsvCounts:
+    headers: list | None
+    rows: int
+    cols: int
+    # True if we stopped counting once there were more than `max_rows` rows, so
+    # `rows` is a lower bound
+    truncated: bool = False
+
+
+class RecordCounter:
+    """Count the non-blank CSV records in a stream of chunks.
+
+    Each chunk fed to the counter, apart from the last, must end with a line
+    ending, so that we never need to look across chunks for an escaped quote or
+    a "\\r\\n" pair.
+    """
+
+    def __init__(self):
+        self.records = 0
+        # whether the last chunk ended inside a quoted field
+        self.in_quotes = False
+
+    def feed(self, chunk):
+        if not chunk:
+            return
+        if self.in_quotes:
+            match = QUOTED_FIELD_END.match(chunk)
+            if not match:
+                # the whole chunk is inside the quoted field
+                return
+            chunk = PLACEHOLDER + chunk[match.end() :]
+        if QUOTE in chunk:
+            chunk = QUOTED_FIELD.sub(PLACEHOLDER, chunk)
+        if b"\r" in chunk:
+            chunk = chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+        records = chunk.count(b"\n")
+        if chunk.startswith(b"\n") or b"\n\n" in chunk:
+            records -= len(BLANK_LINE.findall(chunk))
+        self.records += records
+        # Chunks always end with a line ending, unless the last line ending was
+        # swallowed by an unclosed quoted field, or this is the end of the file.
+        # Either way, the current record has content that hasn't been counted.
+        self.in_quotes = not chunk.endswith(b"\n")
+
+    def finish(self):
+        """Count any final record without a line ending"""
+        if self.in_quotes:
+            self.records += 1
+            self.in_quotes = False
+
+
+def count_csv(f, max_rows=None, chunk_size=CHUNK_SIZE):
+    """Count the rows and columns of the CSV in binary stream `f`.
+
+    If `max_rows` is given, stop counting as soon as there are more rows than
+    that, and return a truncated count.
+    """
+    counter = RecordCounter()
+    # the start of the file, until it contains the header and first row
+    prefix = bytearray()
+    headers = first_row = None
+    parsed_prefix = False
+    remainder = b""
+    truncated = False
+
+    while data := f.read(chunk_size):
+        data = remainder + data
+        # split after the last line ending; a trailing "\r" could be followed by
+        # a "\n" in the next read, so don't split there
+        end = max(data.rfind(b"\n"), data.rfind(b"\r", 0, len(data) - 1)) + 1
+        chunk, remainder = data[:end], data[end:]
+        counter.feed(chunk)
+
+        if not parsed_prefix:
+            prefix += chunk
+            if counter.records >= 2:
+                headers, first_row = parse_prefix(prefix)
+                parsed_prefix = True
+
+        if (
+            parsed_prefix
+            and max_rows is not None
+            and data_rows(counter, headers) > max_rows
+        ):
+            truncated = bool(remainder or f.read(1))
+            break
+
+    if not truncated:
+        counter.feed(remainder)
+        counter.finish()
+        if not parsed_prefix:
+            headers, first_row = parse_prefix(prefix + remainder)
+
+    if first_row is None:
+        return CsvCounts(headers=headers, rows=0, cols=0)
+
+    return CsvCounts(
+        headers=headers,
+        rows=data_rows(counter, headers),
+        cols=len(first_row),
+        truncated=truncated,
+    )
+
+
+def data_rows(counter, headers):
+    # DictReader takes the first line as the header even if it's blank, in which
+    # case it wasn't counted as a record
+    return counter.records - 1 if headers else counter.records
+
+
+def parse_prefix(prefix):
+    """Parse the header and first row from the start of a CSV file"""
+    text = io.TextIOWrapper(io.BytesIO(prefix), encoding="utf-8")
+    reader = csv.DictReader(text)
+    headers = reader.fieldnames
+    return headers, next(reader, None)
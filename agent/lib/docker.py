@@ -11,6 +11,7 @@ import time
 import urllib.parse
 
 from agent import config
+from agent.lib import docker_api
 from common import config as common_config
 
 
@@ -81,6 +82,39 @@ def docker(docker_args, timeout=DEFAULT_TIMEOUT, **kwargs):
             raise
 
 
+def api(method, path, statuses, params=None, timeout=None):
+    """
+    Make a request to the Docker Engine API, and return its status and body.
+
+    Returns None if the daemon isn't available over its socket, or the response
+    status isn't one of `statuses`, in which case the caller falls back to the
+    docker CLI, which reports any errors as it always has.
+    """
+    try:
+        status, body = docker_api.request(
+            method, path, params=params, timeout=timeout or DEFAULT_TIMEOUT
+        )
+    except docker_api.DockerAPIUnavailable:
+        return None
+    except TimeoutError as e:
+        raise DockerTimeoutError(f"{method} {path} timeout") from e
+    if status not in statuses:
+        logger.debug(f"Unexpected {status} response to {method} {path}: {body!r}")
+        return None
+    return status, body
+
+
+def inspect_key(metadata, key):
+    """Look up a dotted path in inspect output, as `--format {{json .Key}}` would"""
+    for name in filter(None, key.split(".")):
+        if metadata is None:
+            break
+        # template keys are Go field names, which match the JSON keys apart from
+        # the container's ID
+        metadata = metadata.get("Id" if name == "ID" else name)
+    return metadata
+
+
 def container_exists(name):
     return bool(container_inspect(name, "ID", none_if_not_exists=True))
 
@@ -94,6 +128,18 @@ def container_inspect(name, key="", none_if_not_exists=False, timeout=None):
 
     See: https://docs.docker.com/engine/reference/commandline/inspect/
     """
+    response = api(
+        "GET",
+        f"/containers/{name}/json",
+        (200, 404) if none_if_not_exists else (200,),
+        timeout=timeout,
+    )
+    if response is not None:
+        status, body = response
+        if status == 404:
+            return {}
+        return inspect_key(json.loads(body), key)
+
     try:
         response = docker(
             ["container", "inspect", "--format", f"{{{{json .{key}}}}}", name],
@@ -115,7 +161,86 @@ def container_inspect(name, key="", none_if_not_exists=False, timeout=None):
     return json.loads(response.stdout)
 
 
+def container_states(label, timeout=None):
+    """
+    Returns the id and state (e.g. "running", "exited") of every container with
+    `label`, by name, from a single listing of containers.
+    """
+    response = api(
+        "GET",
+        "/containers/json",
+        (200,),
+        params={"all": "1", "filters": json.dumps({"label": [label]})},
+        timeout=timeout,
+    )
+    if response is not None:
+        _, body = response
+        return {
+            name.lstrip("/"): (container["Id"], container["State"])
+            for container in json.loads(body)
+            for name in container["Names"]
+        }
+
+    ps = docker(
+        [
+            "container",
+            "ls",
+            "--all",
+            "--no-trunc",
+            "--filter",
+            f"label={label}",
+            "--format",
+            "{{json .}}",
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+        timeout=timeout,
+    )
+    containers = [json.loads(line) for line in ps.stdout.splitlines()]
+    return {
+        name: (container["ID"], container["State"])
+        for container in containers
+        for name in container["Names"].split(",")
+    }
+
+
+def container_events(label, actions):
+    """
+    Yields events as they happen, for the given `actions` (e.g. "die") of
+    containers with `label`, until the daemon ends the stream.
+
+    See: https://docs.docker.com/reference/cli/docker/system/events/
+    """
+    filters = {"type": ["container"], "label": [label], "event": actions}
+    try:
+        with docker_api.stream(
+            "GET", "/events", params={"filters": json.dumps(filters)}
+        ) as response:
+            for line in response:
+                yield json.loads(line)
+        return
+    except docker_api.DockerAPIUnavailable:
+        pass
+
+    args = ["docker", "events", "--format", "{{json .}}"]
+    for name, values in filters.items():
+        for value in values:
+            args.extend(["--filter", f"{name}={value}"])
+    with subprocess.Popen(args, stdout=subprocess.PIPE, text=True) as ps:
+        try:
+            for line in ps.stdout:
+                yield json.loads(line)
+        finally:
+            ps.kill()
+
+
 def image_inspect(image_ref):
+    response = api("GET", f"/images/{image_ref}/json", (200, 404))
+    if response is not None:
+        status, body = response
+        return json.loads(body) if status == 200 else {}
+
     ps = docker(
         ["image", "inspect", "--format", "{{json .}}", image_ref],
         capture_output=True,
@@ -177,6 +302,11 @@ def run(
 
 
 def image_exists_locally(image_name_and_version):
+    response = api("GET", f"/images/{image_name_and_version}/json", (200, 404))
+    if response is not None:
+        status, _ = response
+        return status == 200
+
     try:
         docker(
             ["image", "inspect", "--format", "ok", image_name_and_version],
@@ -191,6 +321,10 @@ def image_exists_locally(image_name_and_version):
 
 
 def delete_container(name):
+    # Ignore error if container has already been removed
+    if api("DELETE", f"/containers/{name}", (204, 404), params={"force": "1"}):
+        return
+
     try:
         docker(
             ["container", "rm", "--force", name],
@@ -204,6 +338,10 @@ def delete_container(name):
 
 
 def kill(name):
+    # Ignore error if container has already been killed or removed
+    if api("POST", f"/containers/{name}/kill", (204, 404, 409)):
+        return
+
     try:
         docker(
             ["container", "kill", name],
@@ -0,0 +1,120 @@
+"""
+Minimal client for the Docker Engine API, over the daemon's unix socket.
+
+Every call to the docker CLI costs a fork and exec of the CLI, which then has to
+start up and connect to the daemon itself. The agent inspects the container of
+each running job several times per loop, so for the calls we make most often we
+talk to the daemon directly instead, keeping a connection alive per thread.
+
+See: https://docs.docker.com/reference/api/engine/
+"""
+
+import contextlib
+import http.client
+import socket
+import threading
+import urllib.parse
+
+from agent import config
+
+
+class DockerAPIUnavailable(Exception):
+    """We couldn't talk to the daemon over its socket"""
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path):
+        super().__init__("localhost", timeout=None)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+        except BaseException:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+CONNECTIONS = threading.local()
+
+
+def get_connection():
+    if not config.DOCKER_API_SOCKET:
+        raise DockerAPIUnavailable("DOCKER_API_SOCKET is not set")
+    conn = getattr(CONNECTIONS, "conn", None)
+    if conn is None or conn.socket_path != config.DOCKER_API_SOCKET:
+        conn = CONNECTIONS.conn = UnixHTTPConnection(config.DOCKER_API_SOCKET)
+    return conn
+
+
+def request(method, path, params=None, timeout=None):
+    """
+    Make a request to the daemon and return the response status and body.
+
+    Raises DockerAPIUnavailable if we can't connect to the daemon, and
+    TimeoutError if it takes longer than `timeout` seconds to respond.
+    """
+    url = build_url(path, params)
+
+    while True:
+        conn = get_connection()
+        reused = conn.sock is not None
+        conn.timeout = timeout
+        if reused:
+            conn.sock.settimeout(timeout)
+        try:
+            conn.request(method, url)
+            response = conn.getresponse()
+            # we must read all of the response to reuse the connection
+            return response.status, response.read()
+        except TimeoutError:
+            conn.close()
+            raise
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            # the daemon may have closed our idle connection, in which case we
+            # try once more with a new one
+            if not reused:
+                raise DockerAPIUnavailable(
+                    f"{method} {path} to {config.DOCKER_API_SOCKET} failed: {e!r}"
+                ) from e
+
+
+@contextlib.contextmanager
+def stream(method, path, params=None):
+    """
+    Make a request to the daemon on a connection of its own, and yield the
+    response for the caller to read as it arrives.
+
+    Raises DockerAPIUnavailable if we can't connect to the daemon, or it doesn't
+    respond with a 200.
+    """
+    if not config.DOCKER_API_SOCKET:
+        raise DockerAPIUnavailable("DOCKER_API_SOCKET is not set")
+
+    conn = UnixHTTPConnection(config.DOCKER_API_SOCKET)
+    try:
+        try:
+            conn.request(method, build_url(path, params))
+            response = conn.getresponse()
+        except (OSError, http.client.HTTPException) as e:
+            raise DockerAPIUnavailable(
+                f"{method} {path} to {config.DOCKER_API_SOCKET} failed: {e!r}"
+            ) from e
+        if response.status != 200:
+            raise DockerAPIUnavailable(
+                f"{method} {path} failed with status {response.status}"
+            )
+        yield response
+    finally:
+        conn.close()
+
+
+def build_url(path, params=None):
+    url = urllib.parse.quote(path, safe="/:@")
+    if params:
+        url += "?" + urllib.parse.urlencode(params)
+    return url
@@ -0,0 +1,123 @@
+"""
+Persistent cache of file content hashes.
+
+Hashing large outputs is expensive, and the same files get hashed repeatedly,
+e.g. by the manifest CLIs. We cache each file's sha256 in a sqlite db, keyed on
+its stat identity: device and inode, plus size, mtime and ctime. Rewriting a
+file in place changes its mtime and ctime, so invalidates the entry. Including
+the ctime means we still notice a rewrite if the mtime is then set back, as
+tools like `touch -d` or `rsync -t` do, because the ctime can't be set.
+
+A file rewritten within the same timestamp tick as it was hashed could keep
+the same stat identity, so we don't cache hashes of files that were changed
+very recently. This is the same trick git uses for its index.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from agent import config
+from common.lib import file_digest
+
+
+log = logging.getLogger(__name__)
+
+DDL = """
+CREATE TABLE IF NOT EXISTS hashes (
+    device INTEGER,
+    inode INTEGER,
+    size INTEGER,
+    mtime_ns INTEGER,
+    ctime_ns INTEGER,
+    sha256 TEXT,
+    PRIMARY KEY (device, inode)
+)
+"""
+
+# Comfortably more than the timestamp granularity of any filesystem we use
+RACY_WINDOW_NS = 2 * 10**9
+
+CONNECTION_CACHE = threading.local()
+
+
+def get_connection():
+    db_file = config.HASH_CACHE_FILE
+    assert isinstance(db_file, Path), "config.HASH_CACHE_FILE db must be file path"
+
+    cache = CONNECTION_CACHE.__dict__
+    if db_file not in cache:
+        conn = sqlite3.connect(db_file)
+        # manual transactions
+        conn.isolation_level = None
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(DDL)
+        cache[db_file] = conn
+
+    return cache[db_file]
+
+
+def file_sha256(path):
+    """Return the hex sha256 of the file at `path`, using the cache if we can"""
+    key = stat_key(os.stat(path))
+    try:
+        content_hash = lookup(key)
+    except sqlite3.Error:
+        log.exception("Failed to read hash cache")
+        content_hash = None
+    if content_hash is not None:
+        return content_hash
+
+    with open(path, "rb") as f:
+        content_hash = file_digest(f, "sha256").hexdigest()
+
+    # only cache it if the file didn't change while we were hashing it
+    if stat_key(os.stat(path)) == key and not is_racy(key):
+        try:
+            store(key, content_hash)
+        except sqlite3.Error:
+            log.exception("Failed to update hash cache")
+    return content_hash
+
+
+def stat_key(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+def is_racy(key):
+    """Was the file changed too recently for a rewrite to change its key?"""
+    _, _, _, mtime_ns, ctime_ns = key
+    return time.time_ns() - max(mtime_ns, ctime_ns) < RACY_WINDOW_NS
+
+
+def lookup(key):
+    row = (
+        get_connection()
+        .execute(
+            """
+            SELECT sha256 FROM hashes
+            WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ? AND ctime_ns = ?
+            """,
+            key,
+        )
+        .fetchone()
+    )
+    return row[0] if row else None
+
+
+def store(key, content_hash):
+    get_connection().execute(
+        """
+        INSERT INTO hashes (device, inode, size, mtime_ns, ctime_ns, sha256)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(device, inode) DO UPDATE SET
+            size = excluded.size,
+            mtime_ns = excluded.mtime_ns,
+            ctime_ns = excluded.ctime_ns,
+            sha256 = excluded.sha256
+        """,
+        (*key, content_hash),
+    )
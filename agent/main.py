@@ -1,11 +1,12 @@
+import functools
 import logging
 import sys
-import time
+import threading
 import traceback
 
 from opentelemetry import trace
 
-from agent import config, task_api, tracing
+from agent import config, prefetch, task_api, tracing
 from agent.executors import get_executor_api
 from agent.lib.docker import (
     docker,
@@ -13,6 +14,7 @@ from agent.lib.docker import (
     get_network_config_args,
     get_proxy_image_sha,
 )
+from agent.pipeline import NORMAL, URGENT, StagedPipeline
 from common import config as common_config
 from common.job_executor import ExecutorAPI, ExecutorState, JobDefinition, JobStatus
 from common.lib.github_validators import (
@@ -25,22 +27,95 @@ from common.schema import TaskType
 log = logging.getLogger(__name__)
 tracer = trace.get_tracer("agent_loop")
 
+# Set to wake the agent loop early, e.g. when the active tasks have changed
+wakeup = threading.Event()
 
-def main(exit_callback=lambda _: False):  # pragma: no cover
+
+def main(exit_callback=lambda _: False, api=None):  # pragma: no cover
     log.info("agent.main loop started")
-    api = get_executor_api()
+    api = api or get_executor_api()
+
+    try:
+        while True:
+            # clear before fetching tasks, so any changes that arrive while we are
+            # handling them will wake the next wait immediately
+            wakeup.clear()
+            active_tasks = handle_tasks(api)
+
+            if exit_callback(active_tasks):
+                break
+
+            wait_for_next_loop(active_tasks)
+    finally:
+        # including when the service is interrupted, so steps that jobs are part
+        # way through, like finalizing, aren't cut short
+        shutdown_pipeline()
+
+
+def wait_for_next_loop(active_tasks):
+    """Wait until the next agent loop is due, or we are woken early.
+
+    Active tasks need polling every JOB_LOOP_INTERVAL to track their progress.
+    But if we have none, and the tasks watcher is long-polling the controller
+    for us, there is nothing to do until it wakes us, so we can wait longer.
+
+    Returns True if we were woken early.
+    """
+    if active_tasks or not config.TASK_LONG_POLL_TIMEOUT:
+        timeout = common_config.JOB_LOOP_INTERVAL
+    else:
+        timeout = config.IDLE_LOOP_INTERVAL
+    return wakeup.wait(timeout)
+
 
+def watch_tasks():  # pragma: no cover
+    """Long-poll the controller for changes to our tasks, waking the agent loop"""
+    version = None
     while True:
-        active_tasks = handle_tasks(api)
+        version = check_for_task_changes(version)
+
+
+def check_for_task_changes(version):
+    """Wait for the active tasks to differ from `version`, and wake the agent loop
+    if they have. Returns the new version."""
+    new_version = task_api.wait_for_tasks_change(version, config.TASK_LONG_POLL_TIMEOUT)
+    if version is not None and new_version != version:
+        log.debug("Active tasks changed, waking agent loop")
+        wakeup.set()
+    return new_version
+
 
-        if exit_callback(active_tasks):
-            break
+def watch_executor_events(api):
+    """Wake the agent loop as soon as the executor sees a job change state by
+    itself, rather than at the next poll"""
+    api.watch_events(job_changed)
 
-        time.sleep(common_config.JOB_LOOP_INTERVAL)
+
+def job_changed(job_id):
+    log.debug(f"Job {job_id} changed state, waking agent loop")
+    wakeup.set()
 
 
 def handle_tasks(api: ExecutorAPI | None):
+    if config.TASK_PIPELINE:
+        # before fetching the tasks, so we know which of them may have changed by
+        # the time we dispatch them
+        get_pipeline().checkpoint()
     active_tasks = task_api.get_active_tasks()
+    # the pipeline's workers change the state of jobs during the loop, so it can't
+    # use a snapshot of their statuses
+    if not config.TASK_PIPELINE:
+        api.snapshot_status()
+    # get code for new jobs fetching in the background while we handle the tasks
+    prefetch.prefetch_code(active_tasks, api)
+
+    if config.TASK_PIPELINE:
+        with tracer.start_as_current_span("AGENT_LOOP") as span:
+            dispatched = dispatch_tasks(active_tasks, api)
+            span.set_attributes(
+                {"handled_tasks": len(active_tasks), "dispatched_tasks": dispatched}
+            )
+        return active_tasks
 
     handled_tasks = []
     errored_tasks = []
@@ -70,6 +145,116 @@ def handle_tasks(api: ExecutorAPI | None):
     return handled_tasks
 
 
+# the stage which handles the next step of a RUNJOB task, by the job's state. Tasks
+# for jobs in other states only need their status reporting, which we do straight
+# away.
+RUNJOB_STAGES = {
+    ExecutorState.UNKNOWN: "prepare",
+    ExecutorState.PREPARED: "execute",
+    ExecutorState.EXECUTED: "finalize",
+}
+
+_pipeline = None
+
+
+def get_pipeline():
+    global _pipeline
+    if _pipeline is None:
+        _pipeline = StagedPipeline(
+            {
+                "prepare": config.PREPARE_WORKERS,
+                "execute": config.EXECUTE_WORKERS,
+                "finalize": config.FINALIZE_WORKERS,
+                "cleanup": config.CLEANUP_WORKERS,
+            },
+            # so the next loop can start the job's next step
+            on_done=wakeup.set,
+        )
+    return _pipeline
+
+
+def shutdown_pipeline():
+    """Wait for any in-progress tasks and stop the pipeline"""
+    global _pipeline
+    if _pipeline is not None:
+        _pipeline.shutdown()
+        _pipeline = None
+
+
+def dispatch_tasks(active_tasks, api):
+    """
+    Hand each task's next step to the pipeline stage for it, unless its job
+    already has a step in progress. Cancellations go ahead of everything else.
+
+    Tasks whose job finished a step since the pipeline's checkpoint may be out of
+    date, so are left for the next loop, which the finished step will have woken.
+
+    Returns the number of tasks dispatched.
+    """
+    pipeline = get_pipeline()
+    staged_api = StagedExecutorAPI(api, pipeline)
+    dispatched = 0
+
+    for task in active_tasks:
+        if task.type in (TaskType.RUNJOB, TaskType.CANCELJOB):
+            key = task.definition["id"]
+        else:
+            key = task.id
+
+        priority = NORMAL
+        with set_log_context(task=task):
+            if pipeline.finished_since_checkpoint(key):
+                continue
+            elif task.type == TaskType.CANCELJOB:
+                stage, priority = "finalize", URGENT
+            elif pipeline.busy(key):
+                continue
+            elif task.type == TaskType.RUNJOB:
+                job = JobDefinition.from_dict(task.definition)
+                stage = RUNJOB_STAGES.get(api.get_status(job).state)
+            else:
+                # simple tasks run a container
+                stage = "execute"
+
+            if stage is None:
+                handle_isolated_task(task, api)
+            elif pipeline.submit(
+                key,
+                stage,
+                functools.partial(handle_isolated_task, task, staged_api),
+                priority,
+            ):
+                dispatched += 1
+
+    return dispatched
+
+
+class StagedExecutorAPI:
+    """The executor api, with cleanup deferred to the pipeline's cleanup stage"""
+
+    def __init__(self, api, pipeline):
+        self.api = api
+        self.pipeline = pipeline
+
+    def __getattr__(self, name):
+        return getattr(self.api, name)
+
+    def cleanup(self, job_definition):
+        self.pipeline.defer(
+            "cleanup", functools.partial(self.api.cleanup, job_definition)
+        )
+
+
+def handle_isolated_task(task, api):
+    """Handle a task, logging any error rather than raising it, so that it
+    doesn't affect any other tasks"""
+    with set_log_context(task=task):
+        try:
+            handle_single_task(task, api)
+        except Exception:
+            log.exception("task error")
+
+
 def handle_single_task(task, api):
     """The top level handler for a task.
 
@@ -297,11 +482,14 @@ def redact_results(results):
     If there are unmatched outputs or patterns, we also redact the
     status_message and hint which may contain messages referring to
     the unmatched filenames or patterns.
+    The container's inspect output is also dropped, as the controller doesn't
+    use it, and status checks no longer read it.
     """
     if not results:
         return results
     results = {**results}
     results.pop("outputs", None)
+    results.pop("container_metadata", None)
     has_unmatched_outputs = bool(results.pop("unmatched_outputs", None))
     has_unmatched_patterns = bool(results.pop("unmatched_patterns", None))
     if has_unmatched_outputs or has_unmatched_patterns:
@@ -15,6 +15,7 @@ from pathlib import Path
 from opentelemetry import trace
 
 from agent import config, task_api, tracing
+from agent.executors import cleanup
 from agent.lib.docker_stats import get_job_stats
 from common.job_executor import JobDefinition
 from common.lib.log_utils import configure_logging
@@ -133,6 +134,8 @@ def record_metrics_tick_trace(last_run):
         "stats_error": False,
         "backend": config.BACKEND,
     }
+    if config.CLEANUP_ASYNC:
+        trace_attrs["cleanup_backlog"] = cleanup.backlog_size()
     stats = {}
     error_attrs = {}
 
@@ -0,0 +1,177 @@
+"""
+Staged, concurrent handling of work, with a bounded pool of worker threads per stage.
+
+The agent loop uses this to hand each task's next step (e.g. preparing or
+finalizing a job) to the pool for that stage, so a slow step for one job doesn't
+hold up the rest. Work is keyed by job, and a key only ever has one piece of
+work queued or running, so a job never has two steps in progress at once.
+
+Urgent work, like cancelling a job, is taken from each stage's queue first, and
+replaces any work for the same key which hasn't started yet.
+
+Errors are logged and don't affect any other work. The next loop will pick up
+the task again, as its key is free.
+
+A loop's tasks are fetched before it dispatches them, so a task whose work
+finishes in between may already be out of date, e.g. a simple task which has
+completed. The loop takes a checkpoint before fetching its tasks, and leaves any
+whose key has finished since then to the next loop.
+"""
+
+import contextvars
+import itertools
+import logging
+import queue
+import threading
+from dataclasses import dataclass, field
+
+
+log = logging.getLogger(__name__)
+
+URGENT = 0
+NORMAL = 1
+
+
+@dataclass
+class Work:
+    key: str
+    stage: str
+    fn: object
+    priority: int
+    # run in a copy of the submitter's context, e.g. to keep its tracing span
+    context: contextvars.Context = field(default_factory=contextvars.copy_context)
+    started: bool = False
+    dropped: bool = False
+    # (stage, fn, context) to run next, with the key still locked
+    deferred: list = field(default_factory=list)
+
+
+class StagedPipeline:
+    def __init__(self, workers, on_done=None):
+        """`workers` is the number of worker threads for each stage, by name.
+        `on_done` is called after each piece of work finishes."""
+        self.on_done = on_done
+        self.lock = threading.Condition()
+        self.in_flight = {}
+        # keys whose work has finished since the last checkpoint
+        self.finished = set()
+        self.queues = {stage: queue.PriorityQueue() for stage in workers}
+        # keeps each stage's queue first in, first out within a priority
+        self.counter = itertools.count()
+        self.current = threading.local()
+        # thread names appear in log output, so we keep them the same length
+        self.workers = [
+            (
+                stage,
+                threading.Thread(
+                    target=self.worker,
+                    args=(stage,),
+                    name=f"{stage[:3]}{i}",
+                    daemon=True,
+                ),
+            )
+            for stage, count in workers.items()
+            for i in range(count)
+        ]
+        for _, thread in self.workers:
+            thread.start()
+
+    def busy(self, key):
+        """Does `key` have work queued or running?"""
+        with self.lock:
+            return key in self.in_flight
+
+    def checkpoint(self):
+        """Start recording which keys' work finishes, forgetting those recorded
+        since the last checkpoint"""
+        with self.lock:
+            self.finished = set()
+
+    def finished_since_checkpoint(self, key):
+        """Has work for `key` finished since the last checkpoint?"""
+        with self.lock:
+            return key in self.finished
+
+    def submit(self, key, stage, fn, priority=NORMAL):
+        """Queue `fn` to run in `stage`, unless `key` already has work in flight.
+
+        More urgent work replaces work for `key` which hasn't started yet.
+
+        Returns whether `fn` was queued.
+        """
+        with self.lock:
+            current = self.in_flight.get(key)
+            if current is not None:
+                if current.started or priority >= current.priority:
+                    return False
+                current.dropped = True
+            self.enqueue(Work(key, stage, fn, priority))
+            return True
+
+    def defer(self, stage, fn):
+        """Run `fn` in `stage` after the current work finishes, keeping its key
+        locked until then. Outside of the pipeline's workers, `fn` runs now."""
+        work = getattr(self.current, "work", None)
+        if work is None:
+            fn()
+        else:
+            work.deferred.append((stage, fn, contextvars.copy_context()))
+
+    def enqueue(self, work):
+        # must hold the lock
+        self.in_flight[work.key] = work
+        self.queues[work.stage].put((work.priority, next(self.counter), work))
+
+    def worker(self, stage):
+        while True:
+            _, _, work = self.queues[stage].get()
+            if work is None:
+                return
+            with self.lock:
+                if work.dropped:
+                    continue
+                work.started = True
+
+            self.current.work = work
+            try:
+                work.context.run(work.fn)
+            except Exception:
+                log.exception(f"Error in {stage} stage for {work.key}")
+            finally:
+                self.current.work = None
+            self.finish(work)
+
+    def finish(self, work):
+        with self.lock:
+            if work.deferred:
+                stage, fn, context = work.deferred[0]
+                self.enqueue(
+                    Work(
+                        work.key,
+                        stage,
+                        fn,
+                        work.priority,
+                        context=context,
+                        deferred=work.deferred[1:],
+                    )
+                )
+            else:
+                del self.in_flight[work.key]
+                self.finished.add(work.key)
+            self.lock.notify_all()
+        if self.on_done:
+            self.on_done()
+
+    def wait(self):
+        """Wait until there is no work queued or running"""
+        with self.lock:
+            self.lock.wait_for(lambda: not self.in_flight)
+
+    def shutdown(self):
+        """Wait for all work to finish, and stop the workers"""
+        self.wait()
+        for stage, _ in self.workers:
+            # sorts after anything left in the queue, which can only be dropped work
+            self.queues[stage].put((float("inf"), next(self.counter), None))
+        for _, thread in self.workers:
+            thread.join()
@@ -0,0 +1,96 @@
+"""
+Background prefetching of code for new jobs.
+
+Preparing a job checks out its commit, which means fetching it from GitHub if we
+don't already have it. Rather than pay that cost at the point the job starts, we
+look for RUNJOB tasks which the executor doesn't know about yet and fetch their
+commits ahead of time, using a small pool of worker threads. By the time the job
+is prepared, the commit is usually already in the local repo.
+
+Prefetching is purely an optimisation: any failure is logged and ignored, and the
+job's own preparation will fetch (and report errors for) the commit as before.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from agent import config
+from common import config as common_config
+from common.job_executor import ExecutorState, JobDefinition
+from common.lib import git
+from common.lib.github_validators import GithubValidationError, validate_repo_url
+from common.schema import TaskType
+
+
+log = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+# ids of the tasks we've already considered, so we only prefetch for each task once
+_seen_tasks = set()
+
+
+def prefetch_code(tasks, api):
+    """Start fetching the code for any new jobs among `tasks` in the background"""
+    if not config.GIT_PREFETCH_WORKERS:
+        return
+
+    # forget about tasks which are no longer active
+    _seen_tasks.intersection_update(task.id for task in tasks)
+
+    for task in tasks:
+        if task.type != TaskType.RUNJOB or task.id in _seen_tasks:
+            continue
+        _seen_tasks.add(task.id)
+        try:
+            job = JobDefinition.from_dict(task.definition)
+            if api.get_status(job).state != ExecutorState.UNKNOWN:
+                continue
+            if not is_allowed_repo(job.repo_url):
+                continue
+            get_executor().submit(prefetch_commit, job.repo_url, job.commit)
+        except Exception:
+            log.exception(f"Error starting prefetch for task {task.id}")
+
+
+def is_allowed_repo(repo_url):
+    # We only fetch from repos we'd be allowed to run jobs from. The full
+    # validation, including the branch check, still happens before the job is
+    # prepared.
+    if common_config.ALLOW_LOCAL_GIT_REPOS and repo_url.startswith("/"):
+        return True
+    try:
+        validate_repo_url(repo_url, common_config.ALLOWED_GITHUB_ORGS)
+    except GithubValidationError:
+        return False
+    return True
+
+
+def prefetch_commit(repo_url, commit):
+    try:
+        git.ensure_commit_fetched(git.get_local_repo_dir(repo_url), repo_url, commit)
+    except Exception:
+        log.warning(f"Failed to prefetch {repo_url}@{commit}", exc_info=True)
+    else:
+        log.debug(f"Prefetched {repo_url}@{commit}")
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=config.GIT_PREFETCH_WORKERS, thread_name_prefix="pfch"
+            )
+        return _executor
+
+
+def shutdown():
+    """Wait for any in-progress prefetches and reset our state"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+    _seen_tasks.clear()
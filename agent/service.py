@@ -2,12 +2,17 @@
 Script runs all agent flows in a single process.
 """
 
+import functools
 import logging
 import threading
 
 from agent import config
+from agent.executors import get_executor_api
+from agent.executors.cleanup import main as cleanup_main
 from agent.main import main as agent_main
+from agent.main import watch_executor_events, watch_tasks
 from agent.metrics import main as metrics_main
+from common import config as common_config
 from common import tracing
 from common.lib.log_utils import configure_logging
 from common.lib.service_utils import ThreadWrapper
@@ -21,7 +26,10 @@ start_thread = ThreadWrapper(log)
 
 def main():
     """
-    Run the agent loop in the main thread and the metrics loop in a background thread
+    Run the agent loop in the main thread and the metrics loop in a background thread,
+    along with the tasks watcher if we are long-polling the controller, the events
+    watcher if we are watching the executor's events, and the cleanup reaper if
+    cleanup is asynchronous
     """
     # note: thread name appears in log output, so its nice to keep them all the same length
     threading.current_thread().name = "agnt"
@@ -33,7 +41,18 @@ def main():
         log.info("agent.service started")
 
         start_thread(metrics_main, "mtrc", config.STATS_POLL_INTERVAL)
-        agent_main()
+        if config.CLEANUP_ASYNC:
+            start_thread(cleanup_main, "clnp", config.CLEANUP_INTERVAL)
+        if config.TASK_LONG_POLL_TIMEOUT:
+            start_thread(watch_tasks, "wtch", common_config.JOB_LOOP_INTERVAL)
+        api = get_executor_api()
+        if config.WATCH_EXECUTOR_EVENTS:
+            start_thread(
+                functools.partial(watch_executor_events, api),
+                "evnt",
+                common_config.JOB_LOOP_INTERVAL,
+            )
+        agent_main(api=api)
     except KeyboardInterrupt:
         log.info("agent.service stopped")
 
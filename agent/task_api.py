@@ -13,20 +13,22 @@ log = logging.getLogger(__name__)
 session = requests.Session()
 
 
-def get_json(path):
-    return request_json("GET", path)
+def get_json(path, params=None, timeout=None):
+    return request_json("GET", path, params=params, timeout=timeout)
 
 
 def post_json(path, data=None):
     return request_json("POST", path, data)
 
 
-def request_json(method, path, data=None):
+def request_json(method, path, data=None, params=None, timeout=None):
     base_url = urljoin(config.TASK_API_ENDPOINT, config.BACKEND)
     data = data or {}
     url = f"{base_url}/{path}"
     headers = {"Authorization": config.TASK_API_TOKEN}
-    response = session.request(method, url, data=data, headers=headers)
+    response = session.request(
+        method, url, data=data, params=params, headers=headers, timeout=timeout
+    )
     try:
         response.raise_for_status()
     except Exception as e:
@@ -41,6 +43,21 @@ def get_active_tasks() -> list[AgentTask]:
     return [AgentTask.from_dict(t) for t in agent_tasks]
 
 
+def wait_for_tasks_change(version: str | None, timeout: float) -> str:
+    """Long-poll the controller until this backend's active tasks change.
+
+    The controller holds the request open until the version of the active tasks
+    differs from `version`, or `timeout` seconds have passed, and we return the
+    current version. Passing a version of None returns immediately.
+    """
+    params = {"wait": timeout}
+    if version is not None:
+        params["version"] = version
+    # allow the controller a little longer than the wait to respond
+    response = get_json("tasks/", params=params, timeout=timeout + 30)
+    return response["version"]
+
+
 def update_controller(
     task: AgentTask,
     stage: str,
@@ -65,3 +65,28 @@ ALLOWED_GITHUB_ORGS = (
 )
 
 ALLOW_LOCAL_GIT_REPOS = os.environ.get("ALLOW_LOCAL_GIT_REPOS", "").lower() == "true"
+
+# Used by the controller to fetch commits without their file contents
+# (`--filter=blob:none`); the files it reads are then fetched on demand. This is
+# ignored by agents, which always fetch the full commit.
+GIT_BLOBLESS_FETCH = os.environ.get("GIT_BLOBLESS_FETCH", "").lower() == "true"
+
+# How long to cache the commit a remote branch or tag points to
+GIT_REF_CACHE_TTL = float(os.environ.get("GIT_REF_CACHE_TTL", "30"))
+
+# Files are read from local repos using long-lived `git cat-file --batch`
+# processes, one per repo. We keep at most GIT_CAT_FILE_POOL_SIZE of these, and
+# close any which have been idle for GIT_CAT_FILE_IDLE_TIMEOUT seconds.
+GIT_CAT_FILE_POOL_SIZE = int(os.environ.get("GIT_CAT_FILE_POOL_SIZE", "8"))
+GIT_CAT_FILE_IDLE_TIMEOUT = float(os.environ.get("GIT_CAT_FILE_IDLE_TIMEOUT", "300"))
+
+# The most entries to keep in each of the in-memory caches of what we've learned
+# about repos, such as which commits have been fetched, which commits are reachable
+# from a branch, and the commits remote refs point to
+GIT_CACHE_SIZE = int(os.environ.get("GIT_CACHE_SIZE", "10000"))
+
+# Parsed pipelines are cached in memory, keyed on (repo_url, commit). Optionally
+# they can also be cached on disk so they survive restarts.
+PIPELINE_CACHE_SIZE = int(os.environ.get("PIPELINE_CACHE_SIZE", "128"))
+PIPELINE_DISK_CACHE = os.environ.get("PIPELINE_DISK_CACHE", "").lower() == "true"
+PIPELINE_CACHE_DIR = WORKDIR / "pipeline-cache"
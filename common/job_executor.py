@@ -275,6 +275,27 @@ class ExecutorAPI:
         out-of-band mechanisms for cleaning up resources associated with such failures.
         """
 
+    def snapshot_status(self) -> None:
+        """
+        Optionally take a snapshot of the status of all jobs, to answer get_status() from.
+
+        This is called at the start of each loop, before any get_status() calls. Implementations which check each
+        job's status individually can ignore it. Any that do use a snapshot must not use it for a job after changing
+        that job's state.
+
+        """
+
+    def watch_events(self, callback) -> None:
+        """
+        Optionally, watch for jobs changing state by themselves, e.g. a job's process exiting, and call
+        `callback(job_id)` for each as soon as it happens.
+
+        This blocks for as long as the watch lasts, and is called repeatedly in a background thread. It only lets the
+        job-runner react sooner: get_status() must still report every state change. Implementations which can't watch
+        for changes can ignore it.
+
+        """
+
     def get_status(self, job_definition: JobDefinition, cancelled=False) -> JobStatus:
         """
         Return the current status of a job.
@@ -2,10 +2,15 @@
 Utility functions for interacting with git
 """
 
+import contextlib
+import fcntl
 import logging
 import os
 import subprocess
+import tempfile
+import threading
 import time
+from collections import OrderedDict
 from pathlib import Path, PurePath
 from urllib.parse import urlparse, urlunparse
 
@@ -17,9 +22,73 @@ from common.lib.string_utils import project_name_from_url
 log = logging.getLogger(__name__)
 
 
+class BoundedCache:
+    """
+    A thread-safe cache which forgets its least recently used entries once it
+    holds more than GIT_CACHE_SIZE, so it can't grow forever in a long-running
+    process
+
+    It can be used as a dict or, with `add`, as a set.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def __contains__(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return False
+            self.entries.move_to_end(key)
+            return True
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > common_config.GIT_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, key):
+        self[key] = True
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
 # See `commit_already_fetched`
 SENTINEL_TAG_PREFIX = "fetched/"
 
+# (repo_url, ref) -> (sha, expires_at), see `get_sha_from_remote_ref`
+remote_ref_cache = BoundedCache()
+
+# (repo_url, commit_sha, ref) triples known to be reachable, see
+# `commit_reachable_from_ref`
+reachable_commits = BoundedCache()
+
+# See `single_flight`
+_single_flight_locks = {}
+_single_flight_lock = threading.Lock()
+
+# Name of the remote used for on-demand fetching of blobs, see `use_blobless_fetch`
+PARTIAL_CLONE_REMOTE = "origin"
+
+
+# (repo_dir, commit_sha) pairs we know have been fully fetched, so we only need to
+# check the sentinel tag once per commit
+known_fetched_commits = BoundedCache()
+
 # Prevent git from ever prompting for credentials. Hat tip:
 # https://serverfault.com/a/1054253
 NEVER_PROMPT_FOR_AUTH_ENV = dict(
@@ -61,21 +130,151 @@ def read_file_from_repo(repo_url, commit_sha, path):
     repo_dir = get_local_repo_dir(repo_url)
     ensure_commit_fetched(repo_dir, repo_url, commit_sha)
     try:
-        response = subprocess.run(
-            ["git", "show", f"{commit_sha}:{path}"],
-            capture_output=True,
-            check=True,
-            cwd=repo_dir,
+        contents = cat_file_readers.read_blob(
+            repo_dir, f"{commit_sha}:{path}", env=get_fetch_env(repo_url)
         )
-    except subprocess.SubprocessError as e:
-        if e.stderr.startswith(b"fatal: path ") and b"does not exist" in e.stderr:
+    except GitFileNotFoundError:
+        if commit_exists(repo_dir, repo_url, commit_sha):
             raise GitFileNotFoundError(f"File '{path}' not found in repository")
-        else:  # pragma: no cover
-            log.exception(f"Error reading from {repo_url} @ {commit_sha}")
-            raise GitError(f"Error reading from {repo_url} @ {commit_sha}")
+        log.error(f"Commit {commit_sha} not found in {repo_dir}")
+        raise GitError(f"Error reading from {repo_url} @ {commit_sha}")
+    except GitError:
+        log.exception(f"Error reading from {repo_url} @ {commit_sha}")
+        raise GitError(f"Error reading from {repo_url} @ {commit_sha}")
     # Note the response here is bytes not text as git doesn't know what
     # encoding the file is supposed to have
-    return response.stdout
+    return contents
+
+
+def commit_exists(repo_dir, repo_url, commit_sha):
+    try:
+        cat_file_readers.read_object(
+            repo_dir, f"{commit_sha}^{{commit}}", env=get_fetch_env(repo_url)
+        )
+    except GitFileNotFoundError:
+        return False
+    return True
+
+
+class CatFileReader:
+    """
+    A long-lived `git cat-file --batch` process for reading objects from a repo
+
+    This saves forking a new git process for every file we read. Requests and
+    responses are sent over the process's stdin/stdout so only one thread can use
+    it at a time.
+    """
+
+    def __init__(self, repo_dir, env=None):
+        self.repo_dir = repo_dir
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.process = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=repo_dir,
+            env=env,
+        )
+
+    def read_object(self, object_name):
+        """Return the type and contents of an object"""
+        if "\n" in object_name:
+            raise GitFileNotFoundError(object_name)
+        with self.lock:
+            if self.process.stdin.closed:
+                raise GitError(f"git cat-file closed in {self.repo_dir}")
+            self.last_used = time.monotonic()
+            self.process.stdin.write(object_name.encode("utf-8") + b"\n")
+            self.process.stdin.flush()
+            header = self.process.stdout.readline()
+            if not header:
+                raise GitError(f"git cat-file exited in {self.repo_dir}")
+            # Either "<sha> <type> <size>" or "<object_name> missing"
+            parts = header.split()
+            if parts[-1] == b"missing" or parts[-1] == b"ambiguous":
+                raise GitFileNotFoundError(object_name)
+            object_type, size = parts[1], int(parts[2])
+            # The contents are followed by a newline
+            contents = self.process.stdout.read(size + 1)[:-1]
+        return object_type, contents
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        with contextlib.suppress(OSError):
+            self.process.stdin.close()
+        self.process.wait()
+        self.process.stdout.close()
+
+
+class CatFileReaderPool:
+    """
+    A bounded pool of `CatFileReader`s, one per repo directory
+
+    When the pool is full the least recently used reader is closed, and readers
+    which have been idle for longer than GIT_CAT_FILE_IDLE_TIMEOUT are closed the
+    next time the pool is used.
+    """
+
+    def __init__(self):
+        self.readers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def read_blob(self, repo_dir, object_name, env=None):
+        object_type, contents = self.read_object(repo_dir, object_name, env)
+        if object_type != b"blob":
+            raise GitFileNotFoundError(object_name)
+        return contents
+
+    def read_object(self, repo_dir, object_name, env=None):
+        reader = self.get_reader(repo_dir, env)
+        try:
+            return reader.read_object(object_name)
+        except (GitError, OSError):
+            # The process may have died, in which case retry once with a new one
+            if reader.is_alive():
+                raise
+            self.discard(repo_dir, reader)
+            return self.get_reader(repo_dir, env).read_object(object_name)
+
+    def get_reader(self, repo_dir, env=None):
+        to_close = []
+        with self.lock:
+            now = time.monotonic()
+            for key, reader in list(self.readers.items()):
+                if now - reader.last_used > common_config.GIT_CAT_FILE_IDLE_TIMEOUT:
+                    to_close.append(self.readers.pop(key))
+            reader = self.readers.get(repo_dir)
+            if reader is None:
+                reader = CatFileReader(repo_dir, env)
+                self.readers[repo_dir] = reader
+            self.readers.move_to_end(repo_dir)
+            while len(self.readers) > common_config.GIT_CAT_FILE_POOL_SIZE:
+                to_close.append(self.readers.popitem(last=False)[1])
+        for old_reader in to_close:
+            # Wait for any in-progress read to finish before closing
+            with old_reader.lock:
+                old_reader.close()
+        return reader
+
+    def discard(self, repo_dir, reader):
+        with self.lock:
+            if self.readers.get(repo_dir) is reader:
+                del self.readers[repo_dir]
+        reader.close()
+
+    def close_all(self):
+        with self.lock:
+            readers = list(self.readers.values())
+            self.readers.clear()
+        for reader in readers:
+            reader.close()
+
+
+cat_file_readers = CatFileReaderPool()
 
 
 def checkout_commit(repo_url, commit_sha, target_dir):
@@ -85,30 +284,51 @@ def checkout_commit(repo_url, commit_sha, target_dir):
     repo_dir = get_local_repo_dir(repo_url)
     ensure_commit_fetched(repo_dir, repo_url, commit_sha)
     os.makedirs(target_dir, exist_ok=True)
-    subprocess.run(
-        [
-            "git",
-            f"--work-tree={target_dir}",
-            "checkout",
-            "--quiet",
-            "--force",
-            commit_sha,
-        ],
-        check=True,
-        # Set GIT_DIR rather than changing working directory so that
-        # `target_dir` gets correctly resolved
-        env=dict(os.environ, GIT_DIR=repo_dir),
-    )
+    # Checking out writes the repo's index and HEAD, so only one checkout can use
+    # a repo at once, whichever commit it's for
+    with repo_lock(repo_dir):
+        subprocess.run(
+            [
+                "git",
+                f"--work-tree={target_dir}",
+                "checkout",
+                "--quiet",
+                "--force",
+                commit_sha,
+            ],
+            check=True,
+            # Set GIT_DIR rather than changing working directory so that
+            # `target_dir` gets correctly resolved
+            env=dict(os.environ, GIT_DIR=repo_dir),
+        )
 
 
 def commit_reachable_from_ref(repo_url, commit_sha, ref):
     """
     Given a `ref` (branch name, tag, etc) on a remote repo, check whether the
     supplied commit is reachable from that ref.
+
+    Once a commit has been found to be reachable from a ref we remember that,
+    on the basis that branches aren't rewound.
     """
+    key = (repo_url, commit_sha, ref)
+    if key in reachable_commits:
+        return True
+    reachable = _commit_reachable_from_ref(repo_url, commit_sha, ref)
+    if reachable:
+        reachable_commits.add(key)
+    return reachable
+
+
+def _commit_reachable_from_ref(repo_url, commit_sha, ref):
     ref_sha = get_sha_from_remote_ref(repo_url, ref)
     # The easy case and the case I expect to be hit almost every time as the UI
     # currently only supports running against the branch head
+    if commit_sha == ref_sha:
+        return True
+    # The ref may have moved since we cached it, so check again before doing any
+    # more expensive work
+    ref_sha = get_sha_from_remote_ref(repo_url, ref, use_cache=False)
     if commit_sha == ref_sha:
         return True
     # However a well (or badly) timed push could cause the target sha and the
@@ -118,21 +338,25 @@ def commit_reachable_from_ref(repo_url, commit_sha, ref):
     # we fetch the entire branch history.
     repo_dir = get_local_repo_dir(repo_url)
     ensure_git_init(repo_dir)
-    fetch_commit(repo_dir, repo_url, ref_sha, depth=10)
-    if commit_is_ancestor(repo_dir, commit_sha, ref_sha):
-        return True
-    # The below is a git magic number meaning "infinite depth". See:
-    # https://git-scm.com/docs/shallow
-    fetch_commit(repo_dir, repo_url, ref_sha, depth=2147483647)
-    return commit_is_ancestor(repo_dir, commit_sha, ref_sha)
+    with repo_lock(repo_dir):
+        fetch_commit(repo_dir, repo_url, ref_sha, depth=10)
+        if commit_is_ancestor(repo_dir, commit_sha, ref_sha):
+            return True
+        # The below is a git magic number meaning "infinite depth". See:
+        # https://git-scm.com/docs/shallow
+        fetch_commit(repo_dir, repo_url, ref_sha, depth=2147483647)
+        return commit_is_ancestor(repo_dir, commit_sha, ref_sha)
 
 
-def get_sha_from_remote_ref(repo_url, ref):
+def get_sha_from_remote_ref(repo_url, ref, use_cache=True):
     """Gets the SHA of the commit associated with the ref at the repo URL.
 
+    Results are cached for GIT_REF_CACHE_TTL seconds.
+
     Args:
         repo_url: A repo URL.
         ref: A ref, such as a branch name, tag name, etc.
+        use_cache: Whether to use a previously cached result.
 
     Returns:
         The SHA of the commit. For example, if the ref is an annotated tag, then the SHA
@@ -142,6 +366,10 @@ def get_sha_from_remote_ref(repo_url, ref):
         GitRepoNotReachableError: We couldn't read from the remote repo
         GitUnknownRefError: We couldn't find the specified ref in the remote repo
     """
+    if use_cache:
+        sha, expires_at = remote_ref_cache.get((repo_url, ref), (None, 0))
+        if expires_at > time.monotonic():
+            return sha
     # If `ref` matches an annotated tag, then `deref_ref` will match the associated
     # commit.
     deref_ref = f"{ref}^{{}}"
@@ -174,7 +402,10 @@ def get_sha_from_remote_ref(repo_url, ref):
         f"refs/tags/{ref}",  # Lightweight tag
     ]:
         if target_ref in results:
-            return results[target_ref]
+            sha = results[target_ref]
+            expires_at = time.monotonic() + common_config.GIT_REF_CACHE_TTL
+            remote_ref_cache[(repo_url, ref)] = (sha, expires_at)
+            return sha
     raise GitUnknownRefError(f"Could not find ref '{ref}' in {repo_url}")
 
 
@@ -199,14 +430,63 @@ def ensure_commit_fetched(repo_dir, repo_url, commit_sha):
     # It's safe to keep re-fetching the same commit, but it requires
     # talking to the remote repo every time so it's better to avoid it if
     # we can
-    if not commit_already_fetched(repo_dir, commit_sha):
-        fetch_commit(repo_dir, repo_url, commit_sha)
+    if commit_already_fetched(repo_dir, commit_sha):
+        return
+    # If several threads or processes need the same commit at once, only one of
+    # them fetches it: the rest wait and then find it already fetched
+    with single_flight((repo_dir, commit_sha)), repo_lock(repo_dir):
+        if not commit_already_fetched(repo_dir, commit_sha):
+            fetch_commit(repo_dir, repo_url, commit_sha)
+
+
+@contextlib.contextmanager
+def single_flight(key):
+    """
+    Allow only one thread at a time to run the block for a given key
+    """
+    with _single_flight_lock:
+        lock, users = _single_flight_locks.get(key, (threading.Lock(), 0))
+        _single_flight_locks[key] = (lock, users + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with _single_flight_lock:
+            lock, users = _single_flight_locks[key]
+            if users == 1:
+                del _single_flight_locks[key]
+            else:
+                _single_flight_locks[key] = (lock, users - 1)
+
+
+@contextlib.contextmanager
+def repo_lock(repo_dir):
+    """
+    Hold an exclusive lock on a local repo while we modify it
+
+    This uses a lock file alongside the repo, so it works across processes (e.g.
+    the controller's webapp workers) as well as threads.
+    """
+    lock_path = repo_dir.with_name(f"{repo_dir.name}.lock")
+    with lock_path.open("a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
 
 def ensure_git_init(repo_dir):
     if not os.path.exists(repo_dir / "config"):
         repo_dir.parent.mkdir(exist_ok=True)
-        subprocess.run(["git", "init", "--bare", "--quiet", repo_dir], check=True)
+        with repo_lock(repo_dir):
+            if os.path.exists(repo_dir / "config"):
+                return
+            # Initialise in a temporary directory and then move it into place so
+            # that no one else ever sees a partially initialised repo
+            tmp_dir = tempfile.mkdtemp(dir=repo_dir.parent, prefix=f".{repo_dir.name}.")
+            subprocess.run(["git", "init", "--bare", "--quiet", tmp_dir], check=True)
+            os.rename(tmp_dir, repo_dir)
 
 
 def commit_already_fetched(repo_dir, commit_sha):
@@ -222,7 +502,11 @@ def commit_already_fetched(repo_dir, commit_sha):
     passes but attempting to check out the commit will fail. To work around
     this we create a special "sentinel" tag for each commit to indicate that
     the entire fetch process has completed successfully.
+
+    Commits never get un-fetched, so we remember positive results in memory.
     """
+    if (repo_dir, commit_sha) in known_fetched_commits:
+        return True
     response = subprocess.run(
         [
             "git",
@@ -238,7 +522,10 @@ def commit_already_fetched(repo_dir, commit_sha):
         capture_output=True,
         cwd=repo_dir,
     )
-    return response.stdout.strip() == b"exists"
+    fetched = response.stdout.strip() == b"exists"
+    if fetched:
+        known_fetched_commits.add((repo_dir, commit_sha))
+    return fetched
 
 
 def mark_commmit_as_fetched(repo_dir, commit_sha):
@@ -258,6 +545,7 @@ def mark_commmit_as_fetched(repo_dir, commit_sha):
         capture_output=True,
         cwd=repo_dir,
     )
+    known_fetched_commits.add((repo_dir, commit_sha))
 
 
 def fetch_commit(repo_dir, repo_url, commit_sha, depth=1):
@@ -273,7 +561,12 @@ def fetch_commit(repo_dir, repo_url, commit_sha, depth=1):
     max_retries = 5
     sleep = 4
     attempt = 1
-    authenticated_url = add_access_token_and_proxy(repo_url)
+    if use_blobless_fetch():
+        ensure_partial_clone_config(repo_dir)
+        # The URL is supplied by get_fetch_env
+        source = ["--filter=blob:none", PARTIAL_CLONE_REMOTE]
+    else:
+        source = [add_access_token_and_proxy(repo_url)]
     while True:
         try:
             subprocess.run(
@@ -283,13 +576,13 @@ def fetch_commit(repo_dir, repo_url, commit_sha, depth=1):
                     "--force",
                     "--depth",
                     str(depth),
-                    authenticated_url,
+                    *source,
                     commit_sha,
                 ],
                 check=True,
                 capture_output=True,
                 cwd=repo_dir,
-                env=NEVER_PROMPT_FOR_AUTH_ENV,
+                env=get_fetch_env(repo_url),
             )
             mark_commmit_as_fetched(repo_dir, commit_sha)
             break
@@ -314,6 +607,47 @@ def fetch_commit(repo_dir, repo_url, commit_sha, depth=1):
                 raise GitError(f"Error fetching commit {commit_sha} from {repo_url}")
 
 
+def use_blobless_fetch():
+    """
+    Whether to fetch commits without their file contents
+
+    The controller only ever reads a couple of small files, so when
+    GIT_BLOBLESS_FETCH is enabled it fetches just the commits and trees, and git
+    fetches the blobs it needs on demand. Agents need to check out complete
+    commits, so they always do full fetches.
+    """
+    return common_config.GIT_BLOBLESS_FETCH and not agent_config.BACKEND
+
+
+def ensure_partial_clone_config(repo_dir):
+    """
+    Configure the repo to fetch missing blobs on demand from PARTIAL_CLONE_REMOTE
+
+    We deliberately don't store the remote's URL in the repo config, as it contains
+    our access token. Instead it is supplied in the environment by `get_fetch_env`.
+    """
+    for key, value in [
+        (f"remote.{PARTIAL_CLONE_REMOTE}.promisor", "true"),
+        (f"remote.{PARTIAL_CLONE_REMOTE}.partialclonefilter", "blob:none"),
+        ("extensions.partialClone", PARTIAL_CLONE_REMOTE),
+    ]:
+        subprocess.run(["git", "config", key, value], check=True, cwd=repo_dir)
+
+
+def get_fetch_env(repo_url):
+    """
+    Return the environment for git commands which may need to talk to the remote
+    """
+    if not use_blobless_fetch():
+        return NEVER_PROMPT_FOR_AUTH_ENV
+    return dict(
+        NEVER_PROMPT_FOR_AUTH_ENV,
+        GIT_CONFIG_COUNT="1",
+        GIT_CONFIG_KEY_0=f"remote.{PARTIAL_CLONE_REMOTE}.url",
+        GIT_CONFIG_VALUE_0=add_access_token_and_proxy(repo_url),
+    )
+
+
 def commit_is_ancestor(repo_dir, ancestor_sha, descendant_sha):
     response = subprocess.run(
         ["git", "merge-base", "--is-ancestor", ancestor_sha, descendant_sha],
@@ -0,0 +1,110 @@
+"""
+Cache of parsed and validated pipelines
+
+The project.yaml at a given commit never changes, so once we have read and
+validated it there's no need to do so again. Both the controller (on every RAP
+create request) and the agent (on every job finalization) load the pipeline for
+a commit, often the same one many times in quick succession.
+
+We keep a bounded, in-memory LRU cache of `Pipeline` objects keyed on (repo_url,
+commit). If PIPELINE_DISK_CACHE is enabled we also pickle each pipeline to disk
+so the cache survives restarts. Pickles are stored in a directory per version of
+the pipeline library, so an upgrade will never load a pipeline parsed by a
+different version.
+"""
+
+import functools
+import importlib.metadata
+import logging
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from pipeline import load_pipeline
+
+from common import config
+from common.lib.string_utils import project_name_from_url
+
+
+log = logging.getLogger(__name__)
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_pipeline(repo_url, commit, read_project_file):
+    """
+    Return the `Pipeline` for the given repo and commit
+
+    `read_project_file` is a callable returning the contents of the project.yaml
+    which is only called if the pipeline is not already cached.
+    """
+    key = (repo_url, commit)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    pipeline = None
+    if config.PIPELINE_DISK_CACHE:
+        pipeline = read_from_disk(repo_url, commit)
+    if pipeline is None:
+        pipeline = load_pipeline(read_project_file())
+        if config.PIPELINE_DISK_CACHE:
+            write_to_disk(repo_url, commit, pipeline)
+
+    with _lock:
+        _cache[key] = pipeline
+        _cache.move_to_end(key)
+        while len(_cache) > config.PIPELINE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return pipeline
+
+
+def clear():
+    with _lock:
+        _cache.clear()
+
+
+@functools.cache
+def get_pipeline_version():
+    try:
+        return importlib.metadata.version("opensafely-pipeline")
+    except importlib.metadata.PackageNotFoundError:  # pragma: no cover
+        return "unknown"
+
+
+def get_disk_cache_path(repo_url, commit):
+    repo_name = project_name_from_url(repo_url)
+    return (
+        config.PIPELINE_CACHE_DIR
+        / get_pipeline_version()
+        / Path(repo_name)
+        / f"{commit}.pickle"
+    )
+
+
+def read_from_disk(repo_url, commit):
+    path = get_disk_cache_path(repo_url, commit)
+    try:
+        with path.open("rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        # A corrupt or otherwise unreadable entry is just a cache miss; it will be
+        # overwritten when we re-parse the pipeline
+        log.warning(f"Ignoring unreadable pipeline cache file {path}", exc_info=True)
+        return None
+
+
+def write_to_disk(repo_url, commit, pipeline):
+    path = get_disk_cache_path(repo_url, commit)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Write then rename so that concurrent readers never see a partial file
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with tmp_path.open("wb") as f:
+        pickle.dump(pipeline, f)
+    tmp_path.replace(path)
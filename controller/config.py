@@ -44,6 +44,33 @@ def client_tokens_from_env(env):
 CLIENT_TOKENS = client_tokens_from_env(os.environ)
 
 
+# Agents may ask the tasks endpoint to hold their request open until their active
+# tasks change (long-polling). This is the longest we will hold a request for. Note
+# that each waiting agent occupies a gunicorn worker for this time, so gunicorn.conf.py
+# adds a worker per backend to leave the rest for the RAP API.
+TASK_LONG_POLL_MAX_WAIT = float(os.environ.get("TASK_LONG_POLL_MAX_WAIT", "10"))
+# How often a waiting request checks the database for changes to the active tasks.
+# Every waiting agent queries the database this often, so we don't allow less than a
+# second.
+TASK_LONG_POLL_CHECK_INTERVAL = max(
+    float(os.environ.get("TASK_LONG_POLL_CHECK_INTERVAL", "1")), 1.0
+)
+
+# If set, the rap/create endpoint only validates and records create requests, and
+# returns a 202. The jobs are created in the background by a pool of
+# RAP_CREATE_WORKERS threads in the controller service, and the outcome is reported
+# by the rap/status endpoint. This avoids slow git operations tying up API workers.
+RAP_CREATE_ASYNC = os.environ.get("RAP_CREATE_ASYNC", "").lower() == "true"
+RAP_CREATE_WORKERS = int(os.environ.get("RAP_CREATE_WORKERS", "4"))
+RAP_CREATE_POLL_INTERVAL = float(os.environ.get("RAP_CREATE_POLL_INTERVAL", "1"))
+
+# Creating jobs in a workspace holds a lock on that workspace. This is how long a
+# create request will wait to acquire the lock before giving up, and how long
+# before a lock is considered abandoned (e.g. if the process holding it died).
+WORKSPACE_LOCK_TIMEOUT = float(os.environ.get("WORKSPACE_LOCK_TIMEOUT", "120"))
+WORKSPACE_LOCK_EXPIRY = float(os.environ.get("WORKSPACE_LOCK_EXPIRY", "600"))
+WORKSPACE_LOCK_POLL_INTERVAL = 0.1
+
 # TICK trace interval
 TICK_POLL_INTERVAL = float(os.environ.get("TICK_POLL_INTERVAL", "30"))
 
@@ -89,6 +116,15 @@ STATA_LICENSE = os.environ.get("STATA_LICENSE")
 ACTIONS_GITHUB_ORG = "opensafely-actions"
 ACTIONS_GITHUB_ORG_URL = f"https://github.com/{ACTIONS_GITHUB_ORG}"
 
+# Reusable action resolution is cached in the database. Tags can be moved, so we
+# only trust a tag's commit for REUSABLE_ACTION_TAG_TTL seconds, and remember that
+# a tag doesn't exist for REUSABLE_ACTION_UNKNOWN_TAG_TTL seconds. The action file
+# for a commit never changes so it is cached permanently.
+REUSABLE_ACTION_TAG_TTL = int(os.environ.get("REUSABLE_ACTION_TAG_TTL", "300"))
+REUSABLE_ACTION_UNKNOWN_TAG_TTL = int(
+    os.environ.get("REUSABLE_ACTION_UNKNOWN_TAG_TTL", "60")
+)
+
 
 def parse_job_resource_weights(config_file_template):
     """
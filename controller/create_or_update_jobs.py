@@ -7,23 +7,31 @@ library to validate the pipeline configuration, and doing the necessary
 dependency resolution.
 """
 
+import functools
 import logging
 import re
 import time
 
 from opentelemetry import trace
-from pipeline import RUN_ALL_COMMAND, load_pipeline
+from pipeline import RUN_ALL_COMMAND, ProjectValidationError
 
 from common import config as common_config
-from common.lib.git import GitFileNotFoundError, read_file_from_repo
-from common.lib.github_validators import validate_repo_and_commit
+from common.lib import pipeline_cache
+from common.lib.git import GitError, GitFileNotFoundError, read_file_from_repo
+from common.lib.github_validators import GithubValidationError, validate_repo_and_commit
 from controller import tracing
-from controller.actions import get_action_specification
+from controller.actions import UnknownActionError, get_action_specification
 from controller.lib.database import exists_where, insert, transaction, update_where
 from controller.models import Job, State, StatusCode
 from controller.permissions.utils import build_analysis_scope
-from controller.queries import calculate_workspace_state
+from controller.queries import (
+    WorkspaceLockTimeoutError,
+    calculate_workspace_state,
+    workspace_lock,
+)
 from controller.reusable_actions import (
+    ReusableActionError,
+    prefetch_reusable_actions,
     resolve_reusable_action_references,
 )
 
@@ -44,43 +52,73 @@ class NothingToDoError(RapCreateRequestError):
     pass
 
 
+# Errors raised by `create_jobs` whose messages we control, and which are likely to
+# contain useful information for the client to display to the user, so are safe to
+# pass on to them
+HANDLED_CREATE_ERRORS = (
+    GitError,
+    GithubValidationError,
+    ProjectValidationError,
+    ReusableActionError,
+    RapCreateRequestError,
+    WorkspaceLockTimeoutError,
+)
+
+
 def create_jobs(rap_create_request):
     with tracer.start_as_current_span(
         "create_jobs", attributes=rap_create_request.get_tracing_span_attributes()
     ):
         validate_rap_create_request(rap_create_request)
-        project_file = get_project_file(rap_create_request)
-
-        pipeline_config = load_pipeline(project_file)
-
-        latest_jobs = get_latest_jobs_for_actions_in_project(
-            rap_create_request.backend, rap_create_request.workspace, pipeline_config
+        pipeline_config = pipeline_cache.get_pipeline(
+            rap_create_request.repo_url,
+            rap_create_request.commit,
+            functools.partial(get_project_file, rap_create_request),
+        )
+        # Resolving reusable actions can mean talking to GitHub, which we don't
+        # want to do while holding the workspace lock, so we fetch any we might
+        # need first
+        reusable_action_cache = prefetch_reusable_actions(
+            get_run_commands(rap_create_request, pipeline_config)
         )
 
-        new_jobs = get_new_jobs_to_run(rap_create_request, pipeline_config, latest_jobs)
-        assert_new_jobs_created(rap_create_request, new_jobs, latest_jobs)
-
-        resolve_reusable_action_references(new_jobs)
-
-        # check for database actions in the new jobs, and raise an exception if
-        # codelists are out of date
-        assert_codelists_ok(rap_create_request, new_jobs)
-
-        # There is a delay between getting the current jobs (which we fetch from
-        # the database and the disk) and inserting our new jobs below. This means
-        # the state of the world may have changed in the meantime. Why is this OK?
-        #
-        # Because we're single threaded and because this function is the only place
-        # jobs are created, we can guarantee that no *new* jobs were created. So
-        # the only state change that's possible is that some active jobs might have
-        # completed. That's unproblematic: any new jobs which are waiting on these
-        # now-already-completed jobs will see they have completed the first time
-        # they check and then proceed as normal.
-        #
-        # (It is also possible that someone could delete files off disk that are
-        # needed by a particular job, but there's not much we can do about that
-        # other than fail gracefully when trying to start the job.)
-        insert_into_database(new_jobs)
+        # Creating jobs depends on the current state of the workspace, so we must
+        # not let any other request create jobs in this workspace until we have
+        # inserted ours. Requests for other workspaces can proceed in parallel.
+        with workspace_lock(rap_create_request.backend, rap_create_request.workspace):
+            latest_jobs = get_latest_jobs_for_actions_in_project(
+                rap_create_request.backend,
+                rap_create_request.workspace,
+                pipeline_config,
+            )
+
+            new_jobs = get_new_jobs_to_run(
+                rap_create_request, pipeline_config, latest_jobs
+            )
+            assert_new_jobs_created(rap_create_request, new_jobs, latest_jobs)
+
+            resolve_reusable_action_references(new_jobs, reusable_action_cache)
+
+            # check for database actions in the new jobs, and raise an exception if
+            # codelists are out of date
+            assert_codelists_ok(rap_create_request, new_jobs)
+
+            # There is a delay between getting the current jobs (which we fetch from
+            # the database and the disk) and inserting our new jobs below. This means
+            # the state of the world may have changed in the meantime. Why is this OK?
+            #
+            # Because we hold the workspace lock and because this function is the
+            # only place jobs are created, we can guarantee that no *new* jobs were
+            # created in this workspace. So the only state change that's possible is
+            # that some active jobs might have completed. That's unproblematic: any
+            # new jobs which are waiting on these now-already-completed jobs will see
+            # they have completed the first time they check and then proceed as
+            # normal.
+            #
+            # (It is also possible that someone could delete files off disk that are
+            # needed by a particular job, but there's not much we can do about that
+            # other than fail gracefully when trying to start the job.)
+            insert_into_database(new_jobs)
 
         return len(new_jobs)
 
@@ -169,6 +207,29 @@ def get_actions_to_run(rap_create_request, pipeline_config):
         return rap_create_request.requested_actions
 
 
+def get_run_commands(rap_create_request, pipeline_config):
+    """
+    Returns the run commands of the requested actions and all the actions they
+    depend on, which are the only actions we might create jobs for
+    """
+    run_commands = []
+    seen = set()
+    actions = list(get_actions_to_run(rap_create_request, pipeline_config))
+    while actions:
+        action = actions.pop()
+        if action in seen:
+            continue
+        seen.add(action)
+        try:
+            action_spec = get_action_specification(pipeline_config, action)
+        except UnknownActionError:
+            # this is reported when we build the jobs
+            continue
+        run_commands.append(action_spec.run)
+        actions.extend(action_spec.needs)
+    return run_commands
+
+
 def recursively_build_jobs(jobs_by_action, rap_create_request, pipeline_config, action):
     """
     Recursively populate the `jobs_by_action` dict with jobs
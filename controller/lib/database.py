@@ -120,6 +120,13 @@ def update_where(itemclass, update_dict, **query_params):
     )
 
 
+@ensure_transaction
+def delete_where(itemclass, **query_params):
+    table = itemclass.__tablename__
+    where, params = query_params_to_sql(query_params)
+    get_connection().execute(f"DELETE FROM {escape(table)} WHERE {where}", params)
+
+
 def find_where(itemclass, **query_params):
     table = itemclass.__tablename__
     fields = dataclasses.fields(itemclass)
@@ -496,3 +496,137 @@ class Task:
         ALTER TABLE tasks ADD COLUMN attributes TEXT;
         """,
     )
+
+
+class RapCreationState(Enum):
+    PENDING = "pending"
+    SUCCEEDED = "succeeded"
+    NOTHING_TO_DO = "nothing_to_do"
+    FAILED = "failed"
+
+
+@databaseclass
+class RapCreation:
+    """
+    A RAP create request which has been accepted by the RAP API but not yet processed.
+
+    When RAP_CREATE_ASYNC is enabled, the create endpoint just records these, and the
+    jobs are created in the background by the controller service (see
+    `controller.rap_creations`). The outcome is reported by the status endpoint.
+    """
+
+    __tablename__ = "rap_creations"
+    __tableschema__ = """
+        CREATE TABLE rap_creations (
+            id TEXT,
+            backend TEXT,
+            workspace TEXT,
+            state TEXT,
+            request TEXT,
+            details TEXT,
+            job_count INT,
+            created_at INT,
+            completed_at INT,
+            PRIMARY KEY (id)
+        );
+
+        -- We only ever need to find pending creations, so keep the index small
+        CREATE INDEX idx_rap_creations__state ON rap_creations (state) WHERE state = 'pending';
+    """
+
+    migration(14, __tableschema__)
+
+    # the rap_id
+    id: str  # noqa: A003
+    backend: str
+    workspace: str
+    state: RapCreationState = RapCreationState.PENDING
+    # the validated CreateRequest, as a dict
+    request: dict = None
+    # details of the outcome, including error messages which are safe to pass on
+    # to the client
+    details: str = None
+    # number of jobs created
+    job_count: int = 0
+    # Times (stored as integer UNIX timestamps in seconds)
+    created_at: int = None
+    completed_at: int = None
+
+
+@databaseclass
+class WorkspaceLock:
+    """
+    An advisory lock on a workspace, held while creating jobs in it.
+
+    Creating jobs involves reading the current state of the workspace and then
+    inserting new jobs based on it, so concurrent creates for the same workspace
+    must be serialized. See `controller.queries.workspace_lock`.
+    """
+
+    __tablename__ = "workspace_locks"
+    __tableschema__ = """
+        CREATE TABLE workspace_locks (
+            id TEXT,
+            owner TEXT,
+            acquired_at REAL,
+            PRIMARY KEY (id)
+        )
+    """
+
+    migration(15, __tableschema__)
+
+    # backend/workspace
+    id: str  # noqa: A003
+    # random token identifying the holder of the lock
+    owner: str
+    acquired_at: float
+
+
+@databaseclass
+class ReusableActionRef:
+    """
+    The commit a reusable action tag pointed to when we last looked it up.
+
+    A null commit means the tag did not exist. See `controller.reusable_actions`.
+    """
+
+    __tablename__ = "reusable_action_refs"
+    __tableschema__ = """
+        CREATE TABLE reusable_action_refs (
+            id TEXT,
+            commit_sha TEXT,
+            checked_at INT,
+            PRIMARY KEY (id)
+        )
+    """
+
+    migration(16, __tableschema__)
+
+    # image:tag
+    id: str  # noqa: A003
+    commit_sha: str = None
+    checked_at: int = None
+
+
+@databaseclass
+class ReusableActionFile:
+    """
+    The validated action.yaml of a reusable action at a particular commit.
+    """
+
+    __tablename__ = "reusable_action_files"
+    __tableschema__ = """
+        CREATE TABLE reusable_action_files (
+            id TEXT,
+            repo_url TEXT,
+            action_file BLOB,
+            PRIMARY KEY (id)
+        )
+    """
+
+    migration(17, __tableschema__)
+
+    # the commit sha
+    id: str  # noqa: A003
+    repo_url: str
+    action_file: bytes
@@ -1,3 +1,5 @@
+import contextlib
+import logging
 import sqlite3
 import time
 from itertools import groupby
@@ -5,14 +7,26 @@ from operator import attrgetter
 
 from opentelemetry import trace
 
-from controller import tracing
-from controller.lib.database import find_one, find_where, upsert
-from controller.models import Flag, Job
+from controller import config, tracing
+from controller.lib.database import (
+    delete_where,
+    exists_where,
+    find_one,
+    find_where,
+    transaction,
+    upsert,
+)
+from controller.models import Flag, Job, WorkspaceLock, new_id
 
 
+log = logging.getLogger(__name__)
 tracer = trace.get_tracer("db")
 
 
+class WorkspaceLockTimeoutError(Exception):
+    pass
+
+
 def calculate_workspace_state(backend, workspace):
     """
     Return a list containing the most recent uncancelled job (if any) for each action in the workspace. We always
@@ -48,6 +62,50 @@ def calculate_workspace_state(backend, workspace):
     return latest_jobs
 
 
+@contextlib.contextmanager
+def workspace_lock(backend, workspace):
+    """
+    Hold an exclusive lock on a workspace for the duration of the context.
+
+    The lock is a row in the workspace_locks table, so it works across the
+    webapp's worker processes as well as threads. Locks for different workspaces
+    are independent.
+    """
+    lock_id = f"{backend}/{workspace}"
+    owner = new_id()
+    with tracer.start_as_current_span("workspace_lock") as span:
+        tracing.set_span_scope_metadata(span, backend=backend, workspace=workspace)
+        deadline = time.monotonic() + config.WORKSPACE_LOCK_TIMEOUT
+        while not acquire_workspace_lock(lock_id, owner):
+            if time.monotonic() > deadline:
+                raise WorkspaceLockTimeoutError(
+                    f"Timed out waiting for another request for workspace "
+                    f"'{workspace}' to complete, please try again"
+                )
+            time.sleep(config.WORKSPACE_LOCK_POLL_INTERVAL)
+
+    try:
+        yield
+    finally:
+        delete_where(WorkspaceLock, id=lock_id, owner=owner)
+
+
+def acquire_workspace_lock(lock_id, owner):
+    now = time.time()
+    # BEGIN IMMEDIATE ensures no one else can acquire it between our check and insert
+    with transaction():
+        if exists_where(
+            WorkspaceLock,
+            id=lock_id,
+            acquired_at__gt=now - config.WORKSPACE_LOCK_EXPIRY,
+        ):
+            return False
+        if exists_where(WorkspaceLock, id=lock_id):
+            log.warning(f"Taking over expired lock on {lock_id}")
+        upsert(WorkspaceLock(id=lock_id, owner=owner, acquired_at=now))
+    return True
+
+
 def group_by(iterable, key):
     return groupby(sorted(iterable, key=key), key=key)
 
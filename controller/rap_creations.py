@@ -0,0 +1,146 @@
+"""
+Background processing of RAP create requests.
+
+When RAP_CREATE_ASYNC is enabled, the rap/create endpoint only validates and records
+each request as a pending RapCreation. These are picked up here and the jobs are
+created by a pool of worker threads, so that slow git operations don't tie up the
+API workers. The outcome is reported by the rap/status endpoint.
+"""
+
+import dataclasses
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
+
+from common.lib.log_utils import set_log_context
+from controller import config
+from controller.create_or_update_jobs import (
+    HANDLED_CREATE_ERRORS,
+    NothingToDoError,
+    create_jobs,
+)
+from controller.lib import database
+from controller.models import RapCreation, RapCreationState
+from controller.queries import group_by
+from controller.webapp.views.validators.dataclasses import CreateRequest
+
+
+log = logging.getLogger(__name__)
+
+
+def main():  # pragma: no cover
+    with ThreadPoolExecutor(
+        max_workers=config.RAP_CREATE_WORKERS, thread_name_prefix="rapc"
+    ) as executor:
+        while True:
+            handle_pending_creations(executor)
+            time.sleep(config.RAP_CREATE_POLL_INTERVAL)
+
+
+def record_pending_creation(request_obj: CreateRequest):
+    """Record a validated create request to be processed in the background"""
+    creation = RapCreation(
+        id=request_obj.id,
+        backend=request_obj.backend,
+        workspace=request_obj.workspace,
+        state=RapCreationState.PENDING,
+        request=dataclasses.asdict(request_obj),
+        created_at=int(time.time()),
+    )
+    database.insert(creation)
+    return creation
+
+
+def retry_creation(creation, request_obj: CreateRequest):
+    """Return a failed creation to pending, to be processed again with the new
+    request, as if it had just arrived"""
+    creation.state = RapCreationState.PENDING
+    creation.request = dataclasses.asdict(request_obj)
+    creation.details = None
+    creation.job_count = 0
+    creation.created_at = int(time.time())
+    creation.completed_at = None
+    database.update(creation)
+    return creation
+
+
+def get_creation(rap_id):
+    try:
+        return database.find_one(RapCreation, id=rap_id)
+    except ValueError:
+        return None
+
+
+def handle_pending_creations(executor):
+    """Submit all pending creations to the supplied executor, and return how many
+    were submitted.
+
+    Creations for different workspaces are processed concurrently, but those for
+    the same workspace are processed in order of arrival, one at a time, as each
+    depends on the jobs created by the previous ones. We don't wait for them, so
+    that one slow workspace doesn't hold up the others; instead, workspaces which
+    are still being processed are skipped until a later call.
+    """
+    pending = database.find_where(RapCreation, state=RapCreationState.PENDING)
+    submitted = 0
+    for key, group in group_by(pending, attrgetter("backend", "workspace")):
+        with _in_flight_lock:
+            if key in _in_flight:
+                continue
+            _in_flight.add(key)
+        creations = sorted(group, key=attrgetter("created_at"))
+        executor.submit(process_rap_creations, key, creations)
+        submitted += len(creations)
+    return submitted
+
+
+# The (backend, workspace) pairs whose creations are being processed
+_in_flight = set()
+_in_flight_lock = threading.Lock()
+
+
+def process_rap_creations(key, creations):
+    try:
+        for creation in creations:
+            # It may have been processed since we found it pending, by a worker
+            # which finished after we looked, so we only go by its current state
+            pending = database.find_where(
+                RapCreation, id=creation.id, state=RapCreationState.PENDING
+            )
+            if pending:
+                process_rap_creation(pending[0])
+    except Exception:
+        log.exception(f"Error processing creations for {key}")
+    finally:
+        with _in_flight_lock:
+            _in_flight.discard(key)
+
+
+def process_rap_creation(creation):
+    request_obj = CreateRequest(**creation.request)
+    with set_log_context(rap_id=creation.id):
+        log.info(f"Handling new rap_id:\n{creation.id}")
+        try:
+            job_count = create_jobs(request_obj)
+        except NothingToDoError as e:
+            log.info("Nothing to do for rap_id %s:\n%s", creation.id, e)
+            creation.state = RapCreationState.NOTHING_TO_DO
+            creation.details = str(e)
+        except HANDLED_CREATE_ERRORS as e:
+            log.error("Failed to create jobs for rap_id %s:\n%s", creation.id, e)
+            creation.state = RapCreationState.FAILED
+            creation.details = str(e)
+        except Exception:
+            log.exception("Uncaught error while creating jobs")
+            creation.state = RapCreationState.FAILED
+            creation.details = "Unknown error"
+        else:
+            log.info(f"Created {job_count} new jobs")
+            creation.state = RapCreationState.SUCCEEDED
+            creation.details = f"Jobs created for rap_id '{creation.id}'"
+            creation.job_count = job_count
+
+    creation.completed_at = int(time.time())
+    database.update(creation)
@@ -1,7 +1,10 @@
 import dataclasses
 import shlex
 import textwrap
+import time
+from collections import Counter
 
+from opentelemetry import trace
 from pipeline.models import is_database_action
 
 from common.lib import git
@@ -11,7 +14,12 @@ from common.lib.github_validators import (
     validate_repo_url,
 )
 from controller import config
+from controller.lib.database import find_where, upsert
 from controller.lib.yaml_utils import YAMLError, parse_yaml
+from controller.models import ReusableActionFile, ReusableActionRef
+
+
+tracer = trace.get_tracer("reusable_actions")
 
 
 class ReusableActionError(Exception):
@@ -76,7 +84,35 @@ class ReusableAction:
         return action_run_args + run_args[1:]
 
 
-def resolve_reusable_action_references(jobs):
+def prefetch_reusable_actions(run_commands):
+    """
+    Fetch the reusable actions invoked by any of `run_commands`, so that they can
+    later be resolved without talking to GitHub.
+
+    Errors are ignored here; they are raised when resolving the jobs which actually
+    use the action.
+
+    Args:
+        run_commands: iterable of action run commands as strings
+
+    Returns:
+        dict of fetched reusable actions, to pass to
+        `resolve_reusable_action_references`
+    """
+    reusable_action_cache = dict()
+    cache_stats = Counter()
+    with tracer.start_as_current_span("prefetch_reusable_actions") as span:
+        for run_command in run_commands:
+            try:
+                handle_reusable_action(run_command, reusable_action_cache, cache_stats)
+            except ReusableActionError:
+                pass
+        for key, count in cache_stats.items():
+            span.set_attribute(f"reusable_actions.{key}", count)
+    return reusable_action_cache
+
+
+def resolve_reusable_action_references(jobs, reusable_action_cache=None):
     """
     Accepts a list of Job instances, identifies any which invoke reusable
     actions and modifies them appropriately which means:
@@ -86,6 +122,8 @@ def resolve_reusable_action_references(jobs):
 
     Args:
         jobs: list of Job instances
+        reusable_action_cache: optional dict of already fetched reusable actions,
+            as returned by `prefetch_reusable_actions`
 
     Returns:
         None - it modifies its arguments in place
@@ -93,23 +131,31 @@ def resolve_reusable_action_references(jobs):
     Raises:
         ReusableActionError
     """
-    reusable_action_cache = dict()
-    for job in jobs:
+    if reusable_action_cache is None:
+        reusable_action_cache = dict()
+    cache_stats = Counter()
+    with tracer.start_as_current_span("resolve_reusable_action_references") as span:
         try:
-            run_command, repo_url, commit = handle_reusable_action(
-                job.run_command, reusable_action_cache
-            )
-        except ReusableActionError as e:
-            # Annotate the exception with the context of the action in which it
-            # occured
-            context = f"{job.action}: {job.run_command.split()[0]}"
-            raise ReusableActionError(f"in '{context}' {e}") from e
-        job.run_command = run_command
-        job.action_repo_url = repo_url
-        job.action_commit = commit
-
-
-def handle_reusable_action(run_command, reusable_action_cache=None):
+            for job in jobs:
+                try:
+                    run_command, repo_url, commit = handle_reusable_action(
+                        job.run_command, reusable_action_cache, cache_stats
+                    )
+                except ReusableActionError as e:
+                    # Annotate the exception with the context of the action in which
+                    # it occured
+                    context = f"{job.action}: {job.run_command.split()[0]}"
+                    raise ReusableActionError(f"in '{context}' {e}") from e
+                job.run_command = run_command
+                job.action_repo_url = repo_url
+                job.action_commit = commit
+        finally:
+            # Record the cache hits/misses so we can track hit rates
+            for key, count in cache_stats.items():
+                span.set_attribute(f"reusable_actions.{key}", count)
+
+
+def handle_reusable_action(run_command, reusable_action_cache=None, cache_stats=None):
     """
     If `run_command` refers to a reusable action then rewrite it appropriately
     and return it along with the repo_url and commit of the reusable action.
@@ -117,6 +163,8 @@ def handle_reusable_action(run_command, reusable_action_cache=None):
 
     Args:
         run_command: Action's run command as a string
+        reusable_action_cache: optional dict of already fetched reusable actions
+        cache_stats: optional Counter in which to record cache hits and misses
 
     Returns: tuple consisting of
         - rewritten_run_command: string
@@ -139,7 +187,7 @@ def handle_reusable_action(run_command, reusable_action_cache=None):
         reusable_action = reusable_action_cache[(image, tag)]
     except KeyError:
         # First time seeing this reusable action
-        reusable_action = fetch_reusable_action(image, tag)
+        reusable_action = fetch_reusable_action(image, tag, cache_stats)
         reusable_action_cache[(image, tag)] = reusable_action
 
     new_run_args = reusable_action.rewrite_run_args(run_args)
@@ -147,13 +195,17 @@ def handle_reusable_action(run_command, reusable_action_cache=None):
     return new_run_command, reusable_action.repo_url, reusable_action.commit
 
 
-def fetch_reusable_action(image, tag):
+def fetch_reusable_action(image, tag, cache_stats=None):
     """
     Fetch all metadata from git needed to apply a reusable action
 
+    Both the commit a tag points to and the action file at that commit are cached
+    in the database, see `get_commit_for_tag` and `get_action_file`.
+
     Args:
         image: The name of the reusable action
         tag: The specified version of the reusable action
+        cache_stats: optional Counter in which to record cache hits and misses
 
     Returns:
         ReusableAction object, wrapping the repo_url, commit and the contents
@@ -168,6 +220,39 @@ def fetch_reusable_action(image, tag):
     except GithubValidationError:
         raise ReusableActionError(f"'{image}' contains invalid characters")
 
+    if cache_stats is None:
+        cache_stats = Counter()
+    commit = get_commit_for_tag(repo_url, image, tag, cache_stats)
+    action_file = get_action_file(repo_url, tag, commit, cache_stats)
+    return ReusableAction(repo_url=repo_url, commit=commit, action_file=action_file)
+
+
+def get_commit_for_tag(repo_url, image, tag, cache_stats):
+    """
+    Return the commit `tag` points to in the reusable action's repo
+
+    Tags can be moved, so a cached commit is only used for REUSABLE_ACTION_TAG_TTL
+    seconds. Unknown tags are cached for REUSABLE_ACTION_UNKNOWN_TAG_TTL seconds so
+    that repeated requests for a mistyped tag don't each hit the remote.
+    """
+    ref_id = f"{image}:{tag}"
+    unknown_tag_error = ReusableActionError(
+        f"'{tag}' is not a tag listed in {repo_url}/tags"
+    )
+    now = int(time.time())
+
+    cached = find_where(ReusableActionRef, id=ref_id)
+    if cached:
+        ref = cached[0]
+        if ref.commit_sha is None:
+            if ref.checked_at > now - config.REUSABLE_ACTION_UNKNOWN_TAG_TTL:
+                cache_stats["unknown_tag_cache_hits"] += 1
+                raise unknown_tag_error
+        elif ref.checked_at > now - config.REUSABLE_ACTION_TAG_TTL:
+            cache_stats["tag_cache_hits"] += 1
+            return ref.commit_sha
+    cache_stats["tag_cache_misses"] += 1
+
     try:
         # If there's a problem, then it relates to the repository. Maybe the study
         # developer made an error; maybe the reusable action developer made an error.
@@ -179,7 +264,26 @@ def fetch_reusable_action(image, tag):
             f"https://actions.opensafely.org"
         )
     except git.GitUnknownRefError:
-        raise ReusableActionError(f"'{tag}' is not a tag listed in {repo_url}/tags")
+        upsert(ReusableActionRef(id=ref_id, commit_sha=None, checked_at=now))
+        raise unknown_tag_error
+
+    upsert(ReusableActionRef(id=ref_id, commit_sha=commit, checked_at=now))
+    return commit
+
+
+def get_action_file(repo_url, tag, commit, cache_stats):
+    """
+    Return the contents of the action.yaml at `commit`, having checked that the
+    commit is approved for use
+
+    The result for a commit never changes, so once validated it is cached
+    permanently.
+    """
+    cached = find_where(ReusableActionFile, id=commit, repo_url=repo_url)
+    if cached:
+        cache_stats["action_file_cache_hits"] += 1
+        return cached[0].action_file
+    cache_stats["action_file_cache_misses"] += 1
 
     # We're planning to give write access to specific external collaborators on
     # specific action repos, but we want to retain final control over what gets
@@ -213,4 +317,5 @@ def fetch_reusable_action(image, tag):
         # away the original exception is fine
         raise ReusableActionError(f"error reading '{commit}' from {repo_url}")
 
-    return ReusableAction(repo_url=repo_url, commit=commit, action_file=action_file)
+    upsert(ReusableActionFile(id=commit, repo_url=repo_url, action_file=action_file))
+    return action_file
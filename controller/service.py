@@ -11,6 +11,7 @@ from common.lib.service_utils import ThreadWrapper
 from controller import config
 from controller.lib.database import ensure_valid_db
 from controller.main import main as controller_main
+from controller.rap_creations import main as rap_creations_main
 from controller.ticks import main as ticks_main
 
 
@@ -23,7 +24,7 @@ start_thread = ThreadWrapper(log)
 def main():
     """
     Run the controller loop in the main thread and the tick loop in a background
-    thread.
+    thread, along with the RAP creation loop if RAP creation is asynchronous.
     """
     # note: thread name appears in log output, so its nice to keep them all the same length
     threading.current_thread().name = "ctrl"
@@ -38,6 +39,8 @@ def main():
         log.info("controller.service started")
 
         start_thread(ticks_main, "tick", config.TICK_POLL_INTERVAL)
+        if config.RAP_CREATE_ASYNC:
+            start_thread(rap_creations_main, "rapc", config.RAP_CREATE_POLL_INTERVAL)
         controller_main()
     except KeyboardInterrupt:
         log.info("controller.service stopped")
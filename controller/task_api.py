@@ -1,5 +1,7 @@
+import hashlib
 import time
 
+from controller import config
 from controller.lib import database
 from controller.models import Task, TaskType
 from controller.queries import get_flag_value, set_flag
@@ -44,6 +46,35 @@ def get_active_tasks(backend: str) -> list[Task]:
     return active_tasks
 
 
+def get_active_tasks_version(task_ids) -> str:
+    """Return an opaque version string for a set of active task ids.
+
+    Tasks are immutable apart from being deactivated, so the set of active ids
+    changes whenever there is something new for the agent to do.
+    """
+    digest = hashlib.sha1(usedforsecurity=False)
+    for task_id in sorted(task_ids):
+        digest.update(task_id.encode())
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def wait_for_active_tasks_change(backend: str, version: str, timeout: float):
+    """Block until the active tasks for the backend no longer match `version`.
+
+    This lets the tasks endpoint hold an agent's request open until there is
+    something new to tell it, rather than the agent polling us every loop. We
+    return after `timeout` seconds regardless.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        task_ids = database.select_values(Task, "id", active=True, backend=backend)
+        if get_active_tasks_version(task_ids) != version:
+            return
+        remaining = max(deadline - time.monotonic(), 0)
+        time.sleep(min(config.TASK_LONG_POLL_CHECK_INTERVAL, remaining))
+
+
 def handle_task_update(*, task_id, stage, results, complete, timestamp_ns=None):
     # This is the function we expect to eventually be invoked via an HTTP API call.
     # This currently just updates the task table, and lets the main controller loop
@@ -5,23 +5,25 @@ from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_GET, require_POST
 from opentelemetry import trace
-from pipeline import ProjectValidationError
 
-from common.lib.git import GitError
-from common.lib.github_validators import GithubValidationError
 from common.tracing import duration_ms_as_span_attr, set_span_attributes
+from controller import config
 from controller.create_or_update_jobs import (
+    HANDLED_CREATE_ERRORS,
     NothingToDoError,
-    RapCreateRequestError,
     create_jobs,
     related_jobs_exist,
     set_cancelled_flag_for_actions,
 )
 from controller.lib.database import exists_where, find_where, select_values
 from controller.main import get_task_for_job
-from controller.models import Job, State
+from controller.models import Job, RapCreation, RapCreationState, State
 from controller.queries import get_current_flags
-from controller.reusable_actions import ReusableActionError
+from controller.rap_creations import (
+    get_creation,
+    record_pending_creation,
+    retry_creation,
+)
 from controller.webapp.api_spec.utils import api_spec_json
 from controller.webapp.views.auth.rap import (
     get_backends_for_client_token,
@@ -251,27 +253,7 @@ def create(request, *, token_backends, request_obj: CreateRequest):
         # All jobs for a single rap_id have the same repo_url, workspace and commit, so we
         # only need to check the first one
         job = related_jobs[0]
-        job_data = {job.repo_url, job.workspace, job.commit}
-        if job_data != {
-            request_obj.repo_url,
-            request_obj.workspace,
-            request_obj.commit,
-        }:
-            log.error(
-                (
-                    "Received mismatched create request data for existing rap_id %s\n"
-                    "repo_url: %s; received %s\n"
-                    "commit: %s; received %s\n"
-                    "workspace: %s; received %s"
-                ),
-                request_obj.id,
-                job.repo_url,
-                request_obj.repo_url,
-                job.commit,
-                request_obj.commit,
-                job.workspace,
-                request_obj.workspace,
-            )
+        if inconsistent_request_data(request_obj, job):
             return JsonResponse(
                 {
                     "error": "Inconsistent request data",
@@ -292,6 +274,9 @@ def create(request, *, token_backends, request_obj: CreateRequest):
             status=200,
         )
 
+    if config.RAP_CREATE_ASYNC:
+        return accept_create_request(request_obj)
+
     try:
         log.info(f"Handling new rap_id:\n{request_obj.id}")
 
@@ -326,13 +311,7 @@ def create(request, *, token_backends, request_obj: CreateRequest):
             },
             status=200,
         )
-    except (
-        GitError,
-        GithubValidationError,
-        ProjectValidationError,
-        ReusableActionError,
-        RapCreateRequestError,
-    ) as e:
+    except HANDLED_CREATE_ERRORS as e:
         log.error("Failed to create jobs for rap_id %s:\n%s", request_obj.id, e)
         # Note: we return the error in the response for these specific handled errors, as
         # this is likely to contain useful information for the client to display to the
@@ -357,6 +336,84 @@ def create(request, *, token_backends, request_obj: CreateRequest):
         )
 
 
+def inconsistent_request_data(request_obj, existing):
+    """
+    Check that the repo/commit/workspace of an existing job or pending creation for
+    a rap_id match those of the request
+    """
+    existing_data = {existing.repo_url, existing.workspace, existing.commit}
+    if existing_data == {
+        request_obj.repo_url,
+        request_obj.workspace,
+        request_obj.commit,
+    }:
+        return False
+
+    log.error(
+        (
+            "Received mismatched create request data for existing rap_id %s\n"
+            "repo_url: %s; received %s\n"
+            "commit: %s; received %s\n"
+            "workspace: %s; received %s"
+        ),
+        request_obj.id,
+        existing.repo_url,
+        request_obj.repo_url,
+        existing.commit,
+        request_obj.commit,
+        existing.workspace,
+        request_obj.workspace,
+    )
+    return True
+
+
+def accept_create_request(request_obj):
+    """
+    Record a create request to be processed in the background, and return a 202.
+
+    The outcome can be found via the status endpoint.
+    """
+    if creation := get_creation(request_obj.id):
+        existing = CreateRequest(**creation.request)
+        if inconsistent_request_data(request_obj, existing):
+            return JsonResponse(
+                {
+                    "error": "Inconsistent request data",
+                    "details": f"A create request for rap_id '{request_obj.id}' has already been accepted which is inconsistent with request data",
+                },
+                status=400,
+            )
+        if creation.state == RapCreationState.FAILED:
+            # the failure may have been transient, so we try again, as we would
+            # if we were creating the jobs synchronously
+            log.info(f"Retrying failed rap_id:\n{request_obj.id}")
+            retry_creation(creation, request_obj)
+        else:
+            log.info(f"Ignoring already accepted rap_id:\n{request_obj.id}")
+    else:
+        log.info(f"Accepted new rap_id:\n{request_obj.id}")
+        record_pending_creation(request_obj)
+
+    return JsonResponse(
+        {
+            "result": "Accepted",
+            "details": f"Jobs will be created for rap_id '{request_obj.id}'",
+            "rap_id": request_obj.id,
+            "count": 0,
+        },
+        status=202,
+    )
+
+
+def creation_to_api_format(creation):
+    return {
+        "rap_id": creation.id,
+        "status": creation.state.value,
+        "details": creation.details or "",
+        "count": creation.job_count,
+    }
+
+
 def job_to_api_format(job):
     """
     Convert our internal representation of a Job into the API format
@@ -431,6 +488,17 @@ def status(request, *, token_backends, request_obj: StatusRequest):
             )
         ) - set(request_obj.rap_ids)
 
+    # RAPs which were accepted for creation in the background, but have no jobs
+    # (yet), are reported separately, with the outcome of their creation.
+    creations = []
+    if unrecognised_rap_ids:
+        creations = find_where(
+            RapCreation,
+            id__in=list(unrecognised_rap_ids),
+            backend__in=token_backends,
+        )
+        unrecognised_rap_ids -= {creation.id for creation in creations}
+
     set_span_attributes(
         span,
         dict(
@@ -440,7 +508,9 @@ def status(request, *, token_backends, request_obj: StatusRequest):
         ),
     )
 
-    return JsonResponse(
-        {"jobs": jobs_data, "unrecognised_rap_ids": list(unrecognised_rap_ids)},
-        status=200,
-    )
+    response = {"jobs": jobs_data, "unrecognised_rap_ids": list(unrecognised_rap_ids)}
+    if creations:
+        response["rap_creations"] = [
+            creation_to_api_format(creation) for creation in creations
+        ]
+    return JsonResponse(response, status=200)
@@ -7,8 +7,14 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 
 from common.schema import AgentTask
+from controller import config
 from controller.queries import set_flag
-from controller.task_api import get_active_tasks, handle_task_update
+from controller.task_api import (
+    get_active_tasks,
+    get_active_tasks_version,
+    handle_task_update,
+    wait_for_active_tasks_change,
+)
 from controller.webapp.views.auth.task import require_backend_authentication
 from controller.webapp.views.tracing import trace_attributes
 
@@ -24,13 +30,37 @@ def index(request):
 
 @require_backend_authentication
 def active_tasks(request, backend):
+    """Return the active tasks for a backend, along with their version.
+
+    If the agent sends back the version it last saw along with a `wait` time in
+    seconds, we hold the request open until the active tasks change or the wait
+    expires, so that idle agents can find out about new tasks promptly without
+    polling.
+    """
     trace_attributes(backend=backend)
-    active_tasks = [
-        AgentTask.from_task(task).asdict() for task in get_active_tasks(backend)
-    ]
+    try:
+        wait = min(float(request.GET.get("wait", 0)), config.TASK_LONG_POLL_MAX_WAIT)
+    except ValueError:
+        return JsonResponse(
+            {"error": "Invalid wait parameter", "details": request.GET["wait"]},
+            status=400,
+        )
+
+    version = request.GET.get("version")
+    if version and wait > 0:
+        # register that this backend has been in contact before we start waiting
+        set_flag("last-seen-at", value=timezone.now().isoformat(), backend=backend)
+        wait_for_active_tasks_change(backend, version, wait)
+
+    tasks = get_active_tasks(backend)
     # register that this backend has been in contact
     set_flag("last-seen-at", value=timezone.now().isoformat(), backend=backend)
-    return JsonResponse({"tasks": active_tasks})
+    return JsonResponse(
+        {
+            "tasks": [AgentTask.from_task(task).asdict() for task in tasks],
+            "version": get_active_tasks_version(task.id for task in tasks),
+        }
+    )
 
 
 @require_backend_authentication
@@ -1,6 +1,6 @@
 import os
 
-from common import tracing
+from common import config, tracing
 
 
 # Where to log to (stdout and stderr)
@@ -11,8 +11,9 @@ errorlog = "-"
 # # http://docs.gunicorn.org/en/stable/settings.html#logconfig-dict
 # logconfig_dict = logging_config_dict
 
-# workers
-workers = 5
+# workers, plus one for each backend, as an agent long-polling for its tasks holds one
+# for up to TASK_LONG_POLL_MAX_WAIT seconds at a time
+workers = 5 + len(config.BACKENDS)
 
 # listen
 bind = "0.0.0.0:8000"
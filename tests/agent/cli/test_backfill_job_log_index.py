@@ -0,0 +1,15 @@
+from agent import config
+from agent.cli import backfill_job_log_index
+from agent.executors import job_log_index
+
+
+def test_backfill_job_log_index(tmp_work_dir, capsys):
+    log_dir = config.JOB_LOG_DIR / "2020-01/os-job-abcdef"
+    log_dir.mkdir(parents=True)
+    (log_dir / "metadata.json").write_text("{}")
+
+    backfill_job_log_index.run([])
+
+    assert capsys.readouterr().out == "Indexed 1 job log directories\n"
+    assert job_log_index.is_complete()
+    assert job_log_index.lookup("abcdef") == log_dir
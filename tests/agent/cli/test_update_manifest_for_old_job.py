@@ -228,6 +228,49 @@ def test_update_manifest_does_not_overwrite_manifest_outputs(
     assert "out_of_date_action" not in output_metadata
 
 
+def test_update_manifest_keeps_concurrent_updates(
+    job_definition, tmp_work_dir, monkeypatch
+):
+    job_definition.action = "generate_dataset"
+    job_definition.output_spec = {
+        "output/output.csv": "moderately_sensitive",
+    }
+
+    level4_dir = local.get_medium_privacy_workspace(job_definition.workspace)
+    (level4_dir / "output").mkdir(parents=True)
+    (level4_dir / "output/output.csv").write_text("foo,bar\n1,2\n")
+    write_mock_manifest_file(job_definition, level4_dir)
+    write_log_file(job_definition)
+
+    get_workspace_action_names = update_manifest_for_old_job.get_workspace_action_names
+
+    def finalize_during_update(pseudo_job_definition):
+        # another job finishes while we're looking up the workspace's actions,
+        # so the manifest must not be locked
+        with local.open_manifest_store(job_definition.workspace) as manifest:
+            manifest.update_outputs_and_actions(
+                "other", {"output/other.csv": {"action": "other"}}, None
+            )
+        return get_workspace_action_names(pseudo_job_definition)
+
+    monkeypatch.setattr(
+        update_manifest_for_old_job,
+        "get_workspace_action_names",
+        finalize_during_update,
+    )
+
+    update_manifest_for_old_job.run(
+        [job_definition.workspace, job_definition.id, "main"]
+    )
+
+    updated_manifest = local.read_manifest_file(level4_dir, job_definition)
+    assert list(updated_manifest["outputs"]) == [
+        "dummy.txt",
+        "output/other.csv",
+        "output/output.csv",
+    ]
+
+
 def test_update_manifest_no_matching_manifest(tmp_work_dir):
     # try to update the manifest with this job
     with pytest.raises(AssertionError, match="Could not find existing manifest file"):
@@ -1,5 +1,11 @@
+import tempfile
+from pathlib import Path
+
 import pytest
 
+from agent.lib import docker_api
+from tests.agent.stubs import StubDockerDaemon
+
 
 @pytest.fixture(autouse=True)
 def test_backend_api_tokens(monkeypatch):
@@ -9,3 +15,17 @@ def test_backend_api_tokens(monkeypatch):
     """
     monkeypatch.setattr("agent.config.TASK_API_TOKEN", "test_token")
     monkeypatch.setattr("controller.config.JOB_SERVER_TOKENS", {"test": "test_token"})
+
+
+@pytest.fixture
+def docker_daemon(monkeypatch):
+    """Serve the Docker Engine API from a StubDockerDaemon"""
+    # unix socket paths are limited to ~100 characters, so we can't use tmp_path
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        daemon = StubDockerDaemon(Path(tmp_dir) / "docker.sock")
+        monkeypatch.setattr("agent.config.DOCKER_API_SOCKET", daemon.socket_path)
+        daemon.start()
+        yield daemon
+        if conn := getattr(docker_api.CONNECTIONS, "conn", None):
+            conn.close()
+        daemon.stop()
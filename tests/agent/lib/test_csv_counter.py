@@ -0,0 +1,122 @@
+import csv
+import io
+import time
+
+import pytest
+
+from agent.lib import csv_counter
+
+
+def dictreader_counts(contents):
+    """The counts we used to get from csv.DictReader"""
+    reader = csv.DictReader(io.StringIO(contents.decode("utf-8"), newline=None))
+    headers = reader.fieldnames
+    first_row = next(reader, None)
+    if first_row is None:
+        return headers, 0, 0
+    return headers, sum(1 for _ in reader) + 1, len(first_row)
+
+
+def count(contents, **kwargs):
+    return csv_counter.count_csv(io.BytesIO(contents), **kwargs)
+
+
+@pytest.mark.parametrize(
+    "contents",
+    [
+        b"",
+        b"a,b\n",
+        b"a,b\n1,2\n3,4\n",
+        b"a,b\n1,2\n3,4",
+        b"a,b\r\n1,2\r\n3,4\r\n",
+        b"a,b\r1,2\r3,4\r",
+        b"a,b\n\n1,2\n\n\n3,4\n\n",
+        b"\na,b\n1,2\n",
+        b'a,b\n"1\n2",3\n"x ""quoted""\n",y\n',
+        b'a,b\n1"2,3\n4,5\n',
+        b'a,b\n"1"2\n3,4\n',
+        b'a,b\n1,"2\n',
+        b"a,b,c\n1,2\n",
+        b"a,b\n1,2,3,4\n",
+        b'"a\nb",c\n1,2\n',
+        b'a,b\n"1\n2\n3",4\n',
+    ],
+)
+def test_count_csv_matches_dictreader(contents):
+    expected = dictreader_counts(contents)
+    # small chunks, so that records and line endings are split across reads
+    for chunk_size in (1, 2, 5, csv_counter.CHUNK_SIZE):
+        counts = count(contents, chunk_size=chunk_size)
+        assert (counts.headers, counts.rows, counts.cols) == expected
+        assert not counts.truncated
+
+
+def test_count_csv():
+    counts = count(b"a,b,c\n" + b"1,2,3\n" * 1000)
+
+    assert counts == csv_counter.CsvCounts(headers=["a", "b", "c"], rows=1000, cols=3)
+
+
+def test_count_csv_max_rows():
+    counts = count(b"a,b\n" + b"1,2\n" * 1000, max_rows=10, chunk_size=20)
+
+    assert counts.truncated
+    assert 10 < counts.rows < 1000
+    assert counts.headers == ["a", "b"]
+
+
+def test_count_csv_max_rows_not_exceeded():
+    counts = count(b"a,b\n" + b"1,2\n" * 10, max_rows=10, chunk_size=20)
+
+    assert counts.rows == 10
+    assert not counts.truncated
+
+
+def test_count_csv_max_rows_exceeded_at_end_of_file():
+    # we only find out that there are too many rows on the last read
+    counts = count(b"a,b\n" + b"1,2\n" * 11, max_rows=10)
+
+    assert counts.rows == 11
+    assert not counts.truncated
+
+
+def test_count_csv_invalid_header():
+    with pytest.raises(UnicodeDecodeError):
+        count(b"\xff\xfe,b\n1,2\n")
+
+
+@pytest.mark.benchmark
+def test_count_csv_benchmark(tmp_path, capsys):
+    """Compare counting a 10M row file with parsing it with csv.DictReader, as we
+    used to"""
+    path = tmp_path / "big.csv"
+    with path.open("wb") as f:
+        f.write(b"patient,date,value,category\n")
+        row = b'12345,2024-01-01,3.14159,"some, category"\n'
+        f.write(row * 10_000_000)
+
+    start = time.perf_counter()
+    with path.open("rb") as f:
+        counts = csv_counter.count_csv(f)
+    counter_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with path.open() as f:
+        reader = csv.DictReader(f)
+        first_row = next(reader)
+        rows = sum(1 for _ in reader) + 1
+    dictreader_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with path.open("rb") as f:
+        limited = csv_counter.count_csv(f, max_rows=5000)
+    limited_seconds = time.perf_counter() - start
+
+    assert counts.rows == rows == 10_000_000
+    assert counts.cols == len(first_row) == 4
+    assert limited.truncated
+    with capsys.disabled():
+        print(
+            f"\ncount_csv: {counter_seconds:.2f}s, DictReader: {dictreader_seconds:.2f}s, "
+            f"count_csv with limit: {limited_seconds:.3f}s for 10,000,000 rows"
+        )
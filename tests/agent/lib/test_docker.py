@@ -3,6 +3,7 @@ import subprocess
 import pytest
 
 from agent.lib import docker
+from tests.factories import ensure_docker_images_present
 
 
 def idempotant_manifest(image_ref):
@@ -196,3 +197,31 @@ def test_ensure_docker_sha_present_old_image_doesnot_update_tag(remove_current_l
     image_metadata = idempotant_manifest(proxy_image_with_new_sha)
     assert idempotant_manifest(proxy_image_with_label) == image_metadata
     assert idempotant_manifest(registry_image_with_label) == image_metadata
+
+
+@pytest.mark.needs_docker
+def test_api_matches_cli(docker_cleanup, monkeypatch):
+    ensure_docker_images_present("busybox")
+    image = "ghcr.io/opensafely-core/busybox:latest"
+    docker.run("os-job-api-test", [image, "sleep", "60"])
+
+    def inspect_all():
+        return (
+            docker.container_inspect("os-job-api-test"),
+            docker.container_inspect("os-job-api-test", "State.Running"),
+            docker.container_exists("os-job-api-test"),
+            docker.container_inspect("os-job-missing", none_if_not_exists=True),
+            docker.image_inspect(image),
+            docker.image_inspect("missing-image"),
+            docker.image_exists_locally(image),
+        )
+
+    from_api = inspect_all()
+    monkeypatch.setattr("agent.config.DOCKER_API_SOCKET", "")
+    assert inspect_all() == from_api
+
+    docker.kill("os-job-api-test")
+    docker.kill("os-job-api-test")
+    docker.delete_container("os-job-api-test")
+    docker.delete_container("os-job-api-test")
+    assert not docker.container_exists("os-job-api-test")
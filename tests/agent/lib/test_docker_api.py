@@ -0,0 +1,221 @@
+import json
+import os
+import subprocess
+import time
+import urllib.parse
+
+import pytest
+
+from agent.lib import docker, docker_api
+
+
+CONTAINER = {
+    "Id": "abc123",
+    "Name": "/os-job-1234",
+    "State": {"Status": "running", "Running": True, "ExitCode": 0},
+    "Config": {"Labels": {"job-runner": ""}, "Env": ["FOO=bar"] * 50},
+}
+
+
+@pytest.fixture
+def cli(monkeypatch):
+    """Record any calls which fall back to the docker CLI"""
+    calls = []
+
+    def run(args, **kwargs):
+        calls.append(args)
+        return subprocess.CompletedProcess(args, 0, stdout=b'"from-cli"')
+
+    monkeypatch.setattr(docker, "docker", run)
+    return calls
+
+
+def test_container_inspect(docker_daemon, cli):
+    docker_daemon.add_response("GET", "/containers/os-job-1234/json", body=CONTAINER)
+
+    assert docker.container_inspect("os-job-1234") == CONTAINER
+    assert docker.container_inspect("os-job-1234", "State.ExitCode") == 0
+    assert docker.container_inspect("os-job-1234", "State.Missing.Key") is None
+    assert docker.container_exists("os-job-1234")
+    assert cli == []
+
+
+def test_container_inspect_no_such_container(docker_daemon, cli):
+    assert docker.container_inspect("os-job-1234", none_if_not_exists=True) == {}
+    assert not docker.container_exists("os-job-1234")
+    assert cli == []
+
+    # the CLI reports the error
+    assert docker.container_inspect("os-job-1234") == "from-cli"
+    assert cli[0][:2] == ["container", "inspect"]
+
+
+def test_container_inspect_timeout(docker_daemon, cli):
+    docker_daemon.add_response(
+        "GET", "/containers/os-job-1234/json", body=CONTAINER, delay=0.5
+    )
+
+    with pytest.raises(docker.DockerTimeoutError):
+        docker.container_inspect("os-job-1234", timeout=0.1)
+
+
+def test_image_inspect(docker_daemon, cli):
+    image = "ghcr.io/opensafely-core/busybox:latest"
+    docker_daemon.add_response("GET", f"/images/{image}/json", body={"Id": "sha"})
+
+    assert docker.image_inspect(image) == {"Id": "sha"}
+    assert docker.image_exists_locally(image)
+    assert docker.image_inspect("missing") == {}
+    assert not docker.image_exists_locally("missing")
+    assert cli == []
+
+
+def test_kill_and_delete_container(docker_daemon, cli):
+    docker_daemon.add_response("POST", "/containers/running/kill", 204)
+    docker_daemon.add_response("POST", "/containers/stopped/kill", 409)
+    docker_daemon.add_response("DELETE", "/containers/running?force=1", 204)
+
+    docker.kill("running")
+    docker.kill("stopped")
+    docker.kill("removed")
+    docker.delete_container("running")
+    docker.delete_container("removed")
+
+    assert docker_daemon.requests == [
+        ("POST", "/containers/running/kill"),
+        ("POST", "/containers/stopped/kill"),
+        ("POST", "/containers/removed/kill"),
+        ("DELETE", "/containers/running?force=1"),
+        ("DELETE", "/containers/removed?force=1"),
+    ]
+    assert cli == []
+
+
+def test_unexpected_status_falls_back_to_cli(docker_daemon, cli):
+    docker_daemon.add_response("POST", "/containers/os-job-1234/kill", 500)
+
+    docker.kill("os-job-1234")
+
+    assert cli == [["container", "kill", "os-job-1234"]]
+
+
+def test_no_daemon_falls_back_to_cli(tmp_path, monkeypatch, cli):
+    monkeypatch.setattr("agent.config.DOCKER_API_SOCKET", str(tmp_path / "none.sock"))
+
+    assert docker.container_inspect("os-job-1234") == "from-cli"
+
+    monkeypatch.setattr("agent.config.DOCKER_API_SOCKET", "")
+    with pytest.raises(docker_api.DockerAPIUnavailable):
+        docker_api.request("GET", "/_ping")
+
+
+def test_request_keeps_connection_alive(docker_daemon):
+    docker_daemon.add_response("GET", "/_ping", body="OK")
+
+    for _ in range(5):
+        assert docker_api.request("GET", "/_ping") == (200, b'"OK"')
+
+    assert docker_daemon.connections == 1
+
+
+def test_request_reconnects_if_connection_closed(docker_daemon):
+    docker_daemon.add_response("GET", "/_ping", body="OK", close=True)
+
+    for _ in range(3):
+        assert docker_api.request("GET", "/_ping") == (200, b'"OK"')
+
+    assert docker_daemon.connections == 3
+
+
+@pytest.mark.benchmark
+def test_status_benchmark(docker_daemon, tmp_path, monkeypatch, capsys):
+    """Compare the cost of inspecting a job's container for its status with the
+    API against with a stand-in docker CLI, which just prints the same output"""
+    docker_daemon.add_response("GET", "/containers/os-job-1234/json", body=CONTAINER)
+    output = tmp_path / "inspect.json"
+    output.write_text(json.dumps(CONTAINER))
+    fake_cli = tmp_path / "bin" / "docker"
+    fake_cli.parent.mkdir()
+    fake_cli.write_text(f"#!/bin/sh\ncat {output}\n")
+    fake_cli.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{fake_cli.parent}:{os.environ['PATH']}")
+    calls = 200
+
+    start = time.perf_counter()
+    for _ in range(calls):
+        assert docker.container_inspect("os-job-1234", none_if_not_exists=True)
+    api_seconds = (time.perf_counter() - start) / calls
+
+    monkeypatch.setattr("agent.config.DOCKER_API_SOCKET", "")
+    start = time.perf_counter()
+    for _ in range(calls):
+        assert docker.container_inspect("os-job-1234", none_if_not_exists=True)
+    cli_seconds = (time.perf_counter() - start) / calls
+
+    with capsys.disabled():
+        print(
+            f"\ncontainer_inspect: api {api_seconds * 1000:.3f}ms, "
+            f"cli {cli_seconds * 1000:.3f}ms per call"
+        )
+
+
+EVENTS_PATH = "/events?" + urllib.parse.urlencode(
+    {
+        "filters": json.dumps(
+            {"type": ["container"], "label": ["test-label"], "event": ["die"]}
+        )
+    }
+)
+
+EVENTS = [
+    {"Type": "container", "Action": "die", "Actor": {"ID": "abc", "Attributes": {}}},
+    {"Type": "container", "Action": "die", "Actor": {"ID": "def", "Attributes": {}}},
+]
+
+
+def test_container_events(docker_daemon):
+    docker_daemon.add_response(
+        "GET",
+        EVENTS_PATH,
+        body=b"".join(json.dumps(event).encode() + b"\n" for event in EVENTS),
+    )
+
+    assert list(docker.container_events("test-label", ["die"])) == EVENTS
+
+
+def test_container_events_cli(docker_daemon, tmp_path, monkeypatch):
+    # the stub daemon doesn't have any events
+    output = tmp_path / "events.json"
+    output.write_text("".join(json.dumps(event) + "\n" for event in EVENTS))
+    args = tmp_path / "args.txt"
+    fake_cli = tmp_path / "bin" / "docker"
+    fake_cli.parent.mkdir()
+    fake_cli.write_text(f'#!/bin/sh\necho "$@" > {args}\ncat {output}\n')
+    fake_cli.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{fake_cli.parent}:{os.environ['PATH']}")
+
+    assert list(docker.container_events("test-label", ["die"])) == EVENTS
+    assert args.read_text().split() == [
+        "events",
+        "--format",
+        "{{json",
+        ".}}",
+        "--filter",
+        "type=container",
+        "--filter",
+        "label=test-label",
+        "--filter",
+        "event=die",
+    ]
+
+
+def test_stream_unavailable(tmp_path, monkeypatch):
+    monkeypatch.setattr("agent.config.DOCKER_API_SOCKET", "")
+    with pytest.raises(docker_api.DockerAPIUnavailable):
+        with docker_api.stream("GET", "/events"):
+            pass  # pragma: no cover
+
+    monkeypatch.setattr("agent.config.DOCKER_API_SOCKET", str(tmp_path / "none.sock"))
+    with pytest.raises(docker_api.DockerAPIUnavailable):
+        with docker_api.stream("GET", "/events"):
+            pass  # pragma: no cover
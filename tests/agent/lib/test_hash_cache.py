@@ -0,0 +1,103 @@
+import hashlib
+import os
+
+import pytest
+
+from agent import config
+from agent.lib import hash_cache
+
+
+@pytest.fixture
+def no_racy_window(monkeypatch):
+    # files we've just written are normally too new to cache
+    monkeypatch.setattr(hash_cache, "RACY_WINDOW_NS", 0)
+
+
+@pytest.fixture
+def hashed_files(monkeypatch):
+    """Record which files are actually hashed"""
+    hashed = []
+    file_digest = hash_cache.file_digest
+
+    def record(f, digest):
+        hashed.append(f.name)
+        return file_digest(f, digest)
+
+    monkeypatch.setattr(hash_cache, "file_digest", record)
+    return hashed
+
+
+def sha256(contents):
+    return hashlib.sha256(contents).hexdigest()
+
+
+def test_file_sha256_cached(tmp_path, no_racy_window, hashed_files):
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"contents")
+
+    assert hash_cache.file_sha256(path) == sha256(b"contents")
+    assert hash_cache.file_sha256(path) == sha256(b"contents")
+    assert hashed_files == [str(path)]
+
+
+def test_file_sha256_rewritten_in_place(tmp_path, no_racy_window, hashed_files):
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"contents")
+    hash_cache.file_sha256(path)
+
+    # same size and inode, and the mtime set back to what it was
+    st = path.stat()
+    with path.open("r+b") as f:
+        f.write(b"CONTENTS")
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    assert hash_cache.file_sha256(path) == sha256(b"CONTENTS")
+    assert len(hashed_files) == 2
+
+
+def test_file_sha256_recently_changed_not_cached(tmp_path, hashed_files):
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"contents")
+
+    hash_cache.file_sha256(path)
+    hash_cache.file_sha256(path)
+
+    assert len(hashed_files) == 2
+
+
+def test_file_sha256_changed_while_hashing(tmp_path, no_racy_window, monkeypatch):
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"contents")
+    file_digest = hash_cache.file_digest
+
+    def digest_and_append(f, digest):
+        result = file_digest(f, digest)
+        with path.open("ab") as other:
+            other.write(b" and more")
+        return result
+
+    monkeypatch.setattr(hash_cache, "file_digest", digest_and_append)
+    hash_cache.file_sha256(path)
+    monkeypatch.setattr(hash_cache, "file_digest", file_digest)
+
+    assert hash_cache.file_sha256(path) == sha256(b"contents and more")
+
+
+def test_file_sha256_cache_error(tmp_path, monkeypatch, caplog):
+    # not a valid sqlite db
+    monkeypatch.setattr(config, "HASH_CACHE_FILE", tmp_path)
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"contents")
+
+    assert hash_cache.file_sha256(path) == sha256(b"contents")
+    assert "Failed to read hash cache" in caplog.text
+
+
+def test_file_sha256_store_error(tmp_path, no_racy_window, monkeypatch, caplog):
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"contents")
+    # create the db, then make it read-only
+    hash_cache.get_connection().execute("PRAGMA query_only = ON")
+
+    assert hash_cache.file_sha256(path) == sha256(b"contents")
+    assert "Failed to update hash cache" in caplog.text
@@ -1,3 +1,7 @@
+import http.server
+import json
+import socketserver
+import threading
 import time
 from collections import defaultdict
 
@@ -189,8 +193,80 @@ class StubExecutorAPI:
         # ExecutorState is not ERROR
         self.do_transition(job, ExecutorState.ERROR, ExecutorState.UNKNOWN, "cleanup")
 
+    def snapshot_status(self):
+        pass
+
+    def watch_events(self, callback):
+        pass
+
     def get_status(self, job, cancelled=False):
         return self.job_statuses.get(job.id, JobStatus(ExecutorState.UNKNOWN))
 
     def delete_files(self, workspace, privacy, files):
         self.deleted[workspace][privacy].extend(files)
+
+
+class StubDockerDaemon:
+    """Dummy Docker daemon serving the Engine API on a unix socket, for use in tests.
+
+    Set the response to a request with add_response(). Anything else gets a 404.
+    Requests are recorded in `requests` as (method, path) tuples, where the path
+    includes any query string, and the number of connections accepted in
+    `connections`.
+    """
+
+    def __init__(self, socket_path):
+        self.socket_path = str(socket_path)
+        self.responses = {}
+        self.requests = []
+        self.connections = 0
+
+        daemon = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            # keep-alive
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                daemon.connections += 1
+
+            def handle_request(self):
+                daemon.requests.append((self.command, self.path))
+                status, body, delay, close = daemon.responses.get(
+                    (self.command, self.path),
+                    (404, {"message": "page not found"}, 0, False),
+                )
+                time.sleep(delay)
+                if body is None:
+                    data = b""
+                elif isinstance(body, bytes):
+                    data = body
+                else:
+                    data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                # without telling the client, as when an idle connection times out
+                self.close_connection = close
+
+            do_GET = do_POST = do_DELETE = handle_request
+
+            def log_message(self, *args):
+                pass
+
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def add_response(self, method, path, status=200, body=None, delay=0, close=False):
+        self.responses[(method, path)] = (status, body, delay, close)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
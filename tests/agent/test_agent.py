@@ -1,5 +1,7 @@
+import dataclasses
 import logging
 import sqlite3
+import threading
 import time
 from unittest.mock import Mock, patch
 
@@ -701,3 +703,288 @@ def test_handle_job_no_task_id_in_definition(
     task = controller_task_api.get_task(task.id)
     assert task.agent_stage == ExecutorState.PREPARED.value
     assert "task_id" not in task.definition
+
+
+def test_wait_for_next_loop_woken(monkeypatch):
+    monkeypatch.setattr("common.config.JOB_LOOP_INTERVAL", 10)
+    main.wakeup.set()
+    try:
+        assert main.wait_for_next_loop([]) is True
+    finally:
+        main.wakeup.clear()
+
+
+@pytest.mark.parametrize(
+    "long_poll_timeout,active_tasks,expected_timeout",
+    [
+        (0, [], 0.01),
+        (30, ["task"], 0.01),
+        (30, [], 0.02),
+    ],
+)
+def test_wait_for_next_loop_timeout(
+    monkeypatch, long_poll_timeout, active_tasks, expected_timeout
+):
+    monkeypatch.setattr("common.config.JOB_LOOP_INTERVAL", 0.01)
+    monkeypatch.setattr("agent.config.IDLE_LOOP_INTERVAL", 0.02)
+    monkeypatch.setattr("agent.config.TASK_LONG_POLL_TIMEOUT", long_poll_timeout)
+    wait = Mock(return_value=False)
+    monkeypatch.setattr(main.wakeup, "wait", wait)
+
+    assert main.wait_for_next_loop(active_tasks) is False
+    wait.assert_called_once_with(expected_timeout)
+
+
+@pytest.mark.parametrize(
+    "version,new_version,woken",
+    [
+        (None, "v1", False),
+        ("v1", "v1", False),
+        ("v1", "v2", True),
+    ],
+)
+def test_check_for_task_changes(monkeypatch, version, new_version, woken):
+    monkeypatch.setattr("agent.config.TASK_LONG_POLL_TIMEOUT", 5)
+    wait_for_tasks_change = Mock(return_value=new_version)
+    monkeypatch.setattr(task_api, "wait_for_tasks_change", wait_for_tasks_change)
+
+    try:
+        assert main.check_for_task_changes(version) == new_version
+        assert main.wakeup.is_set() is woken
+    finally:
+        main.wakeup.clear()
+    wait_for_tasks_change.assert_called_once_with(version, 5)
+
+
+def test_watch_executor_events():
+    api = StubExecutorAPI()
+    api.watch_events = lambda callback: callback("job-id")
+
+    try:
+        main.watch_executor_events(api)
+        assert main.wakeup.is_set()
+    finally:
+        main.wakeup.clear()
+
+    StubExecutorAPI().watch_events(main.job_changed)
+    main.wakeup.clear()
+
+
+@pytest.fixture
+def task_pipeline(monkeypatch):
+    monkeypatch.setattr("agent.config.TASK_PIPELINE", True)
+    monkeypatch.setattr("agent.config.GIT_PREFETCH_WORKERS", 0)
+    yield
+    main.shutdown_pipeline()
+    main.wakeup.clear()
+
+
+def test_handle_tasks_pipeline_stages(task_pipeline, db, monkeypatch):
+    api = StubExecutorAPI()
+    states = [
+        ExecutorState.UNKNOWN,
+        ExecutorState.PREPARED,
+        ExecutorState.EXECUTED,
+        ExecutorState.EXECUTING,
+    ]
+    tasks = [api.add_test_runjob_task(state)[0] for state in states]
+    tasks.append(api.add_test_canceljob_task(ExecutorState.EXECUTING)[0])
+    tasks.append(
+        Task(
+            id="db-task",
+            backend="test",
+            type=TaskType.DBSTATUS,
+            definition={},
+            created_at=time.time(),
+        )
+    )
+    monkeypatch.setattr(task_api, "get_active_tasks", lambda: tasks)
+    handled = {}
+
+    def handle_single_task(task, api):
+        handled[task.id] = (threading.current_thread().name, api)
+
+    monkeypatch.setattr(main, "handle_single_task", handle_single_task)
+
+    assert main.handle_tasks(api) == tasks
+    main.get_pipeline().wait()
+
+    assert {task_id: name[:3] for task_id, (name, _) in handled.items()} == {
+        tasks[0].id: "pre",
+        tasks[1].id: "exe",
+        tasks[2].id: "fin",
+        # still running, so we only need to report its status
+        tasks[3].id: "Mai",
+        tasks[4].id: "fin",
+        "db-task": "exe",
+    }
+    assert handled[tasks[3].id][1] is api
+    assert handled[tasks[0].id][1].api is api
+    assert main.wakeup.is_set()
+
+    spans = get_trace("agent_loop")
+    assert spans[-1].name == "AGENT_LOOP"
+    assert spans[-1].attributes["handled_tasks"] == 6
+    assert spans[-1].attributes["dispatched_tasks"] == 5
+
+
+def test_handle_tasks_pipeline_one_step_per_job(task_pipeline, db, monkeypatch):
+    api = StubExecutorAPI()
+    task, job_id = api.add_test_runjob_task(ExecutorState.UNKNOWN)
+    started = threading.Event()
+    release = threading.Event()
+
+    def prepare(job):
+        started.set()
+        release.wait(5)
+
+    api.set_job_transition(job_id, ExecutorState.PREPARED, hook=prepare)
+    cancel = dataclasses.replace(task, id="cancel", type=TaskType.CANCELJOB)
+    active_tasks = [task]
+    monkeypatch.setattr(task_api, "get_active_tasks", lambda: active_tasks)
+
+    with patch("agent.task_api.update_controller", spec=task_api.update_controller):
+        main.handle_tasks(api)
+        assert started.wait(5)
+        # the job is still preparing, so we leave it alone, and cancel it next loop
+        active_tasks.append(cancel)
+        main.handle_tasks(api)
+        release.set()
+        main.get_pipeline().wait()
+
+    assert api.get_status(JobDefinition.from_dict(task.definition)).state == (
+        ExecutorState.PREPARED
+    )
+    assert job_id not in api.tracker["finalize"]
+    assert [
+        span.attributes["dispatched_tasks"]
+        for span in get_trace("agent_loop")
+        if span.name == "AGENT_LOOP"
+    ] == [1, 0]
+
+    main.shutdown_pipeline()
+    main.shutdown_pipeline()
+
+
+def test_handle_tasks_pipeline_skips_tasks_finished_since_fetch(
+    task_pipeline, db, monkeypatch
+):
+    api = StubExecutorAPI()
+    task = Task(
+        id="db-task",
+        backend="test",
+        type=TaskType.DBSTATUS,
+        definition={},
+        created_at=time.time(),
+    )
+    started = threading.Event()
+    release = threading.Event()
+    handled = []
+
+    def handle_single_task(task, api):
+        handled.append(task.id)
+        started.set()
+        release.wait(5)
+
+    def get_active_tasks():
+        if started.is_set():
+            # the task completes after we've fetched it, but before we dispatch it
+            release.set()
+            main.get_pipeline().wait()
+        return [task]
+
+    monkeypatch.setattr(main, "handle_single_task", handle_single_task)
+    monkeypatch.setattr(task_api, "get_active_tasks", get_active_tasks)
+
+    main.handle_tasks(api)
+    assert started.wait(5)
+    main.handle_tasks(api)
+    main.get_pipeline().wait()
+
+    assert handled == ["db-task"]
+    assert [
+        span.attributes["dispatched_tasks"]
+        for span in get_trace("agent_loop")
+        if span.name == "AGENT_LOOP"
+    ] == [1, 0]
+
+
+def test_main_shuts_down_pipeline(task_pipeline, db, monkeypatch):
+    api = StubExecutorAPI()
+    task = Task(
+        id="db-task",
+        backend="test",
+        type=TaskType.DBSTATUS,
+        definition={},
+        created_at=time.time(),
+    )
+    handled = []
+
+    def handle_single_task(task, api):
+        time.sleep(0.1)
+        handled.append(task.id)
+
+    monkeypatch.setattr(main, "handle_single_task", handle_single_task)
+    monkeypatch.setattr(task_api, "get_active_tasks", lambda: [task])
+
+    main.main(exit_callback=lambda _: True, api=api)
+
+    # the task was left to finish, and the workers stopped
+    assert handled == ["db-task"]
+    assert main._pipeline is None
+
+
+@patch("agent.task_api.update_controller", spec=task_api.update_controller)
+def test_handle_tasks_pipeline_finalize_and_cleanup(
+    mock_update_controller, task_pipeline, db, monkeypatch
+):
+    api = StubExecutorAPI()
+    task, job_id = api.add_test_runjob_task(ExecutorState.EXECUTED)
+    api.set_job_metadata(job_id)
+    cleanup = api.cleanup
+    cleaned_up = []
+
+    def cleanup_in_thread(job):
+        cleaned_up.append(threading.current_thread().name)
+        cleanup(job)
+
+    api.cleanup = cleanup_in_thread
+    monkeypatch.setattr(task_api, "get_active_tasks", lambda: [task])
+
+    main.handle_tasks(api)
+    main.get_pipeline().wait()
+
+    assert job_id in api.tracker["finalize"]
+    assert job_id in api.tracker["cleanup"]
+    assert cleaned_up == ["cle0"]
+    call_kwargs = mock_update_controller.call_args[1]
+    assert call_kwargs["stage"] == ExecutorState.FINALIZED.value
+    assert call_kwargs["complete"] is True
+
+
+@patch("agent.task_api.update_controller", spec=task_api.update_controller)
+def test_handle_tasks_pipeline_errors_are_isolated(
+    mock_update_controller, task_pipeline, db, caplog, monkeypatch
+):
+    api = StubExecutorAPI()
+    failing, failing_id = api.add_test_runjob_task(ExecutorState.PREPARED)
+    api.set_job_transition(
+        failing_id,
+        ExecutorState.EXECUTING,
+        hook=Mock(side_effect=sqlite3.OperationalError("database locked")),
+    )
+    task, job_id = api.add_test_runjob_task(ExecutorState.PREPARED)
+    monkeypatch.setattr(task_api, "get_active_tasks", lambda: [failing, task])
+
+    main.handle_tasks(api)
+    main.get_pipeline().wait()
+
+    assert api.get_status(JobDefinition.from_dict(task.definition)).state == (
+        ExecutorState.EXECUTING
+    )
+    errors = [record for record in caplog.records if record.msg == "task error"]
+    assert len(errors) == 1
+    assert "database locked" in str(errors[0].exc_info[1])
+
+    # the job is free to be tried again
+    assert not main.get_pipeline().busy(failing_id)
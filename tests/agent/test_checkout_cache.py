@@ -0,0 +1,165 @@
+import os
+import stat
+import threading
+from pathlib import Path
+
+import pytest
+
+from agent import config
+from agent.executors import checkout_cache
+from common.lib import git
+
+
+REPO_FIXTURE = str(Path(__file__).parents[1].resolve() / "fixtures/git-repo")
+COMMIT = "d090466f63b0d68084144d8f105f0d6e79a0819e"
+PARENT_COMMIT = "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74"
+
+
+@pytest.fixture
+def cache_size(monkeypatch):
+    def set_size(size):
+        monkeypatch.setattr("agent.config.CHECKOUT_CACHE_MAX_SIZE", size)
+
+    set_size(1024 * 1024)
+    return set_size
+
+
+def test_cached_checkout(tmp_work_dir, cache_size):
+    with checkout_cache.cached_checkout(REPO_FIXTURE, COMMIT) as path:
+        assert path == config.CHECKOUT_CACHE_DIR / COMMIT
+        project = path / "project.yaml"
+        assert project.exists()
+        # the permissions of the files are left alone
+        assert is_writable(project)
+
+    size = int(checkout_cache.size_path(path).read_text())
+    assert size == project.stat().st_size
+
+
+def test_cached_checkout_reuses_checkout(tmp_work_dir, cache_size, monkeypatch):
+    with checkout_cache.cached_checkout(REPO_FIXTURE, COMMIT):
+        pass
+
+    def fail(*args):
+        raise AssertionError("should not check out again")
+
+    monkeypatch.setattr(checkout_cache, "checkout_commit", fail)
+    with checkout_cache.cached_checkout(REPO_FIXTURE, COMMIT) as path:
+        assert (path / "project.yaml").exists()
+
+
+def test_cached_checkout_different_commits_concurrently(tmp_work_dir, cache_size):
+    # both commits are from the same repo, so share its index
+    repo_dir = git.get_local_repo_dir(REPO_FIXTURE)
+    for commit in [COMMIT, PARENT_COMMIT]:
+        git.ensure_commit_fetched(repo_dir, REPO_FIXTURE, commit)
+    paths = {}
+
+    def use(commit):
+        with checkout_cache.cached_checkout(REPO_FIXTURE, commit) as path:
+            paths[commit] = path
+
+    threads = [
+        threading.Thread(target=use, args=(commit,))
+        for commit in [COMMIT, PARENT_COMMIT] * 3
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(paths) == sorted([COMMIT, PARENT_COMMIT])
+    for path in paths.values():
+        assert (path / "project.yaml").exists()
+
+
+def test_cached_checkout_failure_leaves_no_checkout(tmp_work_dir, cache_size):
+    with pytest.raises(Exception):
+        with checkout_cache.cached_checkout(REPO_FIXTURE, "0" * 40):
+            pass  # pragma: no cover
+
+    assert list(config.CHECKOUT_CACHE_DIR.iterdir()) == []
+
+
+def test_cached_checkout_evicts_least_recently_used(tmp_work_dir, cache_size):
+    with checkout_cache.cached_checkout(REPO_FIXTURE, COMMIT) as path:
+        size = int(checkout_cache.size_path(path).read_text())
+    os.utime(path, (0, 0))
+
+    # room for only one checkout
+    cache_size(size)
+    with checkout_cache.cached_checkout(REPO_FIXTURE, PARENT_COMMIT):
+        pass
+
+    assert not path.exists()
+    assert not checkout_cache.size_path(path).exists()
+    assert (config.CHECKOUT_CACHE_DIR / PARENT_COMMIT).exists()
+
+
+def test_evict_keeps_current_checkout(tmp_work_dir, cache_size):
+    with checkout_cache.cached_checkout(REPO_FIXTURE, COMMIT) as path:
+        pass
+
+    cache_size(1)
+    checkout_cache.evict(keep={COMMIT})
+
+    assert path.exists()
+
+
+def test_cached_checkout_in_use_is_not_evicted(tmp_work_dir, cache_size):
+    with checkout_cache.cached_checkout(REPO_FIXTURE, COMMIT) as path:
+        size = int(checkout_cache.size_path(path).read_text())
+        os.utime(path, (0, 0))
+        # room for only one checkout
+        cache_size(size)
+
+        # another job can use another commit while we're using this one
+        thread = threading.Thread(
+            target=use_checkout, args=(REPO_FIXTURE, PARENT_COMMIT)
+        )
+        thread.start()
+        thread.join(10)
+        assert not thread.is_alive()
+
+        assert path.exists()
+        assert (config.CHECKOUT_CACHE_DIR / PARENT_COMMIT).exists()
+
+        # and another job can use this one
+        use_checkout(REPO_FIXTURE, COMMIT)
+        assert checkout_cache._pins == {COMMIT: 1}
+
+    assert checkout_cache._pins == {}
+    assert checkout_cache._creating == {}
+
+    # now it's not in use, it can be evicted
+    os.utime(path, (0, 0))
+    checkout_cache.evict()
+    assert not path.exists()
+
+
+def use_checkout(repo_url, commit):
+    with checkout_cache.cached_checkout(repo_url, commit):
+        pass
+
+
+def test_checkout_size(tmp_path):
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir/file.txt").write_text("12345")
+    (tmp_path / "link").symlink_to("dir/file.txt")
+
+    assert checkout_cache.checkout_size(tmp_path) == 5
+
+
+def test_get_checkouts_ignores_temporary_dirs_and_bad_sizes(tmp_work_dir):
+    config.CHECKOUT_CACHE_DIR.mkdir(parents=True)
+    (config.CHECKOUT_CACHE_DIR / ".tmp-abc").mkdir()
+    (config.CHECKOUT_CACHE_DIR / COMMIT).mkdir()
+    (config.CHECKOUT_CACHE_DIR / f"{COMMIT}.size").write_text("nonsense")
+
+    checkouts = checkout_cache.get_checkouts()
+
+    assert [(commit, size) for _, commit, size in checkouts] == [(COMMIT, 0)]
+
+
+def is_writable(path):
+    return bool(path.stat().st_mode & stat.S_IWUSR)
@@ -0,0 +1,145 @@
+from types import SimpleNamespace
+
+import pytest
+
+from agent.executors import cleanup, volumes
+from tests.conftest import get_trace
+
+
+@pytest.fixture
+def removed_containers(monkeypatch):
+    removed = []
+    monkeypatch.setattr(cleanup.docker, "delete_container", removed.append)
+    return removed
+
+
+def create_volume(job_id):
+    job = SimpleNamespace(id=job_id)
+    volumes.create_volume(job)
+    (volumes.host_volume_path(job) / "output").mkdir()
+    (volumes.host_volume_path(job) / "output/file.txt").write_text("file")
+    return job
+
+
+def test_queue_cleanup(tmp_work_dir, removed_containers):
+    job = create_volume("job")
+
+    cleanup.queue_cleanup(job, "os-job-job")
+
+    assert not volumes.volume_exists(job)
+    assert len(list(cleanup.volume_trash_dir().iterdir())) == 1
+    assert (cleanup.container_queue_dir() / "os-job-job").exists()
+    assert cleanup.backlog_size() == 2
+    # nothing is removed until the reaper runs
+    assert removed_containers == []
+
+
+def test_queue_cleanup_overlay(tmp_work_dir, removed_containers, monkeypatch):
+    monkeypatch.setattr("agent.config.VOLUME_BACKEND", "overlay")
+    # not mounted, so we don't need to unmount
+    monkeypatch.setattr(volumes.os.path, "ismount", lambda p: False)
+    job = create_volume("job")
+
+    cleanup.queue_cleanup(job, "os-job-job")
+
+    assert not volumes.volume_exists(job)
+    assert not volumes.volume_layers_path(job).exists()
+    assert len(list(cleanup.volume_trash_dir().iterdir())) == 2
+
+
+def test_queue_cleanup_missing_volume(tmp_work_dir, removed_containers):
+    cleanup.queue_cleanup(SimpleNamespace(id="job"), "os-job-job")
+
+    assert cleanup.backlog_size() == 1
+
+
+def test_reap(tmp_work_dir, removed_containers):
+    cleanup.queue_cleanup(create_volume("job1"), "os-job-job1")
+    cleanup.queue_cleanup(create_volume("job2"), "os-job-job2")
+
+    cleanup.reap()
+
+    assert sorted(removed_containers) == ["os-job-job1", "os-job-job2"]
+    assert list(cleanup.volume_trash_dir().iterdir()) == []
+    assert cleanup.backlog_size() == 0
+
+    span = get_trace("cleanup")[-1]
+    assert span.name == "CLEANUP"
+    assert span.attributes["backlog"] == 4
+    assert span.attributes["containers"] == 2
+    assert span.attributes["volumes"] == 2
+    assert span.attributes["errors"] == 0
+
+
+def test_reap_empty(tmp_work_dir, removed_containers):
+    cleanup.reap()
+
+    assert get_trace("cleanup")[-1].attributes["backlog"] == 0
+
+
+def test_reap_errors_are_retried(tmp_work_dir, monkeypatch, caplog):
+    cleanup.queue_cleanup(create_volume("job"), "os-job-job")
+
+    def error(*args, **kwargs):
+        raise Exception("some error")
+
+    monkeypatch.setattr(cleanup.docker, "delete_container", error)
+    monkeypatch.setattr(cleanup, "delete_trashed_volume", error)
+
+    cleanup.reap()
+
+    assert get_trace("cleanup")[-1].attributes["errors"] == 2
+    assert "Failed to remove container os-job-job" in caplog.text
+    assert "Failed to delete trashed volume" in caplog.text
+    # still queued, for the next run
+    assert cleanup.backlog_size() == 2
+
+
+def test_delete_trashed_volume_without_ionice(tmp_work_dir, monkeypatch, caplog):
+    monkeypatch.setattr(cleanup, "IONICE", ["no-such-ionice-command"])
+    cleanup.queue_cleanup(create_volume("job"), "os-job-job")
+    (path,) = cleanup.volume_trash_dir().iterdir()
+
+    cleanup.delete_trashed_volume(path)
+
+    assert not path.exists()
+    assert "ionice not found" in caplog.text
+
+
+def test_cancel_container_removal(tmp_work_dir, removed_containers):
+    cleanup.queue_container_removal("os-job-job")
+
+    cleanup.cancel_container_removal("os-job-job")
+    # not queued, so nothing to do
+    cleanup.cancel_container_removal("os-job-other")
+
+    assert removed_containers == ["os-job-job"]
+    assert cleanup.backlog_size() == 0
+
+
+def test_reap_skips_cancelled_container_removal(
+    tmp_work_dir, removed_containers, monkeypatch
+):
+    cleanup.queue_container_removal("os-job-job")
+    lock = cleanup._container_lock
+
+    class CancelBeforeLocking:
+        # the job is retried, reusing the name, after the reaper has listed the
+        # queue but before it takes the lock to remove the container
+        def __enter__(self):
+            monkeypatch.setattr(cleanup, "_container_lock", lock)
+            cleanup.cancel_container_removal("os-job-job")
+            return lock.__enter__()
+
+        def __exit__(self, *exc_info):
+            return lock.__exit__(*exc_info)
+
+    monkeypatch.setattr(cleanup, "_container_lock", CancelBeforeLocking())
+
+    cleanup.reap()
+
+    # removed once, by the cancellation, but not again by the reaper
+    assert removed_containers == ["os-job-job"]
+    attributes = get_trace("cleanup")[-1].attributes
+    assert attributes["containers"] == 0
+    assert attributes["errors"] == 0
@@ -0,0 +1,88 @@
+import json
+from pathlib import Path
+from types import SimpleNamespace
+
+from agent import config
+from agent.executors import job_log_index, local
+
+
+def forbid_glob(monkeypatch):
+    def glob(*args, **kwargs):
+        raise AssertionError("should not search the log directories")
+
+    monkeypatch.setattr(Path, "glob", glob)
+
+
+def write_unindexed_metadata(job_id, month="2020-01"):
+    # as written before we had the index
+    path = config.JOB_LOG_DIR / month / f"os-job-{job_id}" / local.METADATA_FILE
+    path.parent.mkdir(parents=True)
+    path.write_text(json.dumps({"job_id": job_id}))
+    return path
+
+
+def test_write_job_metadata_indexes_log_dir(tmp_work_dir, monkeypatch):
+    forbid_glob(monkeypatch)
+    job_definition = SimpleNamespace(id="abcdef", created_at=0)
+
+    local.write_job_metadata(job_definition, {"status_message": "done"})
+
+    log_dir = local.get_log_dir(job_definition)
+    assert job_log_index.lookup("abcdef") == log_dir
+    assert local.job_metadata_path("abcdef") == log_dir / local.METADATA_FILE
+    assert local.read_job_metadata("abcdef")["status_message"] == "done"
+
+
+def test_job_metadata_path_unindexed(tmp_work_dir):
+    path = write_unindexed_metadata("abcdef")
+
+    assert local.job_metadata_path("abcdef") == path
+    # and now it's indexed
+    assert job_log_index.lookup("abcdef") == path.parent
+
+
+def test_job_metadata_path_missing(tmp_work_dir):
+    assert local.job_metadata_path("abcdef") is None
+
+
+def test_job_metadata_path_missing_after_backfill(tmp_work_dir, monkeypatch):
+    job_log_index.backfill(local.METADATA_FILE)
+    assert job_log_index.is_complete()
+
+    # we trust the index, and don't search
+    forbid_glob(monkeypatch)
+    assert local.job_metadata_path("abcdef") is None
+
+
+def test_job_metadata_path_stale_index(tmp_work_dir):
+    job_log_index.add("abcdef", config.JOB_LOG_DIR / "2020-01/os-job-abcdef")
+    job_log_index.backfill(local.METADATA_FILE)
+    # the logs were moved
+    path = write_unindexed_metadata("abcdef", month="2020-02")
+
+    assert local.job_metadata_path("abcdef") == path
+    assert job_log_index.lookup("abcdef") == path.parent
+
+
+def test_backfill(tmp_work_dir):
+    write_unindexed_metadata("job1", month="2020-01")
+    write_unindexed_metadata("job2", month="2021-06")
+    # not a job
+    (config.JOB_LOG_DIR / "2020-01/something-else").mkdir()
+    # no metadata yet
+    (config.JOB_LOG_DIR / "2020-01/os-job-job3").mkdir()
+
+    assert job_log_index.backfill(local.METADATA_FILE) == 2
+
+    assert job_log_index.lookup("job1") == config.JOB_LOG_DIR / "2020-01/os-job-job1"
+    assert job_log_index.lookup("job2") == config.JOB_LOG_DIR / "2021-06/os-job-job2"
+    assert job_log_index.lookup("job3") is None
+
+
+def test_backfill_keeps_existing_entries(tmp_work_dir):
+    write_unindexed_metadata("job1", month="2020-01")
+    job_log_index.add("job1", config.JOB_LOG_DIR / "2020-02/os-job-job1")
+
+    job_log_index.backfill(local.METADATA_FILE)
+
+    assert job_log_index.lookup("job1") == config.JOB_LOG_DIR / "2020-02/os-job-job1"
@@ -1,13 +1,16 @@
+import dataclasses
 import datetime
 import json
 import logging
+import os
+import threading
 import time
 from unittest import mock
 
 import pytest
 
 from agent import config
-from agent.executors import local, volumes
+from agent.executors import cleanup, job_log_index, local, volumes
 from agent.lib import docker
 from common.job_executor import ExecutorState, JobDefinition, Privacy, Study
 from common.lib import datestr_to_ns_timestamp
@@ -164,6 +167,8 @@ def test_read_metadata_path(job_definition):
     assert local.read_job_metadata(job_definition.id) == local.METADATA_DEFAULTS | {
         "test": "actual"
     }
+    # now it's indexed, so we find it directly
+    assert job_log_index.lookup(job_definition.id) == actual_path.parent
 
     old_path = (
         config.JOB_LOG_DIR
@@ -173,6 +178,13 @@ def test_read_metadata_path(job_definition):
     )
     old_path.parent.mkdir(parents=True)
     old_path.write_text(json.dumps({"test": "old"}))
+    assert local.read_job_metadata(job_definition.id) == local.METADATA_DEFAULTS | {
+        "test": "actual"
+    }
+
+    # we only notice duplicates if we have to search for the metadata because it
+    # isn't indexed
+    job_log_index.get_connection().execute("DELETE FROM jobs")
     with pytest.raises(AssertionError, match="Expected at most one path"):
         local.read_job_metadata(job_definition.id)
 
@@ -213,6 +225,99 @@ def test_read_job_task_metadata(
     assert local.read_job_task_metadata(job_definition) == expected
 
 
+def test_write_job_metadata_writes_summary(job_definition, tmp_work_dir):
+    local.write_job_metadata(
+        job_definition, {"status_message": "done", "container_metadata": {"big": 1}}
+    )
+
+    summary_path = local.get_log_dir(job_definition) / local.SUMMARY_FILE
+    summary = json.loads(summary_path.read_text())
+    assert summary == {"status_message": "done"}
+    assert local.read_job_summary(job_definition.id) == (
+        local.METADATA_DEFAULTS | summary
+    )
+    # the full metadata is still there for the logs and CLIs
+    metadata = local.read_job_metadata(job_definition.id)
+    assert metadata["container_metadata"] == {"big": 1}
+
+
+def rewrite_summary(job_definition, summary, new_inode=False, mtime_ns=None):
+    """Rewrite the job's summary file, keeping its mtime unless told otherwise"""
+    path = local.get_log_dir(job_definition) / local.SUMMARY_FILE
+    st = path.stat()
+    if new_inode:
+        tmp = path.with_name("tmp")
+        tmp.write_text(json.dumps(summary))
+        tmp.replace(path)
+    else:
+        path.write_text(json.dumps(summary))
+    os.utime(path, ns=(st.st_atime_ns, mtime_ns or st.st_mtime_ns))
+
+
+def test_read_job_summary_unchanged_file_not_reread(job_definition, tmp_work_dir):
+    local.write_job_metadata(job_definition, {"status_message": "first"})
+    assert local.read_job_summary(job_definition.id)["status_message"] == "first"
+
+    # same inode, size and mtime, so we keep using what we read before
+    rewrite_summary(job_definition, {"status_message": "secnd"})
+
+    assert local.read_job_summary(job_definition.id)["status_message"] == "first"
+
+
+@pytest.mark.parametrize(
+    "summary,new_inode,mtime_delta",
+    [
+        ({"status_message": "secnd"}, True, 0),
+        ({"status_message": "secnd"}, False, 1000),
+        ({"status_message": "second"}, False, 0),
+    ],
+)
+def test_read_job_summary_changed_file_reloaded(
+    job_definition, tmp_work_dir, summary, new_inode, mtime_delta
+):
+    local.write_job_metadata(job_definition, {"status_message": "first"})
+    assert local.read_job_summary(job_definition.id)["status_message"] == "first"
+    path = local.get_log_dir(job_definition) / local.SUMMARY_FILE
+    mtime_ns = path.stat().st_mtime_ns + mtime_delta
+
+    rewrite_summary(job_definition, summary, new_inode=new_inode, mtime_ns=mtime_ns)
+
+    assert local.read_job_summary(job_definition.id) == (
+        local.METADATA_DEFAULTS | summary
+    )
+
+
+def test_read_job_summary_modifying_result_leaves_cache(job_definition, tmp_work_dir):
+    local.write_job_metadata(
+        job_definition, {"outputs": {"output/a.csv": "highly_sensitive"}}
+    )
+
+    summary = local.read_job_summary(job_definition.id)
+    summary["outputs"]["output/b.csv"] = "highly_sensitive"
+    summary["status_message"] = "modified"
+
+    assert local.read_job_summary(job_definition.id) == local.METADATA_DEFAULTS | {
+        "outputs": {"output/a.csv": "highly_sensitive"}
+    }
+
+
+def test_read_job_summary_without_summary_file(job_definition, tmp_work_dir):
+    # as written before we had summaries
+    path = local.get_log_dir(job_definition) / local.METADATA_FILE
+    path.parent.mkdir(parents=True)
+    path.write_text(
+        json.dumps({"status_message": "done", "container_metadata": {"big": 1}})
+    )
+
+    assert local.read_job_summary(job_definition.id) == local.METADATA_DEFAULTS | {
+        "status_message": "done"
+    }
+
+
+def test_read_job_summary_no_metadata(job_definition, tmp_work_dir):
+    assert local.read_job_summary(job_definition.id) == {}
+
+
 @pytest.mark.needs_docker
 def test_prepare_success(
     docker_cleanup, job_definition, test_repo, tmp_work_dir, freezer
@@ -248,6 +353,52 @@ def test_prepare_success(
     assert all_files == expected
 
 
+@pytest.mark.needs_docker
+def test_prepare_with_checkout_cache(
+    docker_cleanup, job_definition, test_repo, tmp_work_dir, monkeypatch
+):
+    monkeypatch.setattr("agent.config.CHECKOUT_CACHE_MAX_SIZE", 1024 * 1024)
+    populate_workspace(job_definition.workspace, "output/input.csv", "past-job-id")
+    job_definition.input_job_ids = ["past-job-id"]
+
+    api = local.LocalDockerAPI()
+    api.prepare(job_definition)
+    status = api.get_status(job_definition)
+
+    assert status.state == ExecutorState.PREPARED
+    assert (config.CHECKOUT_CACHE_DIR / test_repo.commit).exists()
+
+    expected = set(list_repo_files(test_repo.source) + ["output/input.csv"])
+    expected.add(local.TIMESTAMP_REFERENCE_FILE)
+    files = volumes.glob_volume_files(job_definition)
+    assert set(files["*"] + files["**/*"]) == expected
+
+
+@pytest.mark.needs_docker
+def test_prepare_concurrently(docker_cleanup, job_definition, test_repo, tmp_work_dir):
+    # as the agent's prepare workers do, for jobs on the same commit
+    job_definitions = [
+        dataclasses.replace(job_definition, id=f"{job_definition.id}-{i}")
+        for i in range(4)
+    ]
+    api = local.LocalDockerAPI()
+
+    threads = [
+        threading.Thread(target=api.prepare, args=(job,)) for job in job_definitions
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    expected = set(list_repo_files(test_repo.source))
+    expected.add(local.TIMESTAMP_REFERENCE_FILE)
+    for job in job_definitions:
+        assert api.get_status(job).state == ExecutorState.PREPARED
+        files = volumes.glob_volume_files(job)
+        assert set(files["*"] + files["**/*"]) == expected
+
+
 @pytest.mark.needs_docker
 def test_prepare_already_prepared(docker_cleanup, job_definition):
     # create the volume already
@@ -340,6 +491,54 @@ def test_execute_success(docker_cleanup, job_definition, tmp_work_dir, db):
     assert container_data["HostConfig"]["Memory"] == 2**30  # 1G
 
 
+@pytest.mark.needs_docker
+def test_status_snapshot_matches_live_status(
+    docker_cleanup, job_definition, tmp_work_dir, monkeypatch
+):
+    monkeypatch.setattr(config, "STATUS_SNAPSHOT", True)
+    api = local.LocalDockerAPI()
+
+    def check_snapshot():
+        api.snapshot_status()
+        assert api.current_status(job_definition) is api.status_snapshot
+        from_snapshot = api.get_status(job_definition)
+        api.status_snapshot = None
+        assert api.get_status(job_definition) == from_snapshot
+        return from_snapshot.state
+
+    assert check_snapshot() == ExecutorState.UNKNOWN
+    api.prepare(job_definition)
+    assert check_snapshot() == ExecutorState.PREPARED
+    api.execute(job_definition)
+    wait_for_state(api, job_definition, ExecutorState.EXECUTED)
+    assert check_snapshot() == ExecutorState.EXECUTED
+
+
+@pytest.mark.needs_docker
+def test_watch_events(docker_cleanup, job_definition, tmp_work_dir):
+    api = local.LocalDockerAPI()
+    changed = []
+
+    class Stop(Exception):
+        pass
+
+    def callback(job_id):
+        changed.append(job_id)
+        raise Stop()
+
+    def watch():
+        with pytest.raises(Stop):
+            api.watch_events(callback)
+
+    thread = threading.Thread(target=watch, daemon=True)
+    thread.start()
+    api.prepare(job_definition)
+    api.execute(job_definition)
+    thread.join(timeout=30)
+
+    assert changed == [job_definition.id]
+
+
 @pytest.mark.needs_docker
 def test_execute_config(docker_cleanup, job_definition, tmp_work_dir):
     api = local.LocalDockerAPI()
@@ -869,6 +1068,45 @@ def test_finalize_csv_max_rows(docker_cleanup, job_definition, tmp_work_dir):
     assert manifest["outputs"]["output/output.csv"]["col_count"] == 2
 
 
+@pytest.mark.needs_docker
+def test_finalize_too_many_csv_rows_stops_counting(
+    docker_cleanup, job_definition, tmp_work_dir
+):
+    # large enough that we stop counting before the end of the file
+    job_definition.args = [
+        "sh",
+        "-c",
+        "(echo foo; seq 1 500000) > /workspace/output/output.csv",
+    ]
+    job_definition.output_spec = {
+        "output/output.csv": "moderately_sensitive",
+    }
+    job_definition.level4_max_csv_rows = 10
+
+    api = local.LocalDockerAPI()
+
+    api.prepare(job_definition)
+    api.execute(job_definition)
+    wait_for_state(api, job_definition, ExecutorState.EXECUTED)
+
+    api.finalize(job_definition)
+    status = api.get_status(job_definition)
+    assert status.state == ExecutorState.FINALIZED
+
+    assert status.results["level4_excluded_files"] == {
+        "output/output.csv": "File row count (more than 10) exceeds maximum allowed rows (10)",
+    }
+
+    level4_dir = local.get_medium_privacy_workspace(job_definition.workspace)
+    txt = (level4_dir / "output/output.csv.txt").read_text()
+    assert "contained more than 10 rows" in txt
+
+    manifest = local.read_manifest_file(level4_dir, job_definition)
+    # we don't know how many rows there are
+    assert manifest["outputs"]["output/output.csv"]["row_count"] is None
+    assert manifest["outputs"]["output/output.csv"]["col_count"] == 1
+
+
 @pytest.mark.needs_docker
 def test_finalize_large_level4_outputs_cleanup(
     docker_cleanup, job_definition, tmp_work_dir
@@ -1327,6 +1565,29 @@ def test_running_job_cancelled(docker_cleanup, job_definition, tmp_work_dir):
     assert not workspace_log_file_exists(job_definition)
 
 
+@pytest.mark.needs_docker
+def test_cleanup_async(docker_cleanup, job_definition, tmp_work_dir, monkeypatch):
+    monkeypatch.setattr("agent.config.CLEANUP_ASYNC", True)
+    api = local.LocalDockerAPI()
+    api.prepare(job_definition)
+    api.execute(job_definition)
+    wait_for_state(api, job_definition, ExecutorState.EXECUTED)
+    api.finalize(job_definition)
+
+    api.cleanup(job_definition)
+
+    # the volume is out of the way immediately, the container once reaped
+    assert not volumes.volume_exists(job_definition)
+    name = local.container_name(job_definition.id)
+    assert docker.container_inspect(name, none_if_not_exists=True)
+    assert api.get_status(job_definition).state == ExecutorState.FINALIZED
+
+    cleanup.reap()
+
+    assert docker.container_inspect(name, none_if_not_exists=True) is None
+    assert cleanup.backlog_size() == 0
+
+
 @pytest.mark.needs_docker
 def test_running_job_cancelled_retry(docker_cleanup, job_definition, tmp_work_dir):
     job_definition.args = ["sleep", "101"]
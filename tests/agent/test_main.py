@@ -134,6 +134,7 @@ def test_update_job_task_results_redacted(
     job_results = dict(
         exit_code=0,
         outputs={"output/foo.txt": "moderately_sensitive"},
+        container_metadata={"State": {"ExitCode": 0}},
     )
     job_results.update(output_results)
 
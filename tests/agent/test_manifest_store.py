@@ -0,0 +1,289 @@
+import json
+import threading
+
+import pytest
+
+from agent.executors import manifest_store
+
+
+@pytest.fixture
+def manifest_file(tmp_path):
+    return tmp_path / "level4/metadata/manifest.json"
+
+
+@pytest.fixture
+def open_manifest(tmp_path, manifest_file):
+    def open_manifest():
+        return manifest_store.open_manifest(
+            tmp_path / "level3/metadata", manifest_file, "workspace"
+        )
+
+    return open_manifest
+
+
+def read_manifest(manifest_file):
+    text = manifest_file.read_text()
+    manifest = json.loads(text)
+    # exported exactly as we used to write it
+    assert text == json.dumps(manifest, indent=2)
+    return manifest
+
+
+def test_new_manifest(open_manifest, manifest_file):
+    with open_manifest() as manifest:
+        manifest.update_outputs_and_actions(
+            "action1",
+            {"output/a.csv": {"action": "action1", "size": 1}},
+            {"action1"},
+        )
+
+    assert read_manifest(manifest_file) == {
+        "workspace": "workspace",
+        "repo": None,
+        "outputs": {"output/a.csv": {"action": "action1", "size": 1}},
+    }
+
+
+def test_new_manifest_without_outputs(open_manifest, manifest_file):
+    with open_manifest() as manifest:
+        manifest.update_outputs_and_actions("action1", {}, {"action1"})
+
+    assert read_manifest(manifest_file) == {
+        "workspace": "workspace",
+        "repo": None,
+        "outputs": {},
+    }
+
+
+def test_update_outputs_and_actions(open_manifest, manifest_file):
+    manifest_file.parent.mkdir(parents=True)
+    manifest_file.write_text(
+        json.dumps(
+            {
+                "workspace": "workspace",
+                "outputs": {
+                    "output/old_action.txt": {"action": "old_action"},
+                    "output/dataset.csv": {"action": "generate_dataset"},
+                    "output/reappeared.csv": {
+                        "action": "reappeared",
+                        "out_of_date_action": True,
+                    },
+                    "output/old_name.csv": {"action": "action1"},
+                    "output/a.csv": {"action": "action1", "size": 1},
+                },
+            }
+        )
+    )
+
+    with open_manifest() as manifest:
+        manifest.update_outputs_and_actions(
+            "action1",
+            {
+                "output/a.csv": {"action": "action1", "size": 2},
+                "output/b.csv": {"action": "action1", "size": 3},
+            },
+            {"generate_dataset", "reappeared", "action1"},
+        )
+
+    assert read_manifest(manifest_file) == {
+        "workspace": "workspace",
+        "outputs": {
+            "output/old_action.txt": {
+                "action": "old_action",
+                "out_of_date_action": True,
+            },
+            "output/dataset.csv": {
+                "action": "generate_dataset",
+                "out_of_date_action": False,
+            },
+            "output/reappeared.csv": {
+                "action": "reappeared",
+                "out_of_date_action": False,
+            },
+            "output/old_name.csv": {
+                "action": "action1",
+                "out_of_date_action": False,
+                "out_of_date_output": True,
+            },
+            "output/a.csv": {"action": "action1", "size": 2},
+            "output/b.csv": {"action": "action1", "size": 3},
+        },
+    }
+
+
+def test_update_without_workspace_actions(open_manifest, manifest_file):
+    with open_manifest() as manifest:
+        manifest.update_outputs_and_actions(
+            "action1", {"output/a.csv": {"action": "action1"}}, None
+        )
+    with open_manifest() as manifest:
+        manifest.update_outputs_and_actions(
+            "action2", {"output/b.csv": {"action": "action2"}}, None
+        )
+
+    assert read_manifest(manifest_file)["outputs"] == {
+        "output/a.csv": {"action": "action1"},
+        "output/b.csv": {"action": "action2"},
+    }
+
+
+def test_unchanged_manifest_not_exported(open_manifest, manifest_file):
+    with open_manifest() as manifest:
+        manifest.update_outputs_and_actions(
+            "action1", {"output/a.csv": {"action": "action1"}}, {"action1"}
+        )
+    with open_manifest() as manifest:
+        manifest.update_outputs_and_actions("action2", {}, {"action1"})
+    exported = manifest_file.stat()
+
+    with open_manifest() as manifest:
+        manifest.update_outputs_and_actions("action2", {}, {"action1"})
+
+    assert manifest_file.stat().st_mtime_ns == exported.st_mtime_ns
+    assert manifest_file.stat().st_ino == exported.st_ino
+
+
+def test_add_outputs(open_manifest, manifest_file):
+    with open_manifest() as manifest:
+        assert manifest.get_first_output() is None
+        manifest.update_outputs_and_actions(
+            "action1", {"output/a.csv": {"action": "action1"}}, None
+        )
+
+    with open_manifest() as manifest:
+        manifest.add_outputs(
+            {
+                "output/a.csv": {"action": "old"},
+                "output/b.csv": {"action": "old"},
+            }
+        )
+        assert manifest.get_first_output() == {"action": "action1"}
+        assert manifest.get_output("output/b.csv") == {"action": "old"}
+        assert manifest.get_output("output/c.csv") is None
+
+    assert read_manifest(manifest_file)["outputs"] == {
+        "output/a.csv": {"action": "action1"},
+        "output/b.csv": {"action": "old"},
+    }
+
+
+def test_manifest_edited_externally(open_manifest, manifest_file):
+    with open_manifest() as manifest:
+        manifest.update_outputs_and_actions(
+            "action1", {"output/a.csv": {"action": "action1"}}, {"action1"}
+        )
+
+    edited = read_manifest(manifest_file)
+    edited["outputs"]["output/edited.csv"] = {"action": "action1"}
+    manifest_file.write_text(json.dumps(edited))
+
+    with open_manifest() as manifest:
+        manifest.update_outputs_and_actions(
+            "action2", {"output/b.csv": {"action": "action2"}}, None
+        )
+
+    assert list(read_manifest(manifest_file)["outputs"]) == [
+        "output/a.csv",
+        "output/edited.csv",
+        "output/b.csv",
+    ]
+
+
+def test_manifest_deleted_externally(open_manifest, manifest_file):
+    with open_manifest() as manifest:
+        manifest.update_outputs_and_actions(
+            "action1", {"output/a.csv": {"action": "action1"}}, None
+        )
+    manifest_file.unlink()
+
+    with open_manifest() as manifest:
+        manifest.update_outputs_and_actions(
+            "action2", {"output/b.csv": {"action": "action2"}}, None
+        )
+
+    assert list(read_manifest(manifest_file)["outputs"]) == ["output/b.csv"]
+
+
+def test_export_interrupted(open_manifest, manifest_file):
+    with pytest.raises(KeyboardInterrupt):
+        with open_manifest() as manifest:
+            manifest.update_outputs_and_actions(
+                "action1", {"output/a.csv": {"action": "action1"}}, None
+            )
+            raise KeyboardInterrupt()
+    assert not manifest_file.exists()
+
+    # the update was committed, so is exported next time
+    with open_manifest():
+        pass
+
+    assert list(read_manifest(manifest_file)["outputs"]) == ["output/a.csv"]
+
+
+def test_export_interrupted_and_manifest_edited_externally(
+    open_manifest, manifest_file, caplog
+):
+    with open_manifest() as manifest:
+        manifest.update_outputs_and_actions(
+            "action1", {"output/a.csv": {"action": "action1"}}, None
+        )
+    with pytest.raises(KeyboardInterrupt):
+        with open_manifest() as manifest:
+            manifest.update_outputs_and_actions(
+                "action2", {"output/b.csv": {"action": "action2"}}, None
+            )
+            raise KeyboardInterrupt()
+
+    edited = read_manifest(manifest_file)
+    edited["outputs"]["output/edited.csv"] = {"action": "action1"}
+    manifest_file.write_text(json.dumps(edited, indent=2))
+
+    with open_manifest() as manifest:
+        manifest.update_outputs_and_actions(
+            "action3", {"output/c.csv": {"action": "action3"}}, None
+        )
+
+    # the edit isn't overwritten, so the interrupted update is lost
+    assert list(read_manifest(manifest_file)["outputs"]) == [
+        "output/a.csv",
+        "output/edited.csv",
+        "output/c.csv",
+    ]
+    assert "was changed before we could export our changes" in caplog.text
+
+
+def test_update_failure_rolled_back(open_manifest, manifest_file):
+    with pytest.raises(TypeError):
+        with open_manifest() as manifest:
+            manifest.update_outputs_and_actions(
+                "action1",
+                {
+                    "output/a.csv": {"action": "action1"},
+                    "output/b.csv": {"action": "action1", "bad": object()},
+                },
+                None,
+            )
+
+    with open_manifest():
+        pass
+
+    assert read_manifest(manifest_file)["outputs"] == {}
+
+
+def test_concurrent_updates(open_manifest, manifest_file):
+    def finalize(action):
+        for i in range(10):
+            with open_manifest() as manifest:
+                manifest.update_outputs_and_actions(
+                    action, {f"output/{action}/{i}.csv": {"action": action}}, None
+                )
+
+    threads = [
+        threading.Thread(target=finalize, args=(f"action{i}",)) for i in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(read_manifest(manifest_file)["outputs"]) == 40
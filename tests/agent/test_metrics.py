@@ -5,6 +5,7 @@ import time
 import pytest
 
 from agent import config, metrics
+from agent.executors import cleanup
 from common.job_executor import ExecutorState
 from tests.agent.stubs import StubExecutorAPI
 from tests.conftest import get_trace
@@ -302,3 +303,21 @@ def test_update_job_metrics(db):
         "mem_mb_sample": 100,
         "container_id": "e4f5a6b7",
     }
+
+
+def test_record_metrics_tick_trace_cleanup_backlog(
+    db, freezer, live_server, responses, monkeypatch, tmp_work_dir
+):
+    monkeypatch.setattr("agent.config.TASK_API_ENDPOINT", live_server.url)
+    monkeypatch.setattr("agent.config.CLEANUP_ASYNC", True)
+    monkeypatch.setattr(metrics, "get_job_stats", lambda: {})
+    responses.add_passthru(live_server.url)
+    cleanup.queue_container_removal("os-job-job")
+
+    last_run = time.time()
+    freezer.tick(10)
+    metrics.record_metrics_tick_trace(last_run)
+
+    root = get_trace("metrics")[-1]
+    assert root.name == "METRICS_TICK"
+    assert root.attributes["cleanup_backlog"] == 1
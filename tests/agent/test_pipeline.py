@@ -0,0 +1,210 @@
+import logging
+import threading
+
+import pytest
+
+from agent.pipeline import NORMAL, URGENT, StagedPipeline
+
+
+@pytest.fixture
+def pipeline():
+    pipelines = []
+
+    def create(workers, on_done=None):
+        pipelines.append(StagedPipeline(workers, on_done))
+        return pipelines[-1]
+
+    yield create
+
+    for p in pipelines:
+        p.shutdown()
+
+
+def blocker():
+    """Work which runs until it's released"""
+    started = threading.Event()
+    release = threading.Event()
+
+    def run():
+        started.set()
+        assert release.wait(5)
+
+    return run, started, release
+
+
+def test_runs_work_in_its_stage(pipeline):
+    p = pipeline({"one": 1, "two": 1})
+    ran = []
+
+    assert p.submit("a", "one", lambda: ran.append(("a", threading.current_thread())))
+    assert p.submit("b", "two", lambda: ran.append(("b", threading.current_thread())))
+    p.wait()
+
+    assert sorted((key, thread.name) for key, thread in ran) == [
+        ("a", "one0"),
+        ("b", "two0"),
+    ]
+    assert not p.busy("a")
+
+
+def test_one_piece_of_work_per_key(pipeline):
+    p = pipeline({"one": 1, "two": 1})
+    run, started, release = blocker()
+    ran = []
+
+    assert p.submit("a", "one", run)
+    assert p.busy("a")
+    assert not p.submit("a", "two", lambda: ran.append("a"))
+    assert p.submit("b", "two", lambda: ran.append("b"))
+
+    release.set()
+    p.wait()
+    assert ran == ["b"]
+    assert p.submit("a", "two", lambda: ran.append("a"))
+    p.wait()
+    assert ran == ["b", "a"]
+
+
+def test_slow_stage_does_not_block_others(pipeline):
+    p = pipeline({"slow": 1, "fast": 1})
+    run, started, release = blocker()
+    done = threading.Event()
+
+    p.submit("a", "slow", run)
+    p.submit("b", "fast", done.set)
+
+    assert done.wait(5)
+    assert p.busy("a")
+    release.set()
+
+
+def test_urgent_work_goes_first(pipeline):
+    p = pipeline({"one": 1})
+    run, started, release = blocker()
+    ran = []
+
+    p.submit("blocker", "one", run)
+    assert started.wait(5)
+    for key in ("a", "b"):
+        p.submit(key, "one", lambda key=key: ran.append(key))
+    p.submit("c", "one", lambda: ran.append("c"), URGENT)
+    release.set()
+    p.wait()
+
+    assert ran == ["c", "a", "b"]
+
+
+def test_urgent_work_replaces_queued_work(pipeline):
+    p = pipeline({"one": 1, "two": 1})
+    run, started, release = blocker()
+    ran = []
+
+    p.submit("blocker", "one", run)
+    assert started.wait(5)
+    assert p.submit("a", "one", lambda: ran.append("queued"))
+    assert not p.submit("a", "one", lambda: ran.append("normal"), NORMAL)
+    assert p.submit("a", "two", lambda: ran.append("urgent"), URGENT)
+    assert not p.submit("a", "two", lambda: ran.append("again"), URGENT)
+    release.set()
+    p.wait()
+
+    assert ran == ["urgent"]
+
+
+def test_urgent_work_does_not_replace_started_work(pipeline):
+    p = pipeline({"one": 1})
+    run, started, release = blocker()
+
+    p.submit("a", "one", run)
+    assert started.wait(5)
+
+    assert not p.submit("a", "one", lambda: None, URGENT)
+    release.set()
+
+
+def test_defer(pipeline):
+    p = pipeline({"one": 1, "two": 1})
+    run, started, release = blocker()
+    ran = []
+
+    def first():
+        ran.append(("first", threading.current_thread().name))
+        p.defer("two", run)
+        p.defer("one", lambda: ran.append(("third", threading.current_thread().name)))
+
+    p.submit("a", "one", first)
+    assert started.wait(5)
+    # the key stays locked until the deferred work is done
+    assert p.busy("a")
+    assert not p.submit("a", "one", lambda: None, URGENT)
+    release.set()
+    p.wait()
+
+    assert ran == [("first", "one0"), ("third", "one0")]
+
+
+def test_defer_outside_pipeline(pipeline):
+    p = pipeline({"one": 1})
+    ran = []
+
+    p.defer("one", lambda: ran.append("a"))
+
+    assert ran == ["a"]
+
+
+def test_finished_since_checkpoint(pipeline):
+    p = pipeline({"one": 1})
+    run, started, release = blocker()
+
+    p.submit("a", "one", lambda: p.defer("one", lambda: None))
+    p.wait()
+    p.submit("b", "one", run)
+    assert started.wait(5)
+    p.checkpoint()
+    release.set()
+    p.wait()
+
+    # a finished before the checkpoint, including its deferred work
+    assert not p.finished_since_checkpoint("a")
+    assert p.finished_since_checkpoint("b")
+
+    p.checkpoint()
+    assert not p.finished_since_checkpoint("b")
+
+
+def test_errors_are_isolated(pipeline, caplog):
+    caplog.set_level(logging.ERROR)
+    p = pipeline({"one": 1})
+    ran = []
+
+    p.submit("a", "one", lambda: 1 / 0)
+    p.submit("b", "one", lambda: ran.append("b"))
+    p.wait()
+
+    assert ran == ["b"]
+    assert not p.busy("a")
+    assert caplog.records[-1].msg == "Error in one stage for a"
+    assert caplog.records[-1].exc_info[0] is ZeroDivisionError
+
+
+def test_on_done(pipeline):
+    done = []
+    p = pipeline({"one": 2}, on_done=lambda: done.append(1))
+
+    p.submit("a", "one", lambda: p.defer("one", lambda: None))
+    p.submit("b", "one", lambda: None)
+    p.wait()
+
+    assert len(done) == 3
+
+
+def test_shutdown_waits_for_work():
+    p = StagedPipeline({"one": 1, "two": 2})
+    ran = []
+
+    p.submit("a", "one", lambda: ran.append("a"))
+    p.submit("b", "two", lambda: ran.append("b"))
+    p.shutdown()
+
+    assert sorted(ran) == ["a", "b"]
+    assert not any(thread.is_alive() for _, thread in p.workers)
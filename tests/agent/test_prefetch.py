@@ -0,0 +1,127 @@
+import dataclasses
+from pathlib import Path
+
+import pytest
+
+from agent import prefetch
+from common.job_executor import ExecutorState
+from common.lib import git
+from tests.agent.stubs import StubExecutorAPI
+from tests.factories import canceljob_db_task_factory
+
+
+REPO_FIXTURE = str(Path(__file__).parents[1].resolve() / "fixtures/git-repo")
+COMMIT = "d090466f63b0d68084144d8f105f0d6e79a0819e"
+
+
+@pytest.fixture
+def prefetching(monkeypatch):
+    monkeypatch.setattr("agent.config.GIT_PREFETCH_WORKERS", 2)
+    monkeypatch.setattr("common.config.ALLOW_LOCAL_GIT_REPOS", True)
+
+
+def is_fetched(repo_url, commit):
+    repo_dir = git.get_local_repo_dir(repo_url)
+    return repo_dir.exists() and git.commit_already_fetched(repo_dir, commit)
+
+
+def test_prefetch_code(db, tmp_work_dir, prefetching):
+    api = StubExecutorAPI()
+    task, _ = api.add_test_runjob_task(
+        ExecutorState.UNKNOWN, repo_url=REPO_FIXTURE, commit=COMMIT
+    )
+
+    prefetch.prefetch_code([task], api)
+    prefetch.shutdown()
+
+    assert is_fetched(REPO_FIXTURE, COMMIT)
+
+
+def test_prefetch_code_disabled(db, tmp_work_dir, monkeypatch):
+    monkeypatch.setattr("common.config.ALLOW_LOCAL_GIT_REPOS", True)
+    api = StubExecutorAPI()
+    task, _ = api.add_test_runjob_task(
+        ExecutorState.UNKNOWN, repo_url=REPO_FIXTURE, commit=COMMIT
+    )
+
+    prefetch.prefetch_code([task], api)
+    prefetch.shutdown()
+
+    assert not is_fetched(REPO_FIXTURE, COMMIT)
+
+
+def test_prefetch_code_only_for_new_jobs(db, tmp_work_dir, prefetching, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(
+        prefetch, "prefetch_commit", lambda *args: submitted.append(args)
+    )
+    api = StubExecutorAPI()
+    new_task, _ = api.add_test_runjob_task(
+        ExecutorState.UNKNOWN, repo_url=REPO_FIXTURE, commit=COMMIT
+    )
+    running_task, _ = api.add_test_runjob_task(
+        ExecutorState.EXECUTING, repo_url=REPO_FIXTURE, commit="other"
+    )
+    cancel_task = canceljob_db_task_factory()
+    disallowed_task, _ = api.add_test_runjob_task(
+        ExecutorState.UNKNOWN, repo_url="https://example.com/repo", commit="other"
+    )
+    tasks = [new_task, running_task, cancel_task, disallowed_task]
+
+    prefetch.prefetch_code(tasks, api)
+    # tasks we've already seen are not considered again
+    prefetch.prefetch_code(tasks, api)
+    prefetch.shutdown()
+
+    assert submitted == [(REPO_FIXTURE, COMMIT)]
+
+
+def test_prefetch_code_forgets_inactive_tasks(
+    db, tmp_work_dir, prefetching, monkeypatch
+):
+    submitted = []
+    monkeypatch.setattr(
+        prefetch, "prefetch_commit", lambda *args: submitted.append(args)
+    )
+    api = StubExecutorAPI()
+    task, _ = api.add_test_runjob_task(
+        ExecutorState.UNKNOWN, repo_url=REPO_FIXTURE, commit=COMMIT
+    )
+
+    prefetch.prefetch_code([task], api)
+    prefetch.prefetch_code([], api)
+    assert prefetch._seen_tasks == set()
+    prefetch.prefetch_code([task], api)
+    prefetch.shutdown()
+
+    assert len(submitted) == 2
+
+
+def test_prefetch_code_error_is_logged(db, tmp_work_dir, prefetching, caplog):
+    api = StubExecutorAPI()
+    task, _ = api.add_test_runjob_task(
+        ExecutorState.UNKNOWN, repo_url=REPO_FIXTURE, commit=COMMIT
+    )
+    task = dataclasses.replace(task, definition={})
+
+    prefetch.prefetch_code([task], api)
+
+    assert f"Error starting prefetch for task {task.id}" in caplog.text
+
+
+def test_prefetch_commit_failure_is_logged(tmp_work_dir, caplog):
+    prefetch.prefetch_commit(REPO_FIXTURE, "0" * 40)
+
+    assert f"Failed to prefetch {REPO_FIXTURE}@{'0' * 40}" in caplog.text
+
+
+@pytest.mark.parametrize(
+    "repo_url,allowed",
+    [
+        ("https://github.com/opensafely/study", True),
+        ("https://github.com/not-allowed/study", False),
+        ("/local/repo", True),
+    ],
+)
+def test_is_allowed_repo(repo_url, allowed, prefetching):
+    assert prefetch.is_allowed_repo(repo_url) == allowed
@@ -0,0 +1,218 @@
+import json
+import subprocess
+import urllib.parse
+from types import SimpleNamespace
+
+import pytest
+
+from agent import config
+from agent.executors import local, volumes
+from agent.executors.status_snapshot import LiveStatus, StatusSnapshot
+from agent.lib import docker
+from common.job_executor import ExecutorState
+
+
+LIST_PATH = "/containers/json?" + urllib.parse.urlencode(
+    {"all": "1", "filters": json.dumps({"label": [local.LABEL]})}
+)
+
+
+def job(job_id):
+    return SimpleNamespace(id=job_id, task_id=f"{job_id}-001", created_at=0)
+
+
+def add_container(docker_daemon, job_id, state, containers):
+    name = local.container_name(job_id)
+    containers.append({"Id": f"id-{job_id}", "Names": [f"/{name}"], "State": state})
+    docker_daemon.add_response("GET", LIST_PATH, body=containers)
+    docker_daemon.add_response(
+        "GET",
+        f"/containers/{name}/json",
+        body={
+            "State": {
+                "Running": state == "running",
+                "StartedAt": "2025-01-01T00:00:00.000000001Z",
+                "FinishedAt": "2025-01-01T00:00:01.000000002Z",
+            }
+        },
+    )
+
+
+def write_timestamp(job_definition):
+    path = volumes.host_volume_path(job_definition) / local.TIMESTAMP_REFERENCE_FILE
+    path.parent.mkdir(parents=True)
+    path.write_text("123")
+
+
+def inspect_requests(docker_daemon):
+    return [path for _, path in docker_daemon.requests if path != LIST_PATH]
+
+
+def test_container_states(docker_daemon):
+    add_container(docker_daemon, "running", "running", containers := [])
+    add_container(docker_daemon, "exited", "exited", containers)
+
+    assert docker.container_states(local.LABEL) == {
+        "os-job-running": ("id-running", "running"),
+        "os-job-exited": ("id-exited", "exited"),
+    }
+
+
+def test_container_states_cli(monkeypatch):
+    monkeypatch.setattr(config, "DOCKER_API_SOCKET", "")
+
+    def run(args, **kwargs):
+        assert "label=jobrunner-local" in args
+        lines = [
+            {"ID": "id-running", "Names": "os-job-running", "State": "running"},
+            {"ID": "id-exited", "Names": "os-job-exited,other", "State": "exited"},
+        ]
+        stdout = "\n".join(json.dumps(line) for line in lines)
+        return subprocess.CompletedProcess(args, 0, stdout=stdout)
+
+    monkeypatch.setattr(docker, "docker", run)
+
+    assert docker.container_states(local.LABEL) == {
+        "os-job-running": ("id-running", "running"),
+        "os-job-exited": ("id-exited", "exited"),
+        "other": ("id-exited", "exited"),
+    }
+
+
+def test_list_volumes(tmp_work_dir):
+    assert volumes.list_volumes() == set()
+
+    write_timestamp(job("abc"))
+
+    assert volumes.list_volumes() == {"abc"}
+
+
+def test_get_status_from_snapshot(docker_daemon, tmp_work_dir, monkeypatch):
+    monkeypatch.setattr(config, "STATUS_SNAPSHOT", True)
+    add_container(docker_daemon, "running", "running", containers := [])
+    write_timestamp(job("prepared"))
+    api = local.LocalDockerAPI()
+
+    def statuses():
+        return [
+            api.get_status(job(job_id)).state
+            for job_id in ("running", "prepared", "unknown")
+        ]
+
+    api.snapshot_status()
+    assert statuses() == statuses()
+    assert statuses() == [
+        ExecutorState.EXECUTING,
+        ExecutorState.PREPARED,
+        ExecutorState.UNKNOWN,
+    ]
+    assert api.get_status(job("prepared"), cancelled=True).state == (
+        ExecutorState.PREPARED
+    )
+    assert api.get_status(job("unknown"), cancelled=True).state == (
+        ExecutorState.UNKNOWN
+    )
+    # one list, and one inspect for the only container
+    assert docker_daemon.requests[0] == ("GET", LIST_PATH)
+    assert inspect_requests(docker_daemon) == ["/containers/os-job-running/json"]
+
+    # nothing has changed, so we don't need to inspect anything
+    api.snapshot_status()
+    statuses()
+    assert inspect_requests(docker_daemon) == ["/containers/os-job-running/json"]
+    assert len(docker_daemon.requests) == 3
+
+    # the container has stopped, so we inspect it again
+    containers.clear()
+    add_container(docker_daemon, "running", "exited", containers)
+    api.snapshot_status()
+    assert api.get_status(job("running")).state == ExecutorState.EXECUTED
+    assert len(inspect_requests(docker_daemon)) == 2
+
+
+def test_get_status_after_invalidating(docker_daemon, tmp_work_dir, monkeypatch):
+    monkeypatch.setattr(config, "STATUS_SNAPSHOT", True)
+    docker_daemon.add_response("GET", LIST_PATH, body=[])
+    api = local.LocalDockerAPI()
+    api.snapshot_status()
+    assert api.get_status(job("abc")).state == ExecutorState.UNKNOWN
+
+    # the job is executed during this loop
+    api.invalidate_status(job("abc"))
+    add_container(docker_daemon, "abc", "running", [])
+
+    assert api.get_status(job("abc")).state == ExecutorState.EXECUTING
+    assert api.current_status(job("other")) is api.status_snapshot
+
+
+@pytest.mark.parametrize("method", ["execute", "finalize", "terminate", "cleanup"])
+def test_transitions_invalidate_snapshot(tmp_work_dir, monkeypatch, method):
+    api = local.LocalDockerAPI()
+    api.status_snapshot = StatusSnapshot({}, set())
+    # stop at the first status check
+    monkeypatch.setattr(api, "get_status", lambda *args, **kwargs: 1 / 0)
+    monkeypatch.setattr(local.docker, "delete_container", lambda name: None)
+    monkeypatch.setattr(local.volumes, "delete_volume", lambda job: None)
+
+    with pytest.raises(ZeroDivisionError):
+        getattr(api, method)(job("abc"))
+
+    assert isinstance(api.current_status(job("abc")), LiveStatus)
+    assert api.current_status(job("other")) is api.status_snapshot
+
+
+def test_snapshot_disabled(tmp_work_dir, monkeypatch):
+    monkeypatch.setattr(config, "STATUS_SNAPSHOT", False)
+    api = local.LocalDockerAPI()
+
+    api.snapshot_status()
+
+    assert api.status_snapshot is None
+    api.invalidate_status(job("abc"))
+    status = api.current_status(job("abc"))
+    assert isinstance(status, LiveStatus)
+    assert not status.volume_exists(job("abc"))
+
+
+def test_snapshot_timeout(monkeypatch):
+    monkeypatch.setattr(config, "STATUS_SNAPSHOT", True)
+
+    def timeout(label, timeout=None):
+        raise docker.DockerTimeoutError()
+
+    monkeypatch.setattr(docker, "container_states", timeout)
+    api = local.LocalDockerAPI()
+    api.status_snapshot = StatusSnapshot({}, set())
+
+    api.snapshot_status()
+
+    assert api.status_snapshot is None
+
+
+def test_snapshot_forgets_removed_containers(monkeypatch):
+    monkeypatch.setattr(docker, "container_states", lambda label, timeout: {})
+    monkeypatch.setattr(volumes, "list_volumes", set)
+    previous = StatusSnapshot({"gone": ("id", "exited")}, set())
+    previous.inspected["gone"] = (("id", "exited"), {"State": {}})
+
+    assert StatusSnapshot.take(local.LABEL, previous).inspected == {}
+
+
+def test_watch_events(docker_daemon, monkeypatch):
+    events = [
+        {"Actor": {"ID": "1", "Attributes": {"name": local.container_name("abc")}}},
+        {"Actor": {"ID": "2", "Attributes": {"name": local.container_name("def")}}},
+    ]
+    monkeypatch.setattr(docker, "container_events", lambda label, actions: iter(events))
+    api = local.LocalDockerAPI()
+    changed = []
+
+    api.watch_events(changed.append)
+    assert changed == ["abc", "def"]
+
+    # it invalidates the snapshot, which still has the containers running
+    api.status_snapshot = StatusSnapshot({}, set())
+    api.watch_events(changed.append)
+    assert isinstance(api.current_status(job("abc")), LiveStatus)
+    assert isinstance(api.current_status(job("def")), LiveStatus)
+    assert api.current_status(job("other")) is api.status_snapshot
@@ -143,3 +143,38 @@ def test_full_job_stages(db, responses, monkeypatch, live_server):
     assert db_task.agent_stage == "FINALIZED"
     assert db_task.agent_results == {"test": "test"}
     assert bool(db_task.agent_complete) is True
+
+
+def test_wait_for_tasks_change(db, monkeypatch, responses):
+    monkeypatch.setattr("agent.config.BACKEND", "dummy")
+
+    responses.add(
+        method="GET",
+        url=f"{config.TASK_API_ENDPOINT}dummy/tasks/",
+        status=200,
+        json={"tasks": [], "version": "v1"},
+        match=[matchers.query_param_matcher({"wait": "5"})],
+    )
+    responses.add(
+        method="GET",
+        url=f"{config.TASK_API_ENDPOINT}dummy/tasks/",
+        status=200,
+        json={"tasks": [], "version": "v2"},
+        match=[matchers.query_param_matcher({"wait": "5", "version": "v1"})],
+    )
+
+    assert task_api.wait_for_tasks_change(None, 5) == "v1"
+    assert task_api.wait_for_tasks_change("v1", 5) == "v2"
+
+
+def test_wait_for_tasks_change_live(db, monkeypatch, responses, live_server):
+    monkeypatch.setattr("agent.config.TASK_API_ENDPOINT", live_server.url)
+    monkeypatch.setattr("agent.config.BACKEND", "test")
+    responses.add_passthru(live_server.url)
+
+    version = task_api.wait_for_tasks_change(None, 1)
+    # no changes, so we time out and get the same version back
+    assert task_api.wait_for_tasks_change(version, 0.2) == version
+
+    runjob_db_task_factory(backend="test")
+    assert task_api.wait_for_tasks_change(version, 1) != version
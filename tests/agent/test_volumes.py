@@ -0,0 +1,533 @@
+import errno
+import hashlib
+import os
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from agent.executors import volumes
+
+
+@pytest.fixture(autouse=True)
+def reset_staging_state(monkeypatch):
+    monkeypatch.setattr(volumes, "_unsupported_strategies", volumes.defaultdict(set))
+    monkeypatch.setattr(volumes, "_copy_throughput", {"bytes": 0, "seconds": 0.0})
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "source.txt"
+    path.write_text("source")
+    return path
+
+
+@pytest.fixture
+def read_only_source(source):
+    source.chmod(stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+    return source
+
+
+@pytest.fixture
+def fake_reflink(monkeypatch):
+    def reflink(src, dest):
+        dest.write_text(src.read_text())
+
+    monkeypatch.setattr(volumes, "reflink_file", reflink)
+
+
+@pytest.fixture
+def no_reflink(monkeypatch):
+    monkeypatch.setattr(volumes, "reflink_file", unsupported)
+
+
+def test_stage_file_reflink(source, tmp_path, fake_reflink):
+    dest = tmp_path / "dir/dest.txt"
+    stats = volumes.StagingStats()
+
+    assert volumes.stage_file(source, dest, stats) == "reflink"
+
+    assert dest.read_text() == "source"
+    assert not os.path.samefile(source, dest)
+    assert is_writable(dest)
+    assert stats.files == {"reflink": 1}
+    assert stats.bytes_saved == 6
+
+
+def test_stage_file_hardlink(source, tmp_path, no_reflink):
+    dest = tmp_path / "dest.txt"
+    # existing files are replaced
+    dest.write_text("old")
+
+    assert volumes.stage_file(source, dest, read_only_dest=True) == "hardlink"
+
+    assert os.path.samefile(source, dest)
+
+
+def test_stage_file_does_not_hardlink_into_writable_dest(
+    read_only_source, tmp_path, no_reflink
+):
+    dest = tmp_path / "dest.txt"
+
+    # even though the source is read-only, the job could make its copy writable
+    assert volumes.stage_file(read_only_source, dest) == "copy_file_range"
+
+    assert dest.read_text() == "source"
+    assert not os.path.samefile(read_only_source, dest)
+
+
+def test_stage_file_copy(source, tmp_path, no_reflink, monkeypatch):
+    monkeypatch.setattr(volumes, "copy_file_range", unsupported)
+    dest = tmp_path / "dest.txt"
+
+    assert volumes.stage_file(source, dest) == "copy"
+
+    assert dest.read_text() == "source"
+    assert is_writable(dest)
+
+
+def test_stage_file_remembers_unsupported_strategies(
+    read_only_source, tmp_path, monkeypatch
+):
+    calls = []
+
+    def reflink(src, dest):
+        calls.append(src)
+        raise OSError(errno.EOPNOTSUPP, "not supported")
+
+    monkeypatch.setattr(volumes, "reflink_file", reflink)
+
+    volumes.stage_file(read_only_source, tmp_path / "dest1.txt")
+    volumes.stage_file(read_only_source, tmp_path / "dest2.txt")
+
+    assert len(calls) == 1
+    device = read_only_source.stat().st_dev
+    assert volumes._unsupported_strategies[(device, device)] == {"reflink"}
+
+
+def test_stage_file_other_errors_only_affect_one_file(source, tmp_path, monkeypatch):
+    calls = []
+
+    def hardlink(src, dest):
+        calls.append(src)
+        raise OSError(errno.EMLINK, "too many links")
+
+    monkeypatch.setattr(volumes, "reflink_file", unsupported)
+    monkeypatch.setattr(volumes.os, "link", hardlink)
+
+    for name in ("dest1.txt", "dest2.txt"):
+        strategy = volumes.stage_file(source, tmp_path / name, read_only_dest=True)
+        assert strategy == "copy_file_range"
+
+    assert len(calls) == 2
+    device = source.stat().st_dev
+    assert volumes._unsupported_strategies[(device, device)] == {"reflink"}
+
+
+def test_stage_file_from_many_threads(source, tmp_path, no_reflink):
+    def stage(thread):
+        for i in range(20):
+            volumes.stage_file(source, tmp_path / f"{thread}/{i}.txt")
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(stage, range(8)))
+
+    assert volumes._copy_throughput["bytes"] == 8 * 20 * len("source")
+
+
+def test_stage_to_volume(tmp_work_dir, tmp_path, no_reflink):
+    job = SimpleNamespace(id="job")
+    src = tmp_path / "src"
+    (src / "dir").mkdir(parents=True)
+    (src / "dir/file.txt").write_text("file")
+    (src / "link").symlink_to("dir/file.txt")
+    stats = volumes.StagingStats()
+
+    volumes.stage_to_volume(job, src, ".", stats)
+    volumes.stage_to_volume(job, src / "dir/file.txt", "other.txt", stats)
+
+    volume = volumes.host_volume_path(job)
+    assert (volume / "dir/file.txt").read_text() == "file"
+    assert (volume / "link").is_symlink()
+    assert (volume / "other.txt").read_text() == "file"
+    assert stats.files == {"copy_file_range": 2}
+
+
+def test_staging_stats_span_attributes(monkeypatch):
+    stats = volumes.StagingStats()
+    stats.add("reflink", 1000, 0.1)
+    stats.add("copy_file_range", 500, 1.0)
+
+    # nothing has been copied yet, so we can't estimate the time saved
+    assert stats.span_attributes("staging") == {
+        "staging.bytes_saved": 1000,
+        "staging.reflink.files": 1,
+        "staging.reflink.bytes": 1000,
+        "staging.copy_file_range.files": 1,
+        "staging.copy_file_range.bytes": 500,
+    }
+
+    # 1 byte per ms
+    monkeypatch.setattr(volumes, "_copy_throughput", {"bytes": 500, "seconds": 0.5})
+    assert stats.span_attributes("staging")["staging.seconds_saved"] == (
+        pytest.approx(0.9)
+    )
+
+
+def test_reflink_file(source, tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(volumes.fcntl, "ioctl", lambda *args: calls.append(args))
+    dest = tmp_path / "dest.txt"
+
+    volumes.reflink_file(source, dest)
+
+    assert calls[0][1] == volumes.FICLONE
+    assert stat.S_IMODE(dest.stat().st_mode) == stat.S_IMODE(source.stat().st_mode)
+
+
+def test_copy_file_range(source, tmp_path):
+    dest = tmp_path / "dest.txt"
+
+    volumes.copy_file_range(source, dest)
+
+    assert dest.read_text() == "source"
+
+
+def unsupported(*args):
+    raise OSError(errno.EOPNOTSUPP, "not supported")
+
+
+def is_writable(path):
+    return bool(path.stat().st_mode & stat.S_IWUSR)
+
+
+@pytest.fixture
+def overlay(monkeypatch):
+    monkeypatch.setattr("agent.config.VOLUME_BACKEND", "overlay")
+
+
+@pytest.fixture
+def fake_mounts(monkeypatch):
+    """Record mount commands rather than running them"""
+    mounted = set()
+    commands = []
+
+    def run(cmd, check):
+        commands.append(cmd)
+        if cmd[0] == "mount":
+            mounted.add(cmd[-1])
+        else:
+            mounted.remove(cmd[-1])
+
+    monkeypatch.setattr(volumes.subprocess, "run", run)
+    monkeypatch.setattr(volumes.os.path, "ismount", lambda p: str(p) in mounted)
+    return commands
+
+
+def test_overlay_volume_mount_commands(tmp_work_dir, overlay, fake_mounts):
+    job = SimpleNamespace(id="job")
+    path = str(volumes.host_volume_path(job))
+    layers = volumes.volume_layers_path(job)
+
+    volumes.create_volume(job)
+    volumes.mount_volume(job)
+    # mounting again does nothing
+    volumes.mount_volume(job)
+    # re-creating the volume unmounts it, so the lower layer can be restaged
+    volumes.create_volume(job)
+    volumes.mount_volume(job)
+    volumes.delete_volume(job)
+
+    mount = [
+        "mount",
+        "-t",
+        "overlay",
+        "overlay",
+        "-o",
+        f"lowerdir={layers}/lower,upperdir={layers}/upper,workdir={layers}/work",
+        path,
+    ]
+    umount = ["umount", path]
+    assert fake_mounts == [mount, umount, mount, umount]
+    assert not volumes.host_volume_path(job).exists()
+    assert not layers.exists()
+
+
+def test_overlay_volume_stages_into_lower_layer(
+    source, tmp_work_dir, overlay, fake_mounts, no_reflink
+):
+    job = SimpleNamespace(id="job")
+    volumes.create_volume(job)
+
+    volumes.stage_to_volume(job, source, "input.txt")
+
+    staged = volumes.volume_layers_path(job) / "lower/input.txt"
+    # the lower layer is never written to, so even writable files can be hardlinked
+    assert os.path.samefile(source, staged)
+
+
+def test_overlay_volume_outputs_are_upper_layer(tmp_work_dir, overlay):
+    job = SimpleNamespace(id="job", output_spec={"output/*": "highly_sensitive"})
+    volumes.create_volume(job)
+    lower = volumes.volume_layers_path(job) / "lower"
+    upper = volumes.volume_layers_path(job) / "upper"
+    (lower / "output").mkdir()
+    (lower / "output/input.csv").write_text("input")
+    (upper / "output").mkdir()
+    (upper / "output/output.csv").write_text("output")
+    (upper / "reference").write_text("")
+
+    assert volumes.glob_volume_files(job) == {"output/*": ["output/output.csv"]}
+    assert volumes.find_newer_files(job, "reference") == ["output/output.csv"]
+
+
+def test_overlay_volume_read_after_restart(
+    source, tmp_work_dir, tmp_path, overlay, fake_mounts, no_reflink
+):
+    job = SimpleNamespace(id="job")
+    volumes.create_volume(job)
+    volumes.stage_to_volume(job, source, "input.txt")
+    volumes.mount_volume(job)
+    # as written through the mounted volume
+    upper = volumes.volume_layers_path(job) / "upper"
+    (upper / "reference").write_text("1234")
+    (upper / "output.txt").write_text("output")
+
+    # nothing mounts it again after a restart
+    volumes.unmount_volume(job)
+
+    assert volumes.read_timestamp(job, "reference") == 1234
+    assert volumes.read_timestamp(job, "missing") is None
+    copied = volumes.copy_and_hash_from_volume(job, "output.txt", tmp_path / "out")
+    assert copied.sha256 == hashlib.sha256(b"output").hexdigest()
+    volumes.copy_from_volume(job, "input.txt", tmp_path / "in")
+    assert (tmp_path / "in").read_text() == "source"
+
+    # and it can be mounted again to run the job
+    volumes.mount_volume(job)
+    assert os.path.ismount(volumes.host_volume_path(job))
+
+
+def test_overlay_volume(source, tmp_work_dir, tmp_path, overlay):
+    job = SimpleNamespace(id="job", output_spec={"*": "highly_sensitive"})
+    volumes.create_volume(job)
+    volumes.stage_to_volume(job, source, "input.txt")
+    try:
+        volumes.mount_volume(job)
+    except volumes.subprocess.CalledProcessError:  # pragma: no cover
+        pytest.skip("cannot mount overlay filesystems")
+
+    volume = volumes.host_volume_path(job)
+    try:
+        volumes.write_timestamp(job, "reference")
+        assert (volume / "input.txt").read_text() == "source"
+        (volume / "input.txt").write_text("modified")
+        (volume / "output.txt").write_text("output")
+
+        assert sorted(volumes.find_newer_files(job, "reference")) == [
+            "input.txt",
+            "output.txt",
+        ]
+        # the original input is untouched
+        assert source.read_text() == "source"
+    finally:
+        volumes.delete_volume(job)
+
+    assert not volume.exists()
+    assert not volumes.volume_layers_path(job).exists()
+
+
+VOLUME_FILES = [
+    "a.txt",
+    ".hidden",
+    "output/a.csv",
+    "output/.a.csv",
+    "output/x/a.csv",
+    "output/x/y/b.csv",
+    "abc",
+    "]x",
+    "^x",
+    "o/b/x",
+    "o/d/x",
+    "x.c",
+]
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    [
+        "*",
+        "**/*",
+        "output/*.csv",
+        "output/**/*.csv",
+        "**/a.csv",
+        "a?c",
+        "[ab]*",
+        "[!a]*",
+        "[]]x",
+        "[!]]*",
+        "[^a]*",
+        "[a",
+        "o/[a-c]/x",
+        "*.[ch]",
+        "output/**",
+    ],
+)
+def test_compile_output_pattern_matches_path_glob(pattern, tmp_path):
+    for name in VOLUME_FILES:
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text("")
+    expected = {
+        str(p.relative_to(tmp_path)) for p in tmp_path.glob(pattern) if p.is_file()
+    }
+
+    regex = volumes.compile_output_pattern(pattern)
+
+    assert {name for name in VOLUME_FILES if regex.fullmatch(name)} == expected
+
+
+def test_scan_volume(tmp_work_dir):
+    job = SimpleNamespace(
+        id="job", output_spec={"output/*.csv": "moderately_sensitive", "*": "high"}
+    )
+    volume = volumes.host_volume_path(job)
+    (volume / "output").mkdir(parents=True)
+    (volume / "code.py").write_text("code")
+    (volume / "output/input.csv").write_text("input")
+    os.utime(volume / "code.py", (0, 0))
+    os.utime(volume / "output/input.csv", (0, 0))
+    volumes.write_timestamp(job, "reference")
+    (volume / "output/output.csv").write_text("output")
+    (volume / "output/log.txt").write_text("log")
+    (volume / "link").symlink_to("output")
+
+    scan = volumes.scan_volume(job, "reference")
+
+    assert {k: sorted(v) for k, v in scan.matches.items()} == {
+        "output/*.csv": ["output/input.csv", "output/output.csv"],
+        "*": ["code.py", "reference"],
+    }
+    assert sorted(scan.new_files) == ["output/log.txt", "output/output.csv"]
+    assert volumes.glob_volume_files(job) == scan.matches
+    assert volumes.find_newer_files(job, "reference") == scan.new_files
+
+
+@pytest.mark.benchmark
+def test_scan_volume_benchmark(tmp_work_dir, capsys):
+    """Compare a single scan of a 100k file volume with separately globbing for
+    each output pattern and for new files, as we used to"""
+    output_spec = {
+        "output/patients/*.csv": "highly_sensitive",
+        "output/measures/**/*.csv": "moderately_sensitive",
+        "output/*.txt": "moderately_sensitive",
+        "*.log": "moderately_sensitive",
+    }
+    job = SimpleNamespace(id="job", output_spec=output_spec)
+    volume = volumes.host_volume_path(job)
+    volumes.create_volume(job)
+    volumes.write_timestamp(job, "reference")
+    os.utime(volume / "reference", (0, 0))
+    for i in range(100):
+        (volume / f"output/patients/{i}").mkdir(parents=True)
+        (volume / f"output/measures/{i}").mkdir(parents=True)
+        for j in range(500):
+            (volume / f"output/patients/{i}/{j}.csv").touch()
+            (volume / f"output/measures/{i}/{j}.csv").touch()
+
+    start = time.perf_counter()
+    scan = volumes.scan_volume(job, "reference")
+    scan_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    globbed = {
+        pattern: [str(p.relative_to(volume)) for p in volume.glob(pattern)]
+        for pattern in output_spec
+    }
+    newer = [
+        str(p.relative_to(volume))
+        for p in volume.glob("**/*")
+        if p.is_file() and p.stat().st_mtime > 0
+    ]
+    glob_seconds = time.perf_counter() - start
+
+    assert len(scan.new_files) == len(newer) == 100_000
+    assert {k: sorted(v) for k, v in scan.matches.items()} == {
+        k: sorted(v) for k, v in globbed.items() if v
+    }
+    with capsys.disabled():
+        print(
+            f"\nscan_volume: {scan_seconds:.2f}s, globs: {glob_seconds:.2f}s "
+            f"for 100,000 files"
+        )
+
+
+def test_copy_and_hash(tmp_path):
+    source = tmp_path / "source.bin"
+    contents = os.urandom(3 * volumes.COPY_BUFFER_SIZE + 10)
+    source.write_bytes(contents)
+    source.chmod(0o640)
+    dest = tmp_path / "dir/dest.bin"
+
+    copied = volumes.copy_and_hash(source, dest)
+
+    assert dest.read_bytes() == contents
+    assert stat.S_IMODE(dest.stat().st_mode) == 0o640
+    assert copied == volumes.CopiedFile(
+        size=len(contents), sha256=hashlib.sha256(contents).hexdigest()
+    )
+
+
+def test_copy_and_hash_reads_stream(tmp_path):
+    source = tmp_path / "source.csv"
+    contents = "a,b\n" + "1,2\n" * 100_000
+    source.write_text(contents)
+    dest = tmp_path / "dest.csv"
+
+    def read_stream(f):
+        # only read part of the file; the rest must still be copied
+        return f.readline()
+
+    copied = volumes.copy_and_hash(source, dest, read_stream)
+
+    assert copied.read_result == b"a,b\n"
+    assert dest.read_text() == contents
+    assert copied.sha256 == hashlib.sha256(contents.encode()).hexdigest()
+
+
+def test_copy_and_hash_read_stream_error(tmp_path, caplog):
+    source = tmp_path / "source.csv"
+    source.write_bytes(b"\xff\xfe not utf8 " * 1000)
+    dest = tmp_path / "dest.csv"
+
+    def read_stream(f):
+        return f.read().decode("utf-8")
+
+    copied = volumes.copy_and_hash(source, dest, read_stream)
+
+    assert copied.read_result is None
+    assert dest.read_bytes() == source.read_bytes()
+    assert f"Failed to read {source}" in caplog.text
+
+
+def test_copy_and_hash_max_read_size(tmp_path):
+    source = tmp_path / "source.csv"
+    source.write_text("a,b\n1,2\n")
+
+    copied = volumes.copy_and_hash(
+        source, tmp_path / "dest.csv", lambda f: "read", max_read_size=4
+    )
+
+    assert copied.read_result is None
+
+
+def test_copy_and_hash_from_volume(tmp_work_dir, tmp_path):
+    job = SimpleNamespace(id="job")
+    volumes.create_volume(job)
+    (volumes.host_volume_path(job) / "output.txt").write_text("output")
+
+    copied = volumes.copy_and_hash_from_volume(job, "output.txt", tmp_path / "out.txt")
+
+    assert (tmp_path / "out.txt").read_text() == "output"
+    assert copied.sha256 == hashlib.sha256(b"output").hexdigest()
@@ -1,11 +1,19 @@
+import io
 import os
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from subprocess import CalledProcessError
 from unittest import mock
 
 import pytest
 
+from common.lib import git
 from common.lib.git import (
+    CatFileReaderPool,
     GitError,
     GitFileNotFoundError,
     GitRepoNotReachableError,
@@ -14,11 +22,14 @@ from common.lib.git import (
     checkout_commit,
     commit_already_fetched,
     commit_reachable_from_ref,
+    ensure_commit_fetched,
     ensure_git_init,
     fetch_commit,
+    get_local_repo_dir,
     get_sha_from_remote_ref,
     read_file_from_repo,
     redact_token_from_exception,
+    repo_lock,
 )
 
 
@@ -149,6 +160,186 @@ def test_read_file_from_repo_local_does_not_exist(tmp_work_dir):
         )
 
 
+def test_read_file_from_repo_local_missing_commit(tmp_work_dir, monkeypatch):
+    # e.g. if the fetch was lost, but we still remember making it
+    monkeypatch.setattr(git, "ensure_commit_fetched", lambda *args: None)
+    ensure_git_init(get_local_repo_dir(REPO_FIXTURE))
+
+    with pytest.raises(GitError, match="Error reading from") as exc_info:
+        read_file_from_repo(
+            REPO_FIXTURE,
+            "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74",
+            "project.yaml",
+        )
+    assert not isinstance(exc_info.value, GitFileNotFoundError)
+
+
+def test_read_file_from_repo_local_directory(tmp_work_dir):
+    # Trees aren't files, even though `git show` would list their contents. An
+    # empty path refers to the root directory.
+    with pytest.raises(GitFileNotFoundError):
+        read_file_from_repo(
+            REPO_FIXTURE, "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74", ""
+        )
+
+
+def test_read_file_from_repo_reuses_reader(tmp_work_dir):
+    commit_sha = "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74"
+    read_file_from_repo(REPO_FIXTURE, commit_sha, "project.yaml")
+    readers = dict(git.cat_file_readers.readers)
+
+    with mock.patch("common.lib.git.subprocess.run") as run:
+        output = read_file_from_repo(REPO_FIXTURE, commit_sha, "project.yaml")
+
+    assert output.startswith(b"version: '1.0'")
+    # we know the commit has been fetched so don't check the sentinel tag again,
+    # and the file is read using the same cat-file process
+    run.assert_not_called()
+    assert git.cat_file_readers.readers == readers
+
+
+def test_cat_file_reader_pool_evicts_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setattr("common.config.GIT_CAT_FILE_POOL_SIZE", 2)
+    repo_dirs = [tmp_path / name for name in ["a", "b", "c"]]
+    for repo_dir in repo_dirs:
+        ensure_git_init(repo_dir)
+    pool = CatFileReaderPool()
+
+    readers = [pool.get_reader(repo_dir) for repo_dir in repo_dirs]
+
+    assert list(pool.readers) == repo_dirs[1:]
+    assert not readers[0].is_alive()
+    assert readers[1].is_alive() and readers[2].is_alive()
+    pool.close_all()
+    assert not readers[2].is_alive()
+
+
+def test_cat_file_reader_pool_evicts_idle(tmp_path, monkeypatch):
+    ensure_git_init(tmp_path / "a")
+    ensure_git_init(tmp_path / "b")
+    pool = CatFileReaderPool()
+    idle_reader = pool.get_reader(tmp_path / "a")
+
+    monkeypatch.setattr("common.config.GIT_CAT_FILE_IDLE_TIMEOUT", 0)
+    pool.get_reader(tmp_path / "b")
+
+    assert list(pool.readers) == [tmp_path / "b"]
+    assert not idle_reader.is_alive()
+    pool.close_all()
+
+
+def test_cat_file_reader_pool_replaces_dead_reader(tmp_work_dir):
+    commit_sha = "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74"
+    read_file_from_repo(REPO_FIXTURE, commit_sha, "project.yaml")
+    repo_dir = get_local_repo_dir(REPO_FIXTURE)
+    reader = git.cat_file_readers.readers[repo_dir]
+    reader.process.kill()
+    reader.process.wait()
+
+    output = read_file_from_repo(REPO_FIXTURE, commit_sha, "project.yaml")
+
+    assert output.startswith(b"version: '1.0'")
+    assert git.cat_file_readers.readers[repo_dir] is not reader
+
+
+def test_cat_file_reader_errors(tmp_path):
+    repo_dir = tmp_path / "repo"
+    ensure_git_init(repo_dir)
+    pool = CatFileReaderPool()
+    reader = pool.get_reader(repo_dir)
+
+    with pytest.raises(GitFileNotFoundError):
+        reader.read_object("HEAD:foo\nbar")
+
+    # simulate the process exiting before it responds
+    reader.process.stdout.close()
+    reader.process.stdout = io.BytesIO(b"")
+    with pytest.raises(GitError, match="git cat-file exited"):
+        reader.read_object("HEAD:foo")
+
+    pool.close_all()
+    with pytest.raises(GitError, match="git cat-file closed"):
+        reader.read_object("HEAD:foo")
+    # discarding a reader which is no longer in the pool is harmless
+    pool.discard(repo_dir, reader)
+
+
+@pytest.fixture
+def filterable_repo(tmp_path):
+    """
+    A local repo which, unlike the fixture repo, supports partial clones
+    """
+    repo = tmp_path / "source-repo"
+    (repo / "analysis").mkdir(parents=True)
+    (repo / "project.yaml").write_text("version: '4.0'")
+    (repo / "analysis" / "big.csv").write_text("a,b\n1,2\n")
+
+    def git(*args):
+        return subprocess.run(
+            ["git", *args], cwd=repo, check=True, capture_output=True, text=True
+        ).stdout.strip()
+
+    git("init", "--quiet")
+    git("config", "uploadpack.allowFilter", "true")
+    git("add", ".")
+    git("-c", "user.name=test", "-c", "user.email=test@test", "commit", "-qm", "init")
+    return repo, git("rev-parse", "HEAD")
+
+
+@pytest.fixture
+def blobless(monkeypatch):
+    monkeypatch.setattr("common.config.GIT_BLOBLESS_FETCH", True)
+    monkeypatch.setattr("agent.config.BACKEND", None)
+
+
+def missing_objects(repo_dir, commit_sha):
+    output = subprocess.run(
+        ["git", "rev-list", "--objects", "--missing=print", commit_sha],
+        cwd=repo_dir,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return [line[1:] for line in output.splitlines() if line.startswith("?")]
+
+
+def test_read_file_from_repo_blobless(tmp_work_dir, filterable_repo, blobless):
+    repo, commit_sha = filterable_repo
+
+    output = read_file_from_repo(str(repo), commit_sha, "project.yaml")
+
+    assert output == b"version: '4.0'"
+    repo_dir = get_local_repo_dir(str(repo))
+    # Only the blob we read has been fetched
+    assert len(missing_objects(repo_dir, commit_sha)) == 1
+    # The remote URL (which may contain a token) isn't stored in the repo
+    config = (repo_dir / "config").read_text()
+    assert "promisor = true" in config
+    assert str(repo) not in config
+
+
+def test_read_file_from_repo_blobless_errors(tmp_work_dir, filterable_repo, blobless):
+    repo, commit_sha = filterable_repo
+    read_file_from_repo(str(repo), commit_sha, "project.yaml")
+
+    with pytest.raises(GitFileNotFoundError):
+        read_file_from_repo(str(repo), commit_sha, "unknown.yaml")
+
+    # If the blob can't be fetched on demand git cat-file exits
+    shutil.rmtree(repo)
+    with pytest.raises(GitError, match="Error reading from"):
+        read_file_from_repo(str(repo), commit_sha, "analysis/big.csv")
+
+
+def test_use_blobless_fetch(monkeypatch):
+    monkeypatch.setattr("common.config.GIT_BLOBLESS_FETCH", True)
+    monkeypatch.setattr("agent.config.BACKEND", "test")
+    # agents always do full fetches
+    assert not git.use_blobless_fetch()
+    monkeypatch.setattr("agent.config.BACKEND", None)
+    assert git.use_blobless_fetch()
+
+
 def test_checkout_commit_local(tmp_work_dir, tmp_path):
     target_dir = tmp_path / "files"
     checkout_commit(
@@ -159,6 +350,29 @@ def test_checkout_commit_local(tmp_work_dir, tmp_path):
     assert [f.name for f in target_dir.iterdir()] == ["project.yaml"]
 
 
+def test_checkout_commit_concurrently(tmp_work_dir, tmp_path):
+    # e.g. several jobs being prepared at once, for one or more commits of a repo
+    commits = [
+        "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74",
+        "d090466f63b0d68084144d8f105f0d6e79a0819e",
+    ]
+    for commit in commits:
+        ensure_commit_fetched(get_local_repo_dir(REPO_FIXTURE), REPO_FIXTURE, commit)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [
+            executor.submit(
+                checkout_commit, REPO_FIXTURE, commits[i % 2], tmp_path / str(i)
+            )
+            for i in range(8)
+        ]
+        for future in futures:
+            future.result()
+
+    for i in range(8):
+        assert [f.name for f in (tmp_path / str(i)).iterdir()] == ["project.yaml"]
+
+
 def test_get_sha_from_remote_ref_local(tmp_work_dir):
     sha = get_sha_from_remote_ref(REPO_FIXTURE, "v1")
     assert sha == "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74"
@@ -175,6 +389,56 @@ def test_get_sha_from_remote_ref_local_missing_repo(tmp_work_dir):
         get_sha_from_remote_ref(MISSING_REPO, "v1")
 
 
+def test_get_sha_from_remote_ref_cached(tmp_work_dir, monkeypatch):
+    get_sha_from_remote_ref(REPO_FIXTURE, "v1")
+
+    with mock.patch("common.lib.git.subprocess.run") as run:
+        assert (
+            get_sha_from_remote_ref(REPO_FIXTURE, "v1")
+            == "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74"
+        )
+    run.assert_not_called()
+
+    # bypassing or expiring the cache does a fresh lookup
+    monkeypatch.setattr("common.config.GIT_REF_CACHE_TTL", 0)
+    assert get_sha_from_remote_ref(REPO_FIXTURE, "v1", use_cache=False)
+    with mock.patch("common.lib.git.subprocess.run") as run:
+        run.side_effect = CalledProcessError(returncode=1, cmd=["git"])
+        with pytest.raises(GitRepoNotReachableError):
+            get_sha_from_remote_ref(REPO_FIXTURE, "v1")
+
+
+def test_commit_reachable_from_ref_local(tmp_work_dir):
+    # The "v1" tag points at the parent of the "master" branch
+    commit_sha = "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74"
+    assert commit_reachable_from_ref(
+        REPO_FIXTURE, "d090466f63b0d68084144d8f105f0d6e79a0819e", "master"
+    )
+    assert commit_reachable_from_ref(REPO_FIXTURE, commit_sha, "master")
+    assert not commit_reachable_from_ref(
+        REPO_FIXTURE, "d090466f63b0d68084144d8f105f0d6e79a0819e", "v1"
+    )
+
+    # Once a commit is known to be reachable we don't need to check again
+    with mock.patch("common.lib.git.subprocess.run") as run:
+        assert commit_reachable_from_ref(REPO_FIXTURE, commit_sha, "master")
+    run.assert_not_called()
+
+
+def test_commit_reachable_from_ref_stale_cached_ref(tmp_work_dir):
+    head_sha = "d090466f63b0d68084144d8f105f0d6e79a0819e"
+    # Simulate the branch having moved on since we cached it
+    git.remote_ref_cache[(REPO_FIXTURE, "master")] = (
+        "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74",
+        time.monotonic() + 60,
+    )
+
+    with mock.patch("common.lib.git.fetch_commit") as fetch:
+        assert commit_reachable_from_ref(REPO_FIXTURE, head_sha, "master")
+    # The fresh lookup found the new head, so no history needed fetching
+    fetch.assert_not_called()
+
+
 def test_commit_already_fetched(tmp_path):
     commit_sha = "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74"
     repo_dir = tmp_path / "repo"
@@ -182,6 +446,25 @@ def test_commit_already_fetched(tmp_path):
     assert not commit_already_fetched(repo_dir, commit_sha)
     fetch_commit(repo_dir, REPO_FIXTURE, commit_sha)
     assert commit_already_fetched(repo_dir, commit_sha)
+    # we don't rely on remembering that we fetched it
+    git.known_fetched_commits.clear()
+    assert commit_already_fetched(repo_dir, commit_sha)
+
+
+def test_bounded_cache_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr("common.config.GIT_CACHE_SIZE", 2)
+    cache = git.BoundedCache()
+    cache["a"] = 1
+    cache.add("b")
+    assert "a" in cache
+
+    cache["c"] = 3
+
+    assert len(cache) == 2
+    assert cache.get("a") == 1
+    assert "b" not in cache
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
 
 
 @mock.patch("common.lib.git.time.sleep")
@@ -248,6 +531,52 @@ def test_commit_fetch_retry_unexpected_error(tmp_path):
             fetch_commit(repo_dir, REPO_FIXTURE, commit_sha)
 
 
+def test_ensure_commit_fetched_single_flight(tmp_work_dir):
+    commit_sha = "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74"
+    repo_dir = get_local_repo_dir(REPO_FIXTURE)
+    real_fetch_commit = git.fetch_commit
+
+    def slow_fetch_commit(*args, **kwargs):
+        time.sleep(0.1)
+        real_fetch_commit(*args, **kwargs)
+
+    with mock.patch(
+        "common.lib.git.fetch_commit", side_effect=slow_fetch_commit
+    ) as fetch:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [
+                executor.submit(
+                    ensure_commit_fetched, repo_dir, REPO_FIXTURE, commit_sha
+                )
+                for _ in range(4)
+            ]
+            for future in futures:
+                future.result()
+
+    fetch.assert_called_once()
+    assert commit_already_fetched(repo_dir, commit_sha)
+    assert git._single_flight_locks == {}
+
+
+def test_repo_lock(tmp_path):
+    repo_dir = tmp_path / "repo.git"
+    ensure_git_init(repo_dir)
+    acquired = threading.Event()
+
+    def take_lock():
+        # This opens the lock file separately, just as another process would
+        with repo_lock(repo_dir):
+            acquired.set()
+
+    with repo_lock(repo_dir):
+        thread = threading.Thread(target=take_lock)
+        thread.start()
+        assert not acquired.wait(0.2)
+
+    assert acquired.wait(5)
+    thread.join()
+
+
 @pytest.mark.parametrize(
     "repo_url,token,backend,expected",
     [
@@ -0,0 +1,82 @@
+from unittest import mock
+
+from common.lib import pipeline_cache
+
+
+PROJECT = """
+version: '4.0'
+actions:
+  generate_dataset:
+    run: ehrql:v1 generate-dataset analysis/dataset_definition.py --output output/dataset.csv.gz
+    outputs:
+      highly_sensitive:
+        dataset: output/dataset.csv.gz
+"""
+
+OTHER_PROJECT = PROJECT.replace("generate_dataset", "other_action")
+
+
+def test_get_pipeline_is_cached():
+    read_project_file = mock.Mock(return_value=PROJECT)
+
+    pipeline = pipeline_cache.get_pipeline("repo", "abc", read_project_file)
+    assert pipeline_cache.get_pipeline("repo", "abc", read_project_file) is pipeline
+
+    assert list(pipeline.all_actions) == ["generate_dataset"]
+    read_project_file.assert_called_once()
+
+
+def test_get_pipeline_keyed_on_repo_and_commit():
+    pipeline_cache.get_pipeline("repo", "abc", lambda: PROJECT)
+    other_commit = pipeline_cache.get_pipeline("repo", "def", lambda: OTHER_PROJECT)
+    other_repo = pipeline_cache.get_pipeline("other", "abc", lambda: OTHER_PROJECT)
+
+    assert list(other_commit.all_actions) == ["other_action"]
+    assert list(other_repo.all_actions) == ["other_action"]
+
+
+def test_get_pipeline_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr("common.config.PIPELINE_CACHE_SIZE", 2)
+    read_project_file = mock.Mock(return_value=PROJECT)
+
+    pipeline_cache.get_pipeline("repo", "a", read_project_file)
+    pipeline_cache.get_pipeline("repo", "b", read_project_file)
+    # use "a" so that "b" is the least recently used
+    pipeline_cache.get_pipeline("repo", "a", read_project_file)
+    pipeline_cache.get_pipeline("repo", "c", read_project_file)
+    assert read_project_file.call_count == 3
+
+    pipeline_cache.get_pipeline("repo", "a", read_project_file)
+    assert read_project_file.call_count == 3
+    pipeline_cache.get_pipeline("repo", "b", read_project_file)
+    assert read_project_file.call_count == 4
+
+
+def test_get_pipeline_disk_cache(tmp_work_dir, monkeypatch):
+    monkeypatch.setattr("common.config.PIPELINE_DISK_CACHE", True)
+    pipeline_cache.get_pipeline("repo", "abc", lambda: PROJECT)
+    assert pipeline_cache.get_disk_cache_path("repo", "abc").exists()
+
+    # simulate a restart
+    pipeline_cache.clear()
+    read_project_file = mock.Mock(side_effect=AssertionError("should not be called"))
+    pipeline = pipeline_cache.get_pipeline("repo", "abc", read_project_file)
+
+    assert list(pipeline.all_actions) == ["generate_dataset"]
+
+
+def test_get_pipeline_disk_cache_ignores_corrupt_file(
+    tmp_work_dir, monkeypatch, caplog
+):
+    monkeypatch.setattr("common.config.PIPELINE_DISK_CACHE", True)
+    path = pipeline_cache.get_disk_cache_path("repo", "abc")
+    path.parent.mkdir(parents=True)
+    path.write_bytes(b"not a pickle")
+
+    pipeline = pipeline_cache.get_pipeline("repo", "abc", lambda: PROJECT)
+
+    assert list(pipeline.all_actions) == ["generate_dataset"]
+    assert "Ignoring unreadable pipeline cache file" in caplog.text
+    # the corrupt entry has been replaced
+    pipeline_cache.clear()
+    assert pipeline_cache.read_from_disk("repo", "abc") is not None
@@ -17,8 +17,11 @@ from opentelemetry.sdk.trace.export import SimpleSpanProcessor
 from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
 
 from agent import config as agent_config
-from agent import metrics, task_api
+from agent import metrics, prefetch, task_api
+from agent.executors import job_log_index
+from agent.lib import hash_cache
 from common import config as common_config
+from common.lib import git, pipeline_cache
 from common.tracing import add_exporter, get_provider
 from controller import config as controller_config
 from controller.lib import database, docker
@@ -31,8 +34,18 @@ test_exporter = InMemorySpanExporter()
 add_exporter(provider, test_exporter, processor=SimpleSpanProcessor)
 
 
+def pytest_addoption(parser):
+    parser.addoption(
+        "--benchmark", action="store_true", help="run tests marked as benchmark"
+    )
+
+
 def pytest_configure(config):
     config.addinivalue_line("markers", "slow_test: mark test as being slow running")
+    config.addinivalue_line(
+        "markers",
+        "benchmark: mark test as timing our code, only run with --benchmark",
+    )
     config.addinivalue_line(
         "markers", "needs_docker: mark test as needing Docker daemon"
     )
@@ -55,6 +68,14 @@ def pytest_itemcollected(item):
         item.add_marker(pytest.mark.xdist_group("docker_lib"))
 
 
+def pytest_runtest_setup(item):
+    # timings are too noisy on shared CI machines to run these by default
+    if item.get_closest_marker("benchmark") and not item.config.getoption(
+        "--benchmark"
+    ):
+        pytest.skip("benchmarks only run with --benchmark")
+
+
 @pytest.fixture(scope="session", autouse=True)
 def close_task_api_session():
     # agent.task_api uses a module-level requests.Session. Disable keep-alive
@@ -100,6 +121,12 @@ def close_task_api_session():
 def clear_state():
     yield
     database.CONNECTION_CACHE.__dict__.clear()
+    pipeline_cache.clear()
+    git.cat_file_readers.close_all()
+    git.known_fetched_commits.clear()
+    git.remote_ref_cache.clear()
+    git.reachable_commits.clear()
+    prefetch.shutdown()
     # clear any exported spans
     test_exporter.clear()
 
@@ -116,9 +143,10 @@ def set_tmp_workdir_config(monkeypatch, tmp_path):
     monkeypatch.setattr("common.config.WORKDIR", tmp_path)
     monkeypatch.setattr("controller.config.DATABASE_FILE", tmp_path / "db.sqlite")
     config_vars = {
-        "common": ["GIT_REPO_DIR"],
+        "common": ["GIT_REPO_DIR", "PIPELINE_CACHE_DIR"],
         "agent": [
             "TMP_DIR",
+            "CHECKOUT_CACHE_DIR",
             "HIGH_PRIVACY_STORAGE_BASE",
             "MEDIUM_PRIVACY_STORAGE_BASE",
             "HIGH_PRIVACY_WORKSPACES_DIR",
@@ -306,6 +334,24 @@ def metrics_db(monkeypatch, tmp_path, request):
     metrics.CONNECTION_CACHE.__dict__.clear()
 
 
+@pytest.fixture(autouse=True)
+def hash_cache_db(monkeypatch, tmp_path):
+    """Use a throwaway hash cache db"""
+    monkeypatch.setattr(agent_config, "HASH_CACHE_FILE", tmp_path / "hashes.db")
+    yield
+    for conn in hash_cache.CONNECTION_CACHE.__dict__.values():
+        conn.close()
+    hash_cache.CONNECTION_CACHE.__dict__.clear()
+
+
+@pytest.fixture(autouse=True)
+def close_job_log_index():
+    yield
+    for conn in job_log_index.CONNECTION_CACHE.__dict__.values():
+        conn.close()
+    job_log_index.CONNECTION_CACHE.__dict__.clear()
+
+
 @dataclass
 class SubprocessStub:
     calls: deque = field(default_factory=deque)
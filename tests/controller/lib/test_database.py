@@ -7,6 +7,7 @@ from controller.lib.database import (
     CONNECTION_CACHE,
     MigrationNeeded,
     count_where,
+    delete_where,
     ensure_db,
     ensure_valid_db,
     exists_where,
@@ -187,6 +188,14 @@ def test_count_where(tmp_work_dir):
     assert jobs_with_id == 1
 
 
+def test_delete_where(tmp_work_dir):
+    insert(Job(id="foo123", state=State.PENDING))
+    insert(Job(id="foo124", state=State.RUNNING))
+    insert(Job(id="foo125", state=State.FAILED))
+    delete_where(Job, state__in=[State.PENDING, State.FAILED])
+    assert select_values(Job, "id") == ["foo124"]
+
+
 def test_select_values(tmp_work_dir):
     insert(Job(id="foo123", state=State.PENDING))
     insert(Job(id="foo124", state=State.RUNNING))
@@ -76,3 +76,8 @@ def test_client_tokens_from_env(monkeypatch):
         "UNKNOWN_CLIENT_TOKENS": "token1",
     }
     assert client_tokens_from_env(env) == {"token1": ["foo", "bar"], "token2": ["foo"]}
+
+
+def test_task_long_poll_check_interval_at_least_a_second():
+    cfg = import_cfg({"TASK_LONG_POLL_CHECK_INTERVAL": "0.1"})
+    assert cfg["TASK_LONG_POLL_CHECK_INTERVAL"] == "1.0"
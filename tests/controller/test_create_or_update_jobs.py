@@ -1,3 +1,4 @@
+import contextlib
 import re
 import uuid
 from pathlib import Path
@@ -8,16 +9,19 @@ import pytest
 
 import common.config
 import controller
+from common.lib import pipeline_cache
 from common.lib.github_validators import GithubValidationError
 from controller.create_or_update_jobs import (
     NothingToDoError,
     RapCreateRequestError,
     StaleCodelistError,
     create_jobs,
+    get_run_commands,
     validate_rap_create_request,
 )
 from controller.lib.database import count_where, find_one, find_where, update_where
 from controller.models import Job, State
+from controller.reusable_actions import ReusableAction
 from controller.webapp.views.validators.dataclasses import CreateRequest
 from tests.conftest import get_trace
 
@@ -380,11 +384,84 @@ def test_create_jobs_reruns_failed_dependencies(db, tmp_work_dir):
 
 
 def create_jobs_with_project_file(rap_create_request, project_file):
+    # Tests use different project files with the same commit, so we can't let the
+    # pipeline from a previous call be reused
+    pipeline_cache.clear()
     with mock.patch("controller.create_or_update_jobs.get_project_file") as f:
         f.return_value = project_file
         return create_jobs(rap_create_request)
 
 
+REUSABLE_ACTION_PROJECT = """
+version: '1.0'
+actions:
+  generate_dataset:
+    run: ehrql:v1 generate-dataset analysis/dataset_definition.py --output output.csv.gz
+    outputs:
+      highly_sensitive:
+        cohort: output.csv.gz
+
+  reuse:
+    run: reusable-action:v1 output.csv.gz
+    needs: [generate_dataset]
+    outputs:
+      moderately_sensitive:
+        output: output.txt
+"""
+
+
+def test_create_jobs_fetches_reusable_actions_before_locking(
+    db, tmp_work_dir, monkeypatch
+):
+    locked = []
+
+    @contextlib.contextmanager
+    def workspace_lock(backend, workspace):
+        locked.append(True)
+        yield
+        locked.pop()
+
+    fetched = []
+
+    def fetch_reusable_action(image, tag, cache_stats=None):
+        fetched.append((image, bool(locked)))
+        return ReusableAction(
+            repo_url="https://github.com/opensafely-actions/reusable-action",
+            commit="abcdef0123456789abcdef0123456789abcdef01",
+            action_file=b"run: python:latest main.py",
+        )
+
+    monkeypatch.setattr(
+        "controller.create_or_update_jobs.workspace_lock", workspace_lock
+    )
+    monkeypatch.setattr(
+        "controller.reusable_actions.fetch_reusable_action", fetch_reusable_action
+    )
+
+    create_jobs_with_project_file(
+        make_create_request(action="reuse"), REUSABLE_ACTION_PROJECT
+    )
+
+    assert fetched == [("reusable-action", False)]
+    job = find_one(Job, action="reuse")
+    assert job.run_command == "python:latest main.py output.csv.gz"
+    assert job.action_commit == "abcdef0123456789abcdef0123456789abcdef01"
+
+
+def test_get_run_commands(tmp_work_dir):
+    pipeline_config = pipeline.load_pipeline(TEST_PROJECT)
+    rap_create_request = make_create_request(
+        requested_actions=["analyse_data", "unknown_action"]
+    )
+
+    assert sorted(get_run_commands(rap_create_request, pipeline_config)) == [
+        "ehrql:v1 generate-dataset analysis/dataset_definition.py --output output.csv.gz",
+        "stata-mp:latest analysis/analyse_data.do",
+        "stata-mp:latest analysis/prepare_data_1.do",
+        "stata-mp:latest analysis/prepare_data_2.do",
+    ]
+
+
 def test_create_jobs_tracing(db, tmp_work_dir):
     assert count_where(Job) == 0
 
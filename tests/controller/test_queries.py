@@ -1,7 +1,17 @@
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from controller.lib.database import get_connection
-from controller.queries import get_flag_value, set_flag
+import pytest
+
+from controller.lib.database import count_where, find_one, get_connection, insert
+from controller.models import WorkspaceLock
+from controller.queries import (
+    WorkspaceLockTimeoutError,
+    acquire_workspace_lock,
+    get_flag_value,
+    set_flag,
+    workspace_lock,
+)
 
 
 def test_get_flag_no_table_does_not_error(tmp_work_dir):
@@ -37,3 +47,71 @@ def test_set_flag_multiple_backends(tmp_work_dir):
     assert get_flag_value("foo", backend="test2") is None
     set_flag("foo", "baz", backend="test2")
     assert get_flag_value("foo", backend="test2") == "baz"
+
+
+def test_workspace_lock(tmp_work_dir):
+    with workspace_lock("test", "workspace"):
+        lock = find_one(WorkspaceLock, id="test/workspace")
+        # a different workspace can be locked at the same time
+        with workspace_lock("test", "other-workspace"):
+            assert count_where(WorkspaceLock) == 2
+        # the same workspace cannot
+        assert not acquire_workspace_lock("test/workspace", "someone-else")
+        assert find_one(WorkspaceLock, id="test/workspace").owner == lock.owner
+
+    assert count_where(WorkspaceLock) == 0
+
+
+def test_workspace_lock_released_on_error(tmp_work_dir):
+    with pytest.raises(ValueError):
+        with workspace_lock("test", "workspace"):
+            raise ValueError()
+
+    assert count_where(WorkspaceLock) == 0
+
+
+def test_workspace_lock_timeout(tmp_work_dir, monkeypatch):
+    monkeypatch.setattr("controller.config.WORKSPACE_LOCK_TIMEOUT", 0.2)
+    monkeypatch.setattr("controller.config.WORKSPACE_LOCK_POLL_INTERVAL", 0.01)
+    assert acquire_workspace_lock("test/workspace", "someone-else")
+
+    with pytest.raises(WorkspaceLockTimeoutError, match="workspace 'workspace'"):
+        with workspace_lock("test", "workspace"):
+            pass  # pragma: no cover
+
+    # the other holder's lock is untouched
+    assert find_one(WorkspaceLock, id="test/workspace").owner == "someone-else"
+
+
+def test_workspace_lock_takes_over_expired_lock(tmp_work_dir, monkeypatch, caplog):
+    insert(
+        WorkspaceLock(
+            id="test/workspace", owner="crashed", acquired_at=time.time() - 3600
+        )
+    )
+
+    with workspace_lock("test", "workspace"):
+        assert find_one(WorkspaceLock, id="test/workspace").owner != "crashed"
+
+    assert "Taking over expired lock on test/workspace" in caplog.text
+    assert count_where(WorkspaceLock) == 0
+
+
+def test_workspace_lock_serializes_threads(tmp_work_dir, monkeypatch):
+    monkeypatch.setattr("controller.config.WORKSPACE_LOCK_POLL_INTERVAL", 0.01)
+    holders = []
+    overlaps = []
+
+    def hold_lock(workspace):
+        with workspace_lock("test", workspace):
+            if any(w == workspace for w in holders):
+                overlaps.append(workspace)  # pragma: no cover
+            holders.append(workspace)
+            time.sleep(0.05)
+            holders.remove(workspace)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(hold_lock, ["ws1", "ws1", "ws2", "ws2"]))
+
+    assert overlaps == []
+    assert count_where(WorkspaceLock) == 0
@@ -0,0 +1,189 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from controller import rap_creations
+from controller.lib.database import find_one, find_where
+from controller.models import Job, RapCreation, RapCreationState
+from tests.factories import rap_create_request_factory
+
+
+FIXTURES_PATH = Path(__file__).parent.parent.resolve() / "fixtures"
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        yield executor
+
+
+def handle_pending_creations(executor):
+    """Submit the pending creations and wait for them to be processed"""
+    submitted = rap_creations.handle_pending_creations(executor)
+    # the executor has one worker, so this runs after everything submitted
+    executor.submit(lambda: None).result()
+    return submitted
+
+
+def make_create_request(**kwargs):
+    values = dict(
+        repo_url=str(FIXTURES_PATH / "git-repo"),
+        # GIT_DIR=tests/fixtures/git-repo git rev-parse v1
+        commit="d090466f63b0d68084144d8f105f0d6e79a0819e",
+        branch="v1",
+        requested_actions=["generate_dataset"],
+    )
+    values.update(kwargs)
+    return rap_create_request_factory(**values)
+
+
+def test_record_pending_creation(db):
+    request_obj = make_create_request()
+    rap_creations.record_pending_creation(request_obj)
+
+    creation = rap_creations.get_creation(request_obj.id)
+    assert creation.state == RapCreationState.PENDING
+    assert creation.workspace == request_obj.workspace
+    assert creation.request["commit"] == request_obj.commit
+    assert creation.created_at is not None
+
+    assert rap_creations.get_creation("unknown") is None
+
+
+def test_handle_pending_creations(db, tmp_work_dir, executor):
+    request_obj = make_create_request()
+    rap_creations.record_pending_creation(request_obj)
+
+    assert handle_pending_creations(executor) == 1
+
+    creation = find_one(RapCreation, id=request_obj.id)
+    assert creation.state == RapCreationState.SUCCEEDED
+    assert creation.details == f"Jobs created for rap_id '{request_obj.id}'"
+    assert creation.job_count == 1
+    assert creation.completed_at is not None
+    job = find_one(Job, rap_id=request_obj.id)
+    assert job.action == "generate_dataset"
+
+    # nothing left to process
+    assert handle_pending_creations(executor) == 0
+
+
+def test_handle_pending_creations_same_workspace_in_order(db, tmp_work_dir, executor):
+    first = make_create_request()
+    second = make_create_request()
+    rap_creations.record_pending_creation(first)
+    rap_creations.record_pending_creation(second)
+
+    assert handle_pending_creations(executor) == 2
+
+    assert find_one(RapCreation, id=first.id).state == RapCreationState.SUCCEEDED
+    creation = find_one(RapCreation, id=second.id)
+    assert creation.state == RapCreationState.NOTHING_TO_DO
+    assert creation.details == "All requested actions were already scheduled to run"
+    assert creation.job_count == 0
+    assert len(find_where(Job)) == 1
+
+
+def test_process_rap_creations_skips_creations_no_longer_pending(
+    db, tmp_work_dir, executor, monkeypatch
+):
+    created = []
+
+    def create_jobs(request_obj):
+        created.append(request_obj.id)
+        return 1
+
+    monkeypatch.setattr(rap_creations, "create_jobs", create_jobs)
+    request_obj = make_create_request()
+    stale = rap_creations.record_pending_creation(request_obj)
+    key = (stale.backend, stale.workspace)
+    handle_pending_creations(executor)
+
+    # as if a poll read the creation as pending just before the worker which
+    # processed it finished
+    rap_creations.process_rap_creations(key, [stale])
+
+    assert created == [request_obj.id]
+    creation = find_one(RapCreation, id=request_obj.id)
+    assert creation.state == RapCreationState.SUCCEEDED
+    assert creation.job_count == 1
+
+
+def test_handle_pending_creations_handled_error(db, tmp_work_dir, executor):
+    request_obj = make_create_request(repo_url="https://github.com/otherorg/study")
+    rap_creations.record_pending_creation(request_obj)
+
+    handle_pending_creations(executor)
+
+    creation = find_one(RapCreation, id=request_obj.id)
+    assert creation.state == RapCreationState.FAILED
+    assert "otherorg" in creation.details
+    assert not find_where(Job, rap_id=request_obj.id)
+
+
+def test_handle_pending_creations_unknown_error(
+    db, tmp_work_dir, executor, monkeypatch
+):
+    def error(request_obj):
+        raise Exception("secret details")
+
+    monkeypatch.setattr(rap_creations, "create_jobs", error)
+    request_obj = make_create_request()
+    rap_creations.record_pending_creation(request_obj)
+
+    handle_pending_creations(executor)
+
+    creation = find_one(RapCreation, id=request_obj.id)
+    assert creation.state == RapCreationState.FAILED
+    assert creation.details == "Unknown error"
+
+
+def test_handle_pending_creations_skips_workspaces_in_progress(
+    db, tmp_work_dir, monkeypatch
+):
+    started = threading.Event()
+    release = threading.Event()
+    created = []
+
+    def create_jobs(request_obj):
+        created.append(request_obj.workspace)
+        if request_obj.workspace == "slow":
+            started.set()
+            release.wait(5)
+        return 1
+
+    monkeypatch.setattr(rap_creations, "create_jobs", create_jobs)
+    rap_creations.record_pending_creation(make_create_request(workspace="slow"))
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert rap_creations.handle_pending_creations(executor) == 1
+        assert started.wait(5)
+
+        # the slow workspace is still in progress, but doesn't hold up another
+        rap_creations.record_pending_creation(make_create_request(workspace="slow"))
+        rap_creations.record_pending_creation(make_create_request(workspace="fast"))
+        assert rap_creations.handle_pending_creations(executor) == 1
+        release.set()
+
+    assert sorted(created) == ["fast", "slow"]
+    assert rap_creations._in_flight == set()
+    # now the slow workspace's next creation can be processed
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert handle_pending_creations(executor) == 1
+    assert created[-1] == "slow"
+
+
+def test_process_rap_creations_error(db, caplog, monkeypatch):
+    def error(creation):
+        raise Exception("database locked")
+
+    monkeypatch.setattr(rap_creations, "process_rap_creation", error)
+    creation = rap_creations.record_pending_creation(make_create_request())
+    rap_creations._in_flight.add(("test", "workspace"))
+
+    rap_creations.process_rap_creations(("test", "workspace"), [creation])
+
+    assert rap_creations._in_flight == set()
+    assert "database locked" in caplog.text
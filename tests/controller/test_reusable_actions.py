@@ -1,3 +1,4 @@
+from collections import Counter
 from copy import deepcopy
 from unittest import mock
 
@@ -8,28 +9,39 @@ from controller import reusable_actions
 from controller.lib.yaml_utils import YAMLError
 from controller.models import Job
 from controller.reusable_actions import ReusableAction
+from tests.conftest import get_trace
 from tests.factories import JOB_DEFAULTS
 
 
-@mock.patch.multiple(
-    "common.lib.git",
-    get_sha_from_remote_ref=mock.DEFAULT,
-    read_file_from_repo=mock.DEFAULT,
-)
+COMMIT = "abcdef0123456789abcdef0123456789abcdef01"
+
+
+@pytest.fixture
+def git_mocks(db):
+    with mock.patch.multiple(
+        "common.lib.git",
+        get_sha_from_remote_ref=mock.DEFAULT,
+        read_file_from_repo=mock.DEFAULT,
+    ) as mocks:
+        mocks["get_sha_from_remote_ref"].return_value = COMMIT
+        mocks["read_file_from_repo"].return_value = b"run: python:latest main.py"
+        yield mocks
+
+
 class TestHandleReusableAction:
-    def test_when_not_a_reusable_action(self, **kwargs):
+    def test_when_not_a_reusable_action(self, git_mocks):
         # Happy path 1
         action_in = "python:latest python analysis/my_action.py"
         action_out = reusable_actions.handle_reusable_action(action_in)[0]
         assert action_in is action_out
-        kwargs["get_sha_from_remote_ref"].assert_not_called()
-        kwargs["read_file_from_repo"].assert_not_called()
+        git_mocks["get_sha_from_remote_ref"].assert_not_called()
+        git_mocks["read_file_from_repo"].assert_not_called()
 
     @mock.patch(
         "controller.reusable_actions.parse_yaml",
         return_value={"run": "python:latest python reusable_action/main.py"},
     )
-    def test_when_a_reusable_action_with_options(self, *args, **kwargs):
+    def test_when_a_reusable_action_with_options(self, mock_parse_yaml, git_mocks):
         # Happy path 2
         action_in = "reusable-action:latest --output-format=png"
         action_out = reusable_actions.handle_reusable_action(action_in)[0]
@@ -43,7 +55,7 @@ class TestHandleReusableAction:
         "controller.reusable_actions.parse_yaml",
         return_value={"run": "python:latest python reusable_action/main.py"},
     )
-    def test_when_a_reusable_action_with_arguments(self, *args, **kwargs):
+    def test_when_a_reusable_action_with_arguments(self, mock_parse_yaml, git_mocks):
         # Happy path 3
         action_in = "reusable-action:latest output/input.csv"
         action_out = reusable_actions.handle_reusable_action(action_in)[0]
@@ -57,7 +69,9 @@ class TestHandleReusableAction:
         "controller.reusable_actions.parse_yaml",
         return_value={"run": "python:latest python reusable_action/main.py"},
     )
-    def test_when_a_reusable_action_with_options_and_arguments(self, *args, **kwargs):
+    def test_when_a_reusable_action_with_options_and_arguments(
+        self, mock_parse_yaml, git_mocks
+    ):
         # Happy path 4
         # We'll use Click's terminology.
         # * Options are optional
@@ -72,7 +86,7 @@ class TestHandleReusableAction:
             == "python:latest python reusable_action/main.py --output-format=png output/input.csv"
         )
 
-    def test_with_bad_run_command(self, **kwargs):
+    def test_with_bad_run_command(self, git_mocks):
         # We don't need to check the scheme, netloc, or org because we add those.
         with pytest.raises(reusable_actions.ReusableActionError):
             reusable_actions.handle_reusable_action(
@@ -82,8 +96,8 @@ class TestHandleReusableAction:
     @pytest.mark.parametrize(
         "side_effect", [git.GitUnknownRefError, git.GitRepoNotReachableError]
     )
-    def test_with_bad_remote_ref(self, side_effect, **kwargs):
-        kwargs["get_sha_from_remote_ref"].side_effect = side_effect
+    def test_with_bad_remote_ref(self, side_effect, git_mocks):
+        git_mocks["get_sha_from_remote_ref"].side_effect = side_effect
         with pytest.raises(reusable_actions.ReusableActionError):
             reusable_actions.handle_reusable_action("reusable-action:latest")
 
@@ -91,14 +105,14 @@ class TestHandleReusableAction:
         "side_effect", [github_validators.GithubValidationError, git.GitError]
     )
     @mock.patch("controller.reusable_actions.validate_branch_and_commit")
-    def test_with_bad_commit(self, patched, side_effect, **kwargs):
+    def test_with_bad_commit(self, patched, side_effect, git_mocks):
         patched.side_effect = side_effect
         with pytest.raises(reusable_actions.ReusableActionError):
             reusable_actions.handle_reusable_action("reusable-action:latest")
 
     @pytest.mark.parametrize("side_effect", [git.GitError, git.GitFileNotFoundError])
-    def test_with_bad_file(self, side_effect, **kwargs):
-        kwargs["read_file_from_repo"].side_effect = side_effect
+    def test_with_bad_file(self, side_effect, git_mocks):
+        git_mocks["read_file_from_repo"].side_effect = side_effect
         with pytest.raises(reusable_actions.ReusableActionError):
             reusable_actions.handle_reusable_action("reusable-action:latest")
 
@@ -106,12 +120,12 @@ class TestHandleReusableAction:
         "controller.reusable_actions.parse_yaml",
         side_effect=YAMLError,
     )
-    def test_with_bad_yaml(self, *args, **kwargs):
+    def test_with_bad_yaml(self, mock_parse_yaml, git_mocks):
         with pytest.raises(reusable_actions.ReusableActionError):
             reusable_actions.handle_reusable_action("reusable-action:latest")
 
     @mock.patch("controller.reusable_actions.parse_yaml", return_value={})
-    def test_with_bad_action_config(self, *args, **kwargs):
+    def test_with_bad_action_config(self, mock_parse_yaml, git_mocks):
         with pytest.raises(reusable_actions.ReusableActionError):
             reusable_actions.handle_reusable_action("reusable-action:latest")
 
@@ -123,7 +137,7 @@ class TestHandleReusableAction:
             "ehrql:v1 generate-dataset dataset.py --output dataset.csv",
         ],
     )
-    def test_reusable_action_with_invalid_runtime(self, action, *args, **kwargs):
+    def test_reusable_action_with_invalid_runtime(self, action):
         reusable_action = ReusableAction(
             repo_url="foo", commit="bar", action_file=f"run: {action}".encode("ascii")
         )
@@ -134,7 +148,7 @@ class TestHandleReusableAction:
         "controller.reusable_actions.parse_yaml",
         return_value={"run": "python:latest python reusable_action/main.py"},
     )
-    def test_resolve_reusable_action_references(self, *args, **kwargs):
+    def test_resolve_reusable_action_references(self, mock_parse_yaml, git_mocks):
         job1_data = deepcopy(JOB_DEFAULTS)
         job1_data["run_command"] = "python:v1 myscript.py"
 
@@ -158,12 +172,16 @@ class TestHandleReusableAction:
         "controller.reusable_actions.validate_branch_and_commit",
         side_effect=[mock.DEFAULT, git.GitUnknownRefError],
     )
-    def test_resolve_reusable_action_references_error(self, *args, **kwargs):
+    def test_resolve_reusable_action_references_error(
+        self, mock_validate, mock_parse_yaml, git_mocks
+    ):
+        # The tags point at different commits, so the second is validated separately
+        git_mocks["get_sha_from_remote_ref"].side_effect = [COMMIT, "f" * 40]
         job1_data = deepcopy(JOB_DEFAULTS)
-        job1_data["run_command"] = "reusable-action:latest --output-format=jpg"
+        job1_data["run_command"] = "reusable-action:v1 --output-format=jpg"
 
         job2_data = deepcopy(JOB_DEFAULTS)
-        job2_data["run_command"] = "reusable-action:latest --output-format=png"
+        job2_data["run_command"] = "reusable-action:v2 --output-format=png"
 
         jobs = [Job(**job1_data), Job(**job2_data)]
 
@@ -178,13 +196,13 @@ class TestHandleReusableAction:
             == "python:latest python reusable_action/main.py --output-format=jpg"
         )
         # job2 raised exception, not resolved
-        assert jobs[1].run_command == "reusable-action:latest --output-format=png"
+        assert jobs[1].run_command == "reusable-action:v2 --output-format=png"
 
     @mock.patch(
         "controller.reusable_actions.parse_yaml",
         return_value={"run": "python:latest python reusable_action/main.py"},
     )
-    def test_caching(self, mock_parse_yaml, *args, **kwargs):
+    def test_caching(self, mock_parse_yaml, git_mocks):
         job1_data = deepcopy(JOB_DEFAULTS)
         job1_data["run_command"] = "reusable-action:latest --output-format=jpg"
 
@@ -210,3 +228,111 @@ class TestHandleReusableAction:
         # ReusableAction.rewrite_run_args that does the work of parsing the
         # mocked value. That also implies there is only one ReusableAction.
         assert mock_parse_yaml.call_count == 1
+
+
+@mock.patch(
+    "controller.reusable_actions.parse_yaml",
+    return_value={"run": "python:latest python reusable_action/main.py"},
+)
+def test_prefetch_reusable_actions(mock_parse_yaml, git_mocks):
+    cache = reusable_actions.prefetch_reusable_actions(
+        [
+            "python:v1 myscript.py",
+            "reusable-action:latest --output-format=png",
+            "../my-bad-org/reusable-action:latest",
+        ]
+    )
+
+    assert list(cache) == [("reusable-action", "latest")]
+
+    git_mocks["get_sha_from_remote_ref"].reset_mock()
+    job_data = deepcopy(JOB_DEFAULTS)
+    job_data["run_command"] = "reusable-action:latest --output-format=jpg"
+    job = Job(**job_data)
+    reusable_actions.resolve_reusable_action_references([job], cache)
+
+    assert job.run_command == (
+        "python:latest python reusable_action/main.py --output-format=jpg"
+    )
+    git_mocks["get_sha_from_remote_ref"].assert_not_called()
+
+    # errors are raised when resolving the jobs which use the action
+    job_data["run_command"] = "../my-bad-org/reusable-action:latest"
+    with pytest.raises(reusable_actions.ReusableActionError):
+        reusable_actions.resolve_reusable_action_references([Job(**job_data)], cache)
+
+
+def tag_lookups(git_mocks, tag):
+    # validating the commit also looks up the main branch, so just count the tag
+    calls = git_mocks["get_sha_from_remote_ref"].call_args_list
+    return len([c for c in calls if c.args[1] == tag])
+
+
+def test_fetch_reusable_action_cached(git_mocks, freezer):
+    cache_stats = Counter()
+    first = reusable_actions.fetch_reusable_action("reusable-action", "v1", cache_stats)
+    second = reusable_actions.fetch_reusable_action(
+        "reusable-action", "v1", cache_stats
+    )
+
+    assert first == second
+    assert second.commit == COMMIT
+    assert second.action_file == b"run: python:latest main.py"
+    assert tag_lookups(git_mocks, "v1") == 1
+    git_mocks["read_file_from_repo"].assert_called_once()
+    assert cache_stats == {
+        "tag_cache_misses": 1,
+        "tag_cache_hits": 1,
+        "action_file_cache_misses": 1,
+        "action_file_cache_hits": 1,
+    }
+
+
+def test_fetch_reusable_action_tag_expires(git_mocks, freezer, monkeypatch):
+    monkeypatch.setattr("controller.config.REUSABLE_ACTION_TAG_TTL", 60)
+    reusable_actions.fetch_reusable_action("reusable-action", "v1")
+
+    freezer.tick(61)
+    cache_stats = Counter()
+    reusable_actions.fetch_reusable_action("reusable-action", "v1", cache_stats)
+
+    # the tag is looked up again, but the action file for the commit is still cached
+    assert tag_lookups(git_mocks, "v1") == 2
+    git_mocks["read_file_from_repo"].assert_called_once()
+    assert cache_stats == {"tag_cache_misses": 1, "action_file_cache_hits": 1}
+
+
+def test_fetch_reusable_action_unknown_tag_cached(git_mocks, freezer, monkeypatch):
+    monkeypatch.setattr("controller.config.REUSABLE_ACTION_UNKNOWN_TAG_TTL", 60)
+    git_mocks["get_sha_from_remote_ref"].side_effect = git.GitUnknownRefError
+    cache_stats = Counter()
+
+    for _ in range(2):
+        with pytest.raises(reusable_actions.ReusableActionError, match="not a tag"):
+            reusable_actions.fetch_reusable_action("reusable-action", "v9", cache_stats)
+    git_mocks["get_sha_from_remote_ref"].assert_called_once()
+    assert cache_stats == {"tag_cache_misses": 1, "unknown_tag_cache_hits": 1}
+
+    # once the negative entry expires we check again, and pick up the new tag
+    freezer.tick(61)
+    git_mocks["get_sha_from_remote_ref"].side_effect = None
+    action = reusable_actions.fetch_reusable_action("reusable-action", "v9")
+    assert action.commit == COMMIT
+
+
+@mock.patch(
+    "controller.reusable_actions.parse_yaml",
+    return_value={"run": "python:latest python reusable_action/main.py"},
+)
+def test_resolve_reusable_action_references_tracing(mock_parse_yaml, git_mocks):
+    job_data = deepcopy(JOB_DEFAULTS)
+    job_data["run_command"] = "reusable-action:latest"
+
+    reusable_actions.resolve_reusable_action_references([Job(**job_data)])
+    reusable_actions.resolve_reusable_action_references([Job(**job_data)])
+
+    spans = get_trace("reusable_actions")
+    assert spans[0].attributes["reusable_actions.tag_cache_misses"] == 1
+    assert spans[0].attributes["reusable_actions.action_file_cache_misses"] == 1
+    assert spans[1].attributes["reusable_actions.tag_cache_hits"] == 1
+    assert spans[1].attributes["reusable_actions.action_file_cache_hits"] == 1
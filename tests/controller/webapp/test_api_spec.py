@@ -59,7 +59,7 @@ class Recorder:
     expected_status_codes_by_path = {
         "/backend/status/": {200, 401},
         "/rap/cancel/": {200, 400, 401, 404},
-        "/rap/create/": {200, 201, 400, 401},
+        "/rap/create/": {200, 201, 202, 400, 401},
         "/rap/status/": {200, 400, 401},
     }
     status_codes = defaultdict(set)
@@ -150,6 +150,16 @@ def test_api_with_auth(db, case, recorder):
     )
 
 
+@hypothesis.settings(deadline=None)
+@schema.include(path="/rap/create/").parametrize()
+def test_api_create_async(db, case, recorder, monkeypatch):
+    # In async mode, new create requests are accepted with a 202
+    monkeypatch.setattr("controller.config.RAP_CREATE_ASYNC", True)
+    call_and_validate(
+        case, recorder, call_kwargs={"headers": {"Authorization": "token"}}
+    )
+
+
 def call_and_validate(case, recorder, call_kwargs=None):
     call_kwargs = call_kwargs or {}
     # Note: we're not using case.call_and_validate() here so that we can record the status
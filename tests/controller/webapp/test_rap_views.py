@@ -8,9 +8,17 @@ from django.urls import reverse
 from pipeline import load_pipeline
 
 from common.lib.git import read_file_from_repo
-from controller.lib.database import find_one, find_where
-from controller.models import Job, State, StatusCode, timestamp_to_isoformat
+from controller.lib.database import find_one, find_where, update
+from controller.models import (
+    Job,
+    RapCreation,
+    RapCreationState,
+    State,
+    StatusCode,
+    timestamp_to_isoformat,
+)
 from controller.queries import set_flag
+from controller.rap_creations import record_pending_creation
 from controller.webapp.views.rap_views import job_to_api_format
 from tests.conftest import get_trace
 from tests.factories import (
@@ -507,6 +515,71 @@ def test_create_view_not_allowed_for_backend(db, client, monkeypatch):
     }
 
 
+def test_create_view_async(db, client, monkeypatch):
+    monkeypatch.setattr("controller.config.CLIENT_TOKENS", {"test_token": ["test"]})
+    monkeypatch.setattr("controller.config.RAP_CREATE_ASYNC", True)
+    headers = {"Authorization": "test_token"}
+
+    rap_request_body = rap_api_v1_factory_raw(
+        repo_url=str(FIXTURES_PATH / "git-repo"),
+        commit="d090466f63b0d68084144d8f105f0d6e79a0819e",
+        branch="v1",
+        requested_actions=["generate_dataset"],
+    )
+    rap_id = rap_request_body["rap_id"]
+
+    def post(body):
+        return client.post(
+            reverse("create"),
+            json.dumps(body),
+            headers=headers,
+            content_type="application/json",
+        )
+
+    response = post(rap_request_body)
+    assert response.status_code == 202
+    assert response.json() == {
+        "result": "Accepted",
+        "details": f"Jobs will be created for rap_id '{rap_id}'",
+        "rap_id": rap_id,
+        "count": 0,
+    }
+    # no jobs created yet, just a pending creation
+    assert not find_where(Job, rap_id=rap_id)
+    creation = find_one(RapCreation, id=rap_id)
+    assert creation.state == RapCreationState.PENDING
+
+    # repeating the request is fine
+    response = post(rap_request_body)
+    assert response.status_code == 202
+    assert len(find_where(RapCreation, id=rap_id)) == 1
+
+    # but not with different data
+    response = post({**rap_request_body, "workspace": "another-workspace"})
+    assert response.status_code == 400
+    assert response.json()["error"] == "Inconsistent request data"
+
+    # a failed creation is tried again
+    creation.state = RapCreationState.FAILED
+    creation.details = "Unknown error"
+    creation.completed_at = 1
+    update(creation)
+    response = post({**rap_request_body, "force_run_dependencies": True})
+    assert response.status_code == 202
+    creation = find_one(RapCreation, id=rap_id)
+    assert creation.state == RapCreationState.PENDING
+    assert creation.details is None
+    assert creation.completed_at is None
+    assert creation.request["force_run_dependencies"] is True
+
+    # but one which has succeeded isn't
+    creation.state = RapCreationState.SUCCEEDED
+    update(creation)
+    response = post(rap_request_body)
+    assert response.status_code == 202
+    assert find_one(RapCreation, id=rap_id).state == RapCreationState.SUCCEEDED
+
+
 def test_create_view_jobs_already_created(db, client, monkeypatch):
     monkeypatch.setattr("controller.config.CLIENT_TOKENS", {"test_token": ["test"]})
     headers = {"Authorization": "test_token"}
@@ -810,6 +883,48 @@ def test_status_view(db, client, monkeypatch, state, status_code):
     }, response
 
 
+@pytest.mark.parametrize(
+    "state,details,count",
+    [
+        (RapCreationState.PENDING, None, 0),
+        (RapCreationState.NOTHING_TO_DO, "All actions have already completed", 0),
+        (RapCreationState.FAILED, "GitError: Error fetching commit", 0),
+    ],
+)
+def test_status_view_rap_creations(db, client, monkeypatch, state, details, count):
+    monkeypatch.setattr("controller.config.CLIENT_TOKENS", {"test_token": ["test"]})
+    headers = {"Authorization": "test_token"}
+
+    request_obj = rap_create_request_factory(backend="test")
+    creation = record_pending_creation(request_obj)
+    creation.state = state
+    creation.details = details
+    update(creation)
+    # a creation on a backend we can't see is unrecognised
+    other = record_pending_creation(rap_create_request_factory(backend="test1"))
+
+    response = client.post(
+        reverse("status"),
+        json.dumps({"rap_ids": [request_obj.id, other.id]}),
+        headers=headers,
+        content_type="application/json",
+    )
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "jobs": [],
+        "unrecognised_rap_ids": [other.id],
+        "rap_creations": [
+            {
+                "rap_id": request_obj.id,
+                "status": state.value,
+                "details": details or "",
+                "count": count,
+            }
+        ],
+    }
+
+
 def test_status_view_validation_error(db, client, monkeypatch):
     monkeypatch.setattr("controller.config.CLIENT_TOKENS", {"test_token": ["test"]})
     headers = {"Authorization": "test_token"}
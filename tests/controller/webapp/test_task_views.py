@@ -5,6 +5,7 @@ from datetime import UTC, datetime
 from django.http import JsonResponse
 from django.urls import reverse
 
+from controller import task_api as controller_task_api
 from controller.lib import database
 from controller.models import Task
 from controller.queries import get_flag_value
@@ -109,6 +110,80 @@ def test_active_tasks_view_multiple_backends(db, client, monkeypatch):
     assert {task["id"] for task in response["tasks"]} == {runtask2.id, canceltask3.id}
 
 
+def test_active_tasks_view_version(db, client, monkeypatch):
+    monkeypatch.setattr("controller.config.JOB_SERVER_TOKENS", {"test": "test_token"})
+    headers = {"Authorization": "test_token"}
+    url = reverse("active_tasks", args=("test",))
+
+    version = client.get(url, headers=headers).json()["version"]
+    assert client.get(url, headers=headers).json()["version"] == version
+
+    task = runjob_db_task_factory(backend="test")
+    new_version = client.get(url, headers=headers).json()["version"]
+    assert new_version != version
+
+    controller_task_api.mark_task_inactive(task)
+    assert client.get(url, headers=headers).json()["version"] == version
+
+
+def test_active_tasks_view_long_poll_timeout(db, client, monkeypatch):
+    monkeypatch.setattr("controller.config.JOB_SERVER_TOKENS", {"test": "test_token"})
+    monkeypatch.setattr("controller.config.TASK_LONG_POLL_CHECK_INTERVAL", 0.01)
+    headers = {"Authorization": "test_token"}
+    url = reverse("active_tasks", args=("test",))
+
+    runjob_db_task_factory(backend="test")
+    version = client.get(url, headers=headers).json()["version"]
+
+    start = time.monotonic()
+    response = client.get(
+        url, {"version": version, "wait": "0.2"}, headers=headers
+    ).json()
+    assert time.monotonic() - start >= 0.2
+    assert response["version"] == version
+    assert len(response["tasks"]) == 1
+    assert get_flag_value("last-seen-at", "test") is not None
+
+
+def test_active_tasks_view_long_poll_max_wait(db, client, monkeypatch):
+    monkeypatch.setattr("controller.config.JOB_SERVER_TOKENS", {"test": "test_token"})
+    monkeypatch.setattr("controller.config.TASK_LONG_POLL_MAX_WAIT", 0)
+    headers = {"Authorization": "test_token"}
+    url = reverse("active_tasks", args=("test",))
+
+    version = client.get(url, headers=headers).json()["version"]
+    # max wait of 0 means we return immediately
+    response = client.get(url, {"version": version, "wait": "600"}, headers=headers)
+    assert response.json()["version"] == version
+
+
+def test_active_tasks_view_long_poll_changed(db, client, monkeypatch):
+    monkeypatch.setattr("controller.config.JOB_SERVER_TOKENS", {"test": "test_token"})
+    headers = {"Authorization": "test_token"}
+    url = reverse("active_tasks", args=("test",))
+
+    version = client.get(url, headers=headers).json()["version"]
+    task = runjob_db_task_factory(backend="test")
+
+    # tasks have already changed since the version we sent, so we return immediately
+    start = time.monotonic()
+    response = client.get(url, {"version": version, "wait": "10"}, headers=headers)
+    assert time.monotonic() - start < 10
+    assert response.json()["version"] != version
+    assert [t["id"] for t in response.json()["tasks"]] == [task.id]
+
+
+def test_active_tasks_view_invalid_wait(db, client, monkeypatch):
+    monkeypatch.setattr("controller.config.JOB_SERVER_TOKENS", {"test": "test_token"})
+    response = client.get(
+        reverse("active_tasks", args=("test",)),
+        {"wait": "forever"},
+        headers={"Authorization": "test_token"},
+    )
+    assert response.status_code == 400
+    assert response.json()["error"] == "Invalid wait parameter"
+
+
 def test_active_tasks_unknown_backend(db, client):
     response = client.get(reverse("active_tasks", args=("foo",)))
     assert response.status_code == 404